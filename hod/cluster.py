@@ -28,6 +28,7 @@ Cluster and label functions.
 @author: Kenneth Hoste (Universiteit Gent)
 """
 
+import json
 import os
 import shutil
 from collections import namedtuple
@@ -95,11 +96,11 @@ def _cluster_info(label, info_file):
     """
     labels = known_cluster_labels()
     if label in labels:
-        info_file = os.path.join(cluster_info_dir(), label, info_file)
-        if os.path.exists(info_file):
-            return info_file
+        info_path = os.path.join(cluster_info_dir(), label, info_file)
+        if os.path.exists(info_path):
+            return info_path
         else:
-            raise ValueError("No 'env' file found for cluster with label '%s'" % label)
+            raise ValueError("No '%s' file found for cluster with label '%s'" % (info_file, label))
     else:
         raise ValueError("Unknown cluster label '%s': %s" % (label, labels))
 
@@ -189,6 +190,32 @@ def save_cluster_info(cluster_info):
         _log.error("Failed to write cluster info files: %s", err)
 
 
+def save_grow_info(label, grow_info):
+    """
+    Save the rendezvous info for 'hod grow' (a dict with host, port, token and modules) for this cluster.
+    Only the owner can read it, since the token gives access to the cluster configuration.
+    """
+    info_dir = os.path.join(cluster_info_dir(), label)
+    if not os.path.exists(info_dir):
+        os.makedirs(info_dir)
+    fd = os.open(os.path.join(info_dir, 'grow'), os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0600)
+    with os.fdopen(fd, 'w') as grow:
+        json.dump(grow_info, grow)
+
+
+def cluster_grow_info(label):
+    """Return the rendezvous info for 'hod grow' for cluster with specified label."""
+    with open(_cluster_info(label, 'grow')) as grow:
+        return json.load(grow)
+
+
+def rm_grow_info(label):
+    """Remove the rendezvous info for 'hod grow' for cluster with specified label, if there is any."""
+    path = os.path.join(cluster_info_dir(), label, 'grow')
+    if os.path.exists(path):
+        os.remove(path)
+
+
 def clean_cluster_info(master, cluster_info):
     """
     Remove all the cluster directories for the labels with jobids using the
@@ -33,20 +33,44 @@ TODO: acutally use vsc.utils.run here
 @author: Jens Timmerman, Stijn De Weirdt
 """
 from subprocess import Popen, PIPE
+import ctypes
+import ctypes.util
 import datetime
+import errno
 import os
 import pty
+import select
 import signal
+import threading
 import time
 
 from vsc.utils import fancylogger
 
+from hod.commands.usage import returncode, rusage_fields
+from hod.node.affinity import pinned_command
+from hod.spawn import SpawnError, SpawnedProcess, spawn_client
+
 
 COMMAND_TIMEOUT = 120  # timeout in seconds
 NO_TIMEOUT = None # No timeout
 
-TIMEOUT_POLL_TIME = 1
-NO_TIMEOUT_POLL_TIME = 10
+KILL_DELAY = 1  # seconds between SIGTERM and SIGKILL for a command that timed out
+EXIT_DRAIN_TIME = 1  # max seconds to read output that is left after the command exited
+READ_SIZE = 65536
+OUTPUT_TAIL = 4096  # bytes of output that are kept in memory for streams that are written to a file
+
+OUTPUT_MAX_BYTES = 10 * 1024 * 1024  # size at which an output file is rotated
+OUTPUT_BACKUPS = 5  # number of rotated output files that are kept
+
+# held while a command is reaped or signalled, so a reaped pid is never signalled
+_REAP_LOCK = threading.Lock()
+
+# waitid(2), to wait for a command to exit without reaping it (os.waitid is python 3 only)
+_LIBC = ctypes.CDLL(ctypes.util.find_library('c') or 'libc.so.6', use_errno=True)
+_P_PID = 1
+_WEXITED = 4
+_WNOWAIT = 0x01000000
+_SIGINFO_SIZE = 128
 
 
 class Command(object):
@@ -55,15 +79,26 @@ class Command(object):
     this will have to be extended
     '''
 
-    def __init__(self, command=None, timeout=COMMAND_TIMEOUT, env=None):
+    def __init__(self, command=None, timeout=COMMAND_TIMEOUT, env=None, stdout=None, stderr=None, cpus=None):
         '''
         Constructor
         command is a string representing the command to be run
+        stdout and stderr are optional file-like objects the output is written to as it arrives;
+        only the last OUTPUT_TAIL bytes of those streams are returned by run()
+        cpus is an optional list of cpus the command (and everything it starts) is pinned to
         '''
         self.log = fancylogger.getLogger(self.__class__.__name__, fname=False)
         self.command = command
         self.timeout = timeout
         self.env = env
+        self.stdout = stdout
+        self.stderr = stderr
+        self.cpus = cpus
+
+        self._proc = None
+        self._terminated = False
+        # wall time, exit status and resource usage of the last run, see hod.commands.usage
+        self.usage = None
 
         self.fake_pty = False
 
@@ -92,6 +127,9 @@ class Command(object):
         if self.command is None:
             self.log.error("No command set")
             return
+        if self._terminated:
+            self.log.warning("Cmd %s was terminated before it started", self.command)
+            return '', 'Terminated before it started\n'
 
         self.log.debug("Run going to run %s", self.command)
         start = datetime.datetime.now()
@@ -118,38 +156,38 @@ class Command(object):
         if self.env is not None:
             popen_kwargs['env'] = self.env
 
-        popen_kwargs.update(stdouterr)
-        # TODO: (high) buffer overflow here sometimes, check what happens and fix
-        # see easybuild/buildsoft/async
-        p = Popen(self.__str__(), **popen_kwargs)
-        time.sleep(.1)  # for immediate answers
-        timedout = False
-        while p.poll() is None:
-            if os.path.exists("/proc/%s" % (p.pid)):
-                if self.timeout == NO_TIMEOUT:
-                    self.log.debug("There is no timeout for cmd %s and it is still running" % self.command)
-                    time.sleep(NO_TIMEOUT_POLL_TIME)
-                    continue
-                else:
-                    now = datetime.datetime.now()
-                    if (now - start).seconds > self.timeout:
-                        if timedout is False:
-                            os.kill(p.pid, signal.SIGTERM)
-                            self.log.debug("Timeout occured with cmd %s. took more than %i secs to complete.",
-                                    self.command, self.timeout)
-                            timedout = True
-                        else:
-                            os.kill(p.pid, signal.SIGKILL)
-            time.sleep(TIMEOUT_POLL_TIME)
+        args = self.__str__()
+        if self.cpus:
+            self.log.debug("Pinning cmd %s to cpus %s", self.command, self.cpus)
+            # not with a preexec_fn, which is not safe while the executor threads run
+            args = pinned_command(args, self.cpus)
+            popen_kwargs['shell'] = False
 
+        popen_kwargs.update(stdouterr)
+        p = None
+        client = spawn_client()
+        if client is not None and not self.fake_pty:
+            try:
+                p = client.spawn(self.__str__(), env=self.env, cpus=self.cpus)
+            except SpawnError, err:
+                self.log.warning("Spawn helper failed to start cmd %s, starting it directly: %s", self.command, err)
+        if p is None:
+            p = Popen(args, **popen_kwargs)
+        self._proc = p
+        if self._terminated:
+            _kill(p, signal.SIGTERM)
+        usage = dict()
+        out, err = self._communicate(p, usage)
+        wall = datetime.datetime.now() - start
+        usage.update(wall=wall.seconds + wall.days * 86400 + wall.microseconds * 1e-6, returncode=p.returncode)
+        self.usage = usage
+        self.log.debug("cmd %s took %.2fs (user %.2fs, sys %.2fs, max rss %s KB)", self.command, usage['wall'],
+                       usage.get('utime', 0), usage.get('stime', 0), usage.get('maxrss', '-'))
         if self.fake_pty:
             # # no stdout/stderr
             self.log.debug("No stdout/stderr in fake pty mode")
             out = 'Fake PTY no out (this is ok)'
             err = 'Fake PTY no err (this is ok)'
-        else:
-            out = p.stdout.read().strip()
-            err = p.stderr.read().strip()
 
         ec = p.returncode
         if not ec == 0:
@@ -159,6 +197,220 @@ class Command(object):
             self.log.debug("cmd ok %s: out %s err %s", self.command, out, err)
         return out, err
 
+    def terminate(self):
+        """Send SIGTERM to the command if it is running; a command that did not start yet won't run"""
+        self._terminated = True
+        if self._proc is not None and self._proc.returncode is None:
+            self.log.debug("Terminating cmd %s", self.command)
+            _kill(self._proc, signal.SIGTERM)
+
+    def _communicate(self, p, usage):
+        """
+        Wait for p to exit while reading its stdout and stderr as output arrives, so a chatty
+        command can't block on a full pipe. Sends SIGTERM when the timeout expires and SIGKILL
+        KILL_DELAY seconds later. Returns the output as an (out, err) tuple; the resource usage
+        of the command is added to usage.
+
+        A thread reaps the process and wakes up the loop through a pipe, so it returns as soon
+        as the command exits, also when a daemon it started keeps its stdout or stderr open.
+        """
+        exit_r, exit_w = os.pipe()
+        reaper = threading.Thread(target=_reap, args=(p, exit_w, usage), name='reap-%s' % p.pid)
+        reaper.daemon = True
+        reaper.start()
+
+        out, err = _Output(self.stdout), _Output(self.stderr)
+        readers = [exit_r]
+        output = dict()
+        if not self.fake_pty:
+            output = dict([(p.stdout.fileno(), out), (p.stderr.fileno(), err)])
+            readers.extend(output.keys())
+
+        deadline = None
+        if self.timeout != NO_TIMEOUT:
+            deadline = time.time() + self.timeout
+        timedout = False
+        exited_at = None
+        try:
+            while readers:
+                if exited_at is not None:
+                    # only read what is left in the pipes
+                    if time.time() - exited_at > EXIT_DRAIN_TIME:
+                        break
+                    wait = 0
+                elif deadline is None:
+                    wait = None
+                else:
+                    wait = max(0, deadline - time.time())
+
+                try:
+                    ready = select.select(readers, [], [], wait)[0]
+                except select.error, error:
+                    if error.args[0] == errno.EINTR:
+                        continue
+                    raise
+
+                if not ready:
+                    if exited_at is not None:
+                        break
+                    if not timedout:
+                        self.log.debug("Timeout occured with cmd %s. took more than %i secs to complete.",
+                                       self.command, self.timeout)
+                        _kill(p, signal.SIGTERM)
+                        timedout = True
+                        deadline = time.time() + KILL_DELAY
+                    else:
+                        _kill(p, signal.SIGKILL)
+                        deadline = None
+
+                for fd in ready:
+                    if fd == exit_r:
+                        exited_at = time.time()
+                        readers.remove(exit_r)
+                        continue
+                    data = os.read(fd, READ_SIZE)
+                    if data:
+                        output[fd].write(data)
+                    else:
+                        readers.remove(fd)
+            # the command exited, so the reaper is done right away
+            reaper.join()
+        finally:
+            # the reaper closes exit_w
+            os.close(exit_r)
+            for pipe in (p.stdout, p.stderr):
+                if pipe is not None:
+                    pipe.close()
+
+        return out.getvalue().strip(), err.getvalue().strip()
+
+
+class _Output(object):
+    """Output of a command: all of it, or only a tail if it is written to sink as well"""
+    def __init__(self, sink=None):
+        self.sink = sink
+        self.chunks = []
+        self.tail = ''
+
+    def write(self, data):
+        if self.sink is None:
+            self.chunks.append(data)
+        else:
+            self.sink.write(data)
+            self.tail = (self.tail + data)[-OUTPUT_TAIL:]
+
+    def getvalue(self):
+        if self.sink is None:
+            return ''.join(self.chunks)
+        return self.tail
+
+
+class RotatingFile(object):
+    """
+    Append-only file that is rotated to <path>.1, <path>.2, ... when it grows beyond max_bytes;
+    at most backups rotated files are kept.
+    """
+    def __init__(self, path, max_bytes=OUTPUT_MAX_BYTES, backups=OUTPUT_BACKUPS):
+        self.path = path
+        self.max_bytes = max_bytes
+        self.backups = backups
+        dirname = os.path.dirname(path)
+        if dirname and not os.path.isdir(dirname):
+            try:
+                os.makedirs(dirname)
+            except OSError, err:
+                if err.errno != errno.EEXIST:
+                    raise
+        self._fh = open(path, 'a')
+        self._size = os.path.getsize(path)
+
+    def write(self, data):
+        """Write data, rotating the file first if it would grow beyond max_bytes"""
+        if self._size and self._size + len(data) > self.max_bytes:
+            self.rotate()
+        self._fh.write(data)
+        self._fh.flush()
+        self._size += len(data)
+
+    def rotate(self):
+        """Move the file to <path>.1 (and <path>.1 to <path>.2, ...) and start a new one"""
+        self._fh.close()
+        for idx in range(self.backups - 1, 0, -1):
+            src = '%s.%d' % (self.path, idx)
+            if os.path.exists(src):
+                os.rename(src, '%s.%d' % (self.path, idx + 1))
+        if self.backups > 0:
+            os.rename(self.path, '%s.1' % self.path)
+        else:
+            os.remove(self.path)
+        self._fh = open(self.path, 'a')
+        self._size = 0
+
+    def close(self):
+        self._fh.close()
+
+
+def _wait(p):
+    """Wait for p to exit; returns its resource usage (see hod.commands.usage.rusage_fields)"""
+    if isinstance(p, SpawnedProcess):
+        p.wait()
+        return p.usage
+    try:
+        _wait_exited(p.pid)
+        # the pid may be reused once p is reaped, so it is reaped and marked as such at once (see _kill);
+        # p exited already, so this does not block
+        _REAP_LOCK.acquire()
+        try:
+            _, status, rusage = os.wait4(p.pid, 0)
+            p.returncode = returncode(status)
+        finally:
+            _REAP_LOCK.release()
+    except OSError, err:
+        if err.errno == errno.ECHILD:
+            # reaped by Popen already
+            p.wait()
+            return dict()
+        raise
+    return rusage_fields(rusage)
+
+
+def _wait_exited(pid):
+    """Wait for the child process pid to exit, without reaping it"""
+    siginfo = ctypes.create_string_buffer(_SIGINFO_SIZE)
+    while _LIBC.waitid(_P_PID, pid, siginfo, _WEXITED | _WNOWAIT) != 0:
+        err = ctypes.get_errno()
+        if err != errno.EINTR:
+            raise OSError(err, os.strerror(err))
+
+
+def _reap(p, exit_fd, usage):
+    """Wait for p to exit, add its resource usage to usage and signal the exit on exit_fd"""
+    try:
+        usage.update(_wait(p))
+        os.write(exit_fd, 'x')
+    except OSError:
+        # nobody is waiting for the command anymore
+        pass
+    finally:
+        os.close(exit_fd)
+
+
+def _kill(p, signum):
+    """
+    Send signum to p, unless it exited already. Once p is reaped (its returncode is set),
+    its pid may belong to another process, so it is not signalled anymore.
+    """
+    _REAP_LOCK.acquire()
+    try:
+        if p.returncode is not None:
+            return
+        os.kill(p.pid, signum)
+    except OSError, err:
+        if err.errno != errno.ESRCH:
+            raise
+    finally:
+        _REAP_LOCK.release()
+
 
 class GenerateSshKey(Command):
     """Create a public/private key pair"""
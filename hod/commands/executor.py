@@ -0,0 +1,283 @@
+# #
+# Copyright 2009-2015 Ghent University
+#
+# This file is part of hanythingondemand
+# originally created by the HPC team of Ghent University (http://ugent.be/hpc/en),
+# with support of Ghent University (http://ugent.be/hpc),
+# the Flemish Supercomputer Centre (VSC) (https://vscentrum.be/nl/en),
+# the Hercules foundation (http://www.herculesstichting.be/in_English)
+# and the Department of Economy, Science and Innovation (EWI) (http://www.ewi-vlaanderen.be/en).
+#
+# http://github.com/hpcugent/hanythingondemand
+#
+# hanythingondemand is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation v2.
+#
+# hanythingondemand is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with hanythingondemand. If not, see <http://www.gnu.org/licenses/>.
+# #
+"""
+Run commands (or any callables) concurrently on a bounded number of worker threads.
+
+Python 2 has no concurrent.futures, so this is a small executor in the same spirit:
+submit returns a CommandFuture that can be waited for and cancelled; cancelling a
+running Command terminates its process. A call that runs Commands itself can attach them
+to its future with attach_command, so cancelling the call terminates those as well.
+"""
+import Queue
+import sys
+import threading
+import time
+from collections import namedtuple
+
+from vsc.utils import fancylogger
+
+_log = fancylogger.getLogger(fname=False)
+
+MAX_WORKERS = 16
+# seconds between checks while waiting, so signal handlers run in the waiting thread
+WAIT_INTERVAL = 0.1
+
+PENDING = 'pending'
+RUNNING = 'running'
+DONE = 'done'
+CANCELLED = 'cancelled'
+
+# the future of the call that runs on the current worker thread
+_current = threading.local()
+
+# result of a command run with CommandExecutor.run_commands; output is (out, err) or None
+CommandResult = namedtuple('CommandResult', ['command', 'output', 'error', 'cancelled'])
+
+
+class CancelledError(Exception):
+    """The call was cancelled before it finished"""
+    pass
+
+
+class TimeoutError(Exception):
+    """The call did not finish in time"""
+    pass
+
+
+class CommandFuture(object):
+    """Result of a call submitted to a CommandExecutor"""
+    def __init__(self, fn, args, kwargs, command=None):
+        self.fn = fn
+        self.args = args
+        self.kwargs = kwargs
+        self.command = command
+        self.state = PENDING
+        self._cancelled = False
+        self._result = None
+        self._exc_info = None
+        self._lock = threading.Lock()
+        self._done = threading.Event()
+
+    def done(self):
+        """True if the call finished or was cancelled"""
+        return self._done.is_set()
+
+    def cancelled(self):
+        return self._cancelled
+
+    def cancel(self):
+        """
+        Cancel the call: a pending call will not run; of a running call, the Command it runs is
+        terminated, also if it is only attached later (see attach_command).
+        Returns False if the call can't be cancelled (anymore).
+        """
+        with self._lock:
+            if self.state == PENDING:
+                self._cancelled = True
+                self.state = CANCELLED
+                self._done.set()
+                return True
+            if self.state != RUNNING:
+                return self._cancelled
+            self._cancelled = True
+            command = self.command
+        if command is not None:
+            command.terminate()
+        return True
+
+    def attach(self, command):
+        """Attach the Command the call runs now, so cancelling the call terminates it"""
+        with self._lock:
+            self.command = command
+            cancelled = self._cancelled
+        if cancelled:
+            command.terminate()
+
+    def wait(self, timeout=None):
+        """Wait at most timeout seconds (forever if None) for the call to finish; returns done()"""
+        deadline = None
+        if timeout is not None:
+            deadline = time.time() + timeout
+        while not self._done.is_set():
+            wait = WAIT_INTERVAL
+            if deadline is not None:
+                wait = min(wait, deadline - time.time())
+                if wait <= 0:
+                    break
+            self._done.wait(wait)
+        return self.done()
+
+    def result(self, timeout=None):
+        """Return the result of the call, or raise the exception it raised"""
+        if not self.wait(timeout):
+            raise TimeoutError("%s did not finish within %s seconds" % (self, timeout))
+        if self._cancelled:
+            raise CancelledError("%s was cancelled" % self)
+        if self._exc_info is not None:
+            raise self._exc_info[0], self._exc_info[1], self._exc_info[2]
+        return self._result
+
+    def exception(self, timeout=None):
+        """Return the exception raised by the call, or None"""
+        if not self.wait(timeout):
+            raise TimeoutError("%s did not finish within %s seconds" % (self, timeout))
+        if self._cancelled:
+            return CancelledError("%s was cancelled" % self)
+        if self._exc_info is not None:
+            return self._exc_info[1]
+        return None
+
+    def _run(self):
+        with self._lock:
+            if self.state != PENDING:
+                return
+            self.state = RUNNING
+        _current.future = self
+        try:
+            self._result = self.fn(*self.args, **self.kwargs)
+        except Exception:
+            self._exc_info = sys.exc_info()
+        finally:
+            _current.future = None
+        with self._lock:
+            if self._cancelled:
+                self.state = CANCELLED
+            else:
+                self.state = DONE
+        self._done.set()
+
+    def __str__(self):
+        if self.command is not None:
+            return "Command '%s'" % self.command
+        return getattr(self.fn, '__name__', str(self.fn))
+
+
+def attach_command(command):
+    """
+    Attach command to the future of the call that runs on this worker thread, so cancelling the call
+    terminates it; does nothing outside of a worker thread.
+    """
+    future = getattr(_current, 'future', None)
+    if future is not None:
+        future.attach(command)
+
+
+def wait(futures, timeout=None):
+    """Wait at most timeout seconds for all futures; returns the lists of done and not done futures"""
+    deadline = None
+    if timeout is not None:
+        deadline = time.time() + timeout
+    for future in futures:
+        if deadline is None:
+            future.wait()
+        else:
+            future.wait(max(0, deadline - time.time()))
+    done = [future for future in futures if future.done()]
+    return done, [future for future in futures if not future.done()]
+
+
+class CommandExecutor(object):
+    """
+    Run submitted calls on at most max_workers threads. The worker threads are daemon threads,
+    so a call that hangs does not keep the process alive.
+    """
+    def __init__(self, max_workers=MAX_WORKERS, name='executor'):
+        if max_workers < 1:
+            raise ValueError("max_workers should be at least 1, got %s" % max_workers)
+        self.max_workers = max_workers
+        self.name = name
+        self._queue = Queue.Queue()
+        self._workers = []
+        self._idle = 0
+        self._lock = threading.Lock()
+        self._shutdown = False
+
+    def submit(self, fn, *args, **kwargs):
+        """Run fn(*args, **kwargs) on a worker thread; returns a CommandFuture"""
+        return self._submit(CommandFuture(fn, args, kwargs))
+
+    def submit_command(self, command):
+        """Run a Command on a worker thread; the future returns its (out, err)"""
+        return self._submit(CommandFuture(command.run, (), {}, command=command))
+
+    def run_commands(self, commands, timeout=None):
+        """
+        Run the commands concurrently (each with its own timeout) and wait at most timeout seconds
+        for all of them; commands still running then are cancelled. Returns a CommandResult per command.
+        """
+        futures = [self.submit_command(command) for command in commands]
+        _, not_done = wait(futures, timeout)
+        for future in not_done:
+            future.cancel()
+        results = []
+        for command, future in zip(commands, futures):
+            if future.cancelled() or not future.done():
+                results.append(CommandResult(command, None, None, True))
+            else:
+                results.append(CommandResult(command, future._result, future.exception(), False))
+        return results
+
+    def shutdown(self, wait_for_calls=True):
+        """Stop accepting calls; cancel the pending ones unless wait_for_calls"""
+        with self._lock:
+            self._shutdown = True
+            workers = list(self._workers)
+        if not wait_for_calls:
+            while True:
+                try:
+                    future = self._queue.get_nowait()
+                except Queue.Empty:
+                    break
+                if future is not None:
+                    future.cancel()
+        for _ in workers:
+            self._queue.put(None)
+        if wait_for_calls:
+            for worker in workers:
+                while worker.is_alive():
+                    worker.join(WAIT_INTERVAL)
+
+    def _submit(self, future):
+        with self._lock:
+            if self._shutdown:
+                raise RuntimeError("Can't submit %s to %s after shutdown" % (future, self.name))
+            self._queue.put(future)
+            if self._queue.qsize() > self._idle and len(self._workers) < self.max_workers:
+                worker = threading.Thread(target=self._work, name='%s-%d' % (self.name, len(self._workers)))
+                worker.daemon = True
+                self._workers.append(worker)
+                worker.start()
+        return future
+
+    def _work(self):
+        while True:
+            with self._lock:
+                self._idle += 1
+            future = self._queue.get()
+            with self._lock:
+                self._idle -= 1
+            if future is None:
+                return
+            future._run()
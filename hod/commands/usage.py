@@ -0,0 +1,123 @@
+# #
+# Copyright 2009-2015 Ghent University
+#
+# This file is part of hanythingondemand
+# originally created by the HPC team of Ghent University (http://ugent.be/hpc/en),
+# with support of Ghent University (http://ugent.be/hpc),
+# the Flemish Supercomputer Centre (VSC) (https://vscentrum.be/nl/en),
+# the Hercules foundation (http://www.herculesstichting.be/in_English)
+# and the Department of Economy, Science and Innovation (EWI) (http://www.ewi-vlaanderen.be/en).
+#
+# http://github.com/hpcugent/hanythingondemand
+#
+# hanythingondemand is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation v2.
+#
+# hanythingondemand is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with hanythingondemand. If not, see <http://www.gnu.org/licenses/>.
+# #
+"""
+Resource usage of the commands run by the services: wall time and the getrusage data of
+wait4 (CPU time, max RSS, I/O blocks), recorded per command in the localworkdir of each rank
+and summed up per service by the master at the end of the job, from the files of all ranks.
+"""
+import json
+import os
+import threading
+
+# records of the commands run on a rank, one JSON object per line, in its localworkdir
+USAGE_FILENAME = 'command-usage.jsonl'
+# table of the slowest commands per service and rank, in the localworkdir of the master
+SUMMARY_FILENAME = 'command-usage.txt'
+
+RUSAGE_FIELDS = ['utime', 'stime', 'maxrss', 'inblock', 'oublock']
+
+_write_lock = threading.Lock()
+
+
+def returncode(status):
+    """Exit status as returned by os.waitpid, in the format of Popen.returncode"""
+    if os.WIFSIGNALED(status):
+        return -os.WTERMSIG(status)
+    return os.WEXITSTATUS(status)
+
+
+def rusage_fields(rusage):
+    """The fields of a resource.struct_rusage that are recorded (maxrss is in kilobytes on Linux)"""
+    if rusage is None:
+        return dict()
+    return dict([(field, getattr(rusage, 'ru_%s' % field)) for field in RUSAGE_FIELDS])
+
+
+def write_record(path, record):
+    """Append record (a dict) to the JSON lines file at path"""
+    line = json.dumps(record, sort_keys=True) + '\n'
+    with _write_lock:
+        fh = open(path, 'a')
+        try:
+            fh.write(line)
+        finally:
+            fh.close()
+
+
+def read_records(paths):
+    """
+    Read the records of the JSON lines files at paths; lines that can't be parsed, e.g. because
+    they are still being written, are skipped
+    """
+    records = []
+    for path in paths:
+        fh = open(path)
+        try:
+            for line in fh:
+                try:
+                    records.append(json.loads(line))
+                except ValueError:
+                    continue
+        finally:
+            fh.close()
+    return records
+
+
+def _fmt_row(row, widths):
+    return '  '.join([str(value).ljust(width) for value, width in zip(row, widths)]).rstrip()
+
+
+def summary_table(records, slowest=1):
+    """
+    Table (a list of lines) of the slowest commands of every service on every rank,
+    services with the slowest commands first. records are dicts as written by ConfiguredService.
+    """
+    by_service = dict()
+    for record in records:
+        by_service.setdefault(record['service'], dict()).setdefault(record['rank'], []).append(record)
+
+    header = ['service', 'rank', 'host', 'script', 'wall(s)', 'user(s)', 'sys(s)', 'maxrss(MB)', 'exit',
+              'commands', 'total(s)']
+    rows = []
+    services = sorted(by_service.items(),
+                      key=lambda item: max([rec['wall'] for recs in item[1].values() for rec in recs]),
+                      reverse=True)
+    for service, ranks in services:
+        for rank in sorted(ranks):
+            recs = sorted(ranks[rank], key=lambda rec: rec['wall'], reverse=True)
+            total = sum([rec['wall'] for rec in recs])
+            for idx, rec in enumerate(recs[:slowest]):
+                maxrss = rec.get('maxrss')
+                if maxrss is not None:
+                    maxrss = '%.1f' % (maxrss / 1024.0)
+                row = [service, rank, rec.get('host', ''), rec['script'], '%.2f' % rec['wall'],
+                       '%.2f' % rec.get('utime', 0), '%.2f' % rec.get('stime', 0), maxrss or '-',
+                       rec.get('returncode', '-')]
+                if idx == 0:
+                    row.extend([len(recs), '%.2f' % total])
+                rows.append(row)
+
+    widths = [max([len(str(row[col])) for row in [header] + rows if col < len(row)]) for col in range(len(header))]
+    return [_fmt_row(header, widths)] + [_fmt_row(row, widths) for row in rows]
@@ -35,6 +35,8 @@ import os
 import re
 import math
 
+from hod.node.numa import numa_nodes_in_use
+
 def parse_memory(memstr):
     '''
     Given a string representation of memory, return the memory size in
@@ -126,34 +128,69 @@ def reserved_memory(totalmem):
 
 def available_memory(node):
     '''
-    Return the amount of memory available in bytes. There are three things we
-    consider: 
+    Return the amount of memory available in bytes. There are four things we
+    consider:
     1. If we are using all the cores, we assume we can use all the
     memory in the machine (minus what the OS needs).
 
-    2. If ulimit is set and less than meminfo, we use it.
+    2. If we are not using all the cores, we use the amount of memory based
+    on total machine memory scaled by usablecpus/totalcpus. The number of
+    usable cores already takes the cpuset, the cgroup cpu quota and
+    $PBS_NUM_PPN into account.
+
+    3. If the memory cgroup of the job has a limit, we treat it like the
+    memory of a (smaller) machine: what the OS needs is reserved from it.
 
-    3. If ulimit for vmem is not set (unlimited) then we use the amount of
-    available memory according based on total machine memory scaled by
-    usablecpus/totalcpus
+    4. If ulimit is set, we never go over it.
 
-    TODO: Take a look at supporting cgroups and parsing PBS environment
-    variables.
+    The tightest of these limits is used.
     '''
     meminfo = node['memory']['meminfo']['memtotal']
     memory = meminfo - reserved_memory(meminfo)
-    # If we have the whole box, let's use all the non OS memory
-    if node['cores'] == node['totalcores']:
-        return memory
+    # If we don't have the whole box, only use our share of the non OS memory
+    if node['cores'] != node['totalcores']:
+        pct_cores = float(node['cores']) / node['totalcores']
+        memory = int(memory * pct_cores)
 
-    pct_cores = float(node['cores']) / node['totalcores']
+    cgroup = node['memory'].get('cgroup', 'unlimited')
+    if cgroup != 'unlimited':
+        cgroup = int(cgroup)
+        # keep at least half of a small cgroup for the services
+        memory = min(memory, max(cgroup - reserved_memory(cgroup), cgroup // 2))
 
-    memory = int(memory * pct_cores)
     ulimit = node['memory']['ulimit']
-    if ulimit == 'unlimited':
-        return int(memory)
-    else:
-        return min(int(memory), int(ulimit))
+    if ulimit != 'unlimited':
+        memory = min(memory, int(ulimit))
+    return int(memory)
+
+def numa_nodes(node):
+    '''
+    Return the number of NUMA nodes that the usable cores of the node are
+    spread over (at least 1).
+    '''
+    topology = [numa_node for numa_node in node.get('topology', []) if isinstance(numa_node, dict)]
+    return max(1, len(numa_nodes_in_use(topology, node.get('usablecores', []))))
+
+def round_to_numa_nodes(count, node):
+    '''
+    Round count down to a multiple of the number of NUMA nodes in use, so
+    containers can be spread evenly over the sockets and do not need to
+    span them. Counts smaller than the number of NUMA nodes are kept.
+    '''
+    nnodes = numa_nodes(node)
+    if count < nnodes:
+        return count
+    return count - count % nnodes
+
+def cluster_nodes(node):
+    '''
+    Return the summaries of all nodes in the job (see hod.node.node.cluster_info),
+    or just the node itself if the cluster is not known.
+    '''
+    cluster = node.get('cluster')
+    if cluster and cluster.get('members'):
+        return cluster['members']
+    return [node]
 
 def format_memory(mem, round_val=False):
     '''
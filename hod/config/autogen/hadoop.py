@@ -34,7 +34,7 @@ http://docs.hortonworks.com/HDPDocuments/HDP2/HDP-2.0.6.0/bk_installing_manually
 
 from collections import namedtuple
 from hod.config.autogen.common import (blocksize,
-        available_memory, parse_memory, format_memory, round_mb)
+        available_memory, cluster_nodes, parse_memory, format_memory, round_mb, round_to_numa_nodes)
 
 __all__ = ['autogen_config']
 
@@ -62,12 +62,14 @@ def min_container_size(totalmem):
 
 def memory_defaults(node_info):
     '''
-    Return default memory information.
+    Return default memory information, based on the usable cores and the
+    tightest memory limit of the node (see available_memory). The number of
+    containers is a multiple of the number of NUMA nodes in use.
     '''
     ncores = node_info['cores']
     hadoop_memory = available_memory(node_info)
     min_container_sz = min_container_size(hadoop_memory)
-    num_containers = min(2*ncores, hadoop_memory/min_container_sz)
+    num_containers = round_to_numa_nodes(min(2*ncores, hadoop_memory/min_container_sz), node_info)
     ram_per_container = max(min_container_sz, hadoop_memory/num_containers)
     return MemDefaults(
             hadoop_memory,
@@ -93,18 +95,26 @@ def core_site_xml_defaults(workdir, node_info):
     }
     return dflts
 
+def cluster_memory_defaults(node_info):
+    '''
+    Return the default memory information (see memory_defaults) of every node
+    in the job (see cluster_nodes).
+    '''
+    return [memory_defaults(node) for node in cluster_nodes(node_info)]
+
 def mapred_site_xml_defaults(workdir, node_info):
     '''
-    Default entries for the mapred-site.xml config file.
+    Default entries for the mapred-site.xml config file. The containers of
+    the tasks are sized to the smallest node, so they fit on all of them.
     '''
-    mem_dflts = memory_defaults(node_info)
+    ram_per_container = min([dflts.ram_per_container for dflts in cluster_memory_defaults(node_info)])
 
-    java_map_mem = format_memory(0.8 * mem_dflts.ram_per_container, round_val=True)
-    java_reduce_mem = format_memory(0.8 * 2 * mem_dflts.ram_per_container, round_val=True)
+    java_map_mem = format_memory(0.8 * ram_per_container, round_val=True)
+    java_reduce_mem = format_memory(0.8 * 2 * ram_per_container, round_val=True)
     # In my tests, Yarn gets shirty if I try to run a job and these values are set to
     # more then 8g:
-    map_memory = round_mb(mem_dflts.ram_per_container)
-    reduce_memory = round_mb(2 * mem_dflts.ram_per_container)
+    map_memory = round_mb(ram_per_container)
+    reduce_memory = round_mb(2 * ram_per_container)
     dflts = {
         'mapreduce.framework.name': 'yarn',
         'mapreduce.map.java.opts': '-Xmx%s' % java_map_mem,
@@ -117,19 +127,36 @@ def mapred_site_xml_defaults(workdir, node_info):
     }
     return dflts
 
+def container_vcores(node_info):
+    '''
+    Return the number of cores left for the YARN containers: the usable cores
+    minus those reserved for pinned daemons (CPUAffinity= or ReservedCores=).
+    '''
+    return max(1, node_info['cores'] - len(node_info.get('reservedcores', [])))
+
 def yarn_site_xml_defaults(workdir, node_info):
     '''
-    Default entries for the yarn-site.xml config file.
+    Default entries for the yarn-site.xml config file. The resources of the
+    nodemanager are those of this node; the scheduler limits are based on all
+    nodes in the job, so the largest container fits on the largest node and
+    the smallest one on every node.
     '''
     mem_dflts = memory_defaults(node_info)
-
-    max_alloc = round_mb(mem_dflts.ram_per_container * mem_dflts.num_containers)
-    min_alloc = round_mb(mem_dflts.ram_per_container)
+    cluster_dflts = cluster_memory_defaults(node_info)
+
+    node_alloc = round_mb(mem_dflts.ram_per_container * mem_dflts.num_containers)
+    max_alloc = max([round_mb(dflts.ram_per_container * dflts.num_containers) for dflts in cluster_dflts])
+    min_alloc = min([round_mb(dflts.ram_per_container) for dflts in cluster_dflts])
+    # the same services, so the same number of reserved cores, run on every slave
+    reserved = node_info.get('reservedcores', [])
+    max_vcores = max([container_vcores(dict(node, reservedcores=reserved)) for node in cluster_nodes(node_info)])
     dflts = {
         'yarn.nodemanager.aux-services': 'mapreduce_shuffle',
         'yarn.scheduler.maximum-allocation-mb': max_alloc,
         'yarn.scheduler.minimum-allocation-mb': min_alloc,
-        'yarn.nodemanager.resource.memory-mb': max_alloc,
+        'yarn.nodemanager.resource.memory-mb': node_alloc,
+        'yarn.nodemanager.resource.cpu-vcores': container_vcores(node_info),
+        'yarn.scheduler.maximum-allocation-vcores': max_vcores,
         'yarn.nodemanager.vmem-check-enabled':'false',
         'yarn.nodemanager.vmem-pmem-ratio': 2.1,
         'yarn.nodemanager.hostname': '$dataname',
@@ -28,7 +28,7 @@
 
 from collections import namedtuple
 from hod.config.autogen.common import (blocksize,
-        available_memory, parse_memory, format_memory, round_mb)
+        available_memory, parse_memory, format_memory, round_mb, round_to_numa_nodes)
 
 __all__ = ['autogen_config']
 
@@ -56,12 +56,14 @@ def min_container_size(totalmem):
 
 def memory_defaults(node_info):
     '''
-    Return default memory information.
+    Return default memory information, based on the usable cores and the
+    tightest memory limit of the node (see available_memory). The number of
+    containers is a multiple of the number of NUMA nodes in use.
     '''
     ncores = node_info['cores']
     hadoop_memory = available_memory(node_info)
     min_container_sz = min_container_size(hadoop_memory)
-    num_containers = min(2*ncores, hadoop_memory/min_container_sz)
+    num_containers = round_to_numa_nodes(min(2*ncores, hadoop_memory/min_container_sz), node_info)
     ram_per_container = max(min_container_sz, hadoop_memory/num_containers)
     return MemDefaults(
             hadoop_memory,
@@ -35,9 +35,12 @@ from os.path import join as mkpath, dirname, realpath
 from pkg_resources import Requirement, resource_filename, resource_listdir
 
 import hod
-from hod.node.node import Node
+from hod.node.affinity import parse_cpu_affinity, reserve_cores
+from hod.node.node import node_inventory
 from hod.commands.command import COMMAND_TIMEOUT
 import hod.config.template as hct
+from hod.work.probe import parse_probe
+from hod.timeline import timed
 
 
 from vsc.utils import fancylogger
@@ -58,6 +61,18 @@ RUNS_ON_ALL = RUNS_ON_MASTER | RUNS_ON_SLAVE
 
 HOD_ETC_DIR = os.path.join('etc', 'hod')
 
+# how long to wait for the ReadyCheck of a service to succeed, in seconds
+READY_TIMEOUT = 300
+
+# Restart= policies of a service
+RESTART_NO = 'no'
+RESTART_ON_FAILURE = 'on-failure'
+RESTART_POLICIES = [RESTART_NO, RESTART_ON_FAILURE]
+# how many times a service is restarted at most (per node), unless RestartLimit is set
+RESTART_LIMIT = 3
+# seconds between two LivenessChecks of a service
+LIVENESS_INTERVAL = 5
+
 
 def load_service_config(fileobj):
     '''
@@ -120,6 +135,71 @@ def _cfgget(config, section, item, dflt=None, **kwargs):
         return dflt
 
 
+def _cfgget_unit_list(config, section, item):
+    '''
+    Get a list of unit names separated by spaces and/or commas from a
+    ConfigParser object. Returns None if the option is not set at all, as
+    opposed to an empty list if it is set to an empty value.
+    '''
+    try:
+        return config.get(section, item).replace(',', ' ').split()
+    except (NoSectionError, NoOptionError):
+        return None
+
+
+def _parse_cpu_pinning(config, name):
+    '''
+    Get the CPUAffinity= (as a list of cpus, or None) and ReservedCores= (as a
+    number of cores) of a service from a ConfigParser object.
+    '''
+    cpu_affinity = _cfgget(config, _SERVICE_SECTION, 'CPUAffinity', '')
+    reserved_cores = int(_cfgget(config, _SERVICE_SECTION, 'ReservedCores', '0'))
+    if reserved_cores < 0:
+        raise ValueError("Invalid ReservedCores=%s for service %s" % (reserved_cores, name))
+    if not cpu_affinity:
+        return None, reserved_cores
+    if reserved_cores:
+        raise ValueError("Service %s can not have both CPUAffinity and ReservedCores" % name)
+    try:
+        return parse_cpu_affinity(cpu_affinity), 0
+    except ValueError:
+        raise ValueError("Invalid CPUAffinity=%s for service %s" % (cpu_affinity, name))
+
+
+def slave_cpu_pinning(service_files):
+    '''
+    Return the CPUAffinity= and ReservedCores= of the services in service_files
+    which run on slaves, as a list of (cpu_affinity, reserved_cores) tuples
+    (see _parse_cpu_pinning).
+    '''
+    pinning = []
+    for service_file in service_files:
+        try:
+            config = load_service_config(open(service_file))
+        except IOError, err:
+            _log.debug('Failed to read service config %s: %s', service_file, err)
+            continue
+        name = _cfgget(config, _UNIT_SECTION, 'Name', service_file)
+        if _parse_runs_on(_cfgget(config, _UNIT_SECTION, 'RunsOn', 'all')) == RUNS_ON_MASTER:
+            continue
+        pinning.append(_parse_cpu_pinning(config, name))
+    return pinning
+
+
+def reserved_service_cores(cpu_pinning, usablecores):
+    '''
+    Return the sorted list of the usablecores that the services pin their
+    daemons to, given their cpu_pinning as returned by slave_cpu_pinning.
+    These cores are not available for YARN containers.
+    '''
+    reserved = set()
+    for cpu_affinity, reserved_cores in cpu_pinning:
+        if cpu_affinity is None:
+            cpu_affinity = reserve_cores(usablecores, reserved_cores)
+        reserved.update(cpu_affinity)
+    return sorted(reserved.intersection(usablecores))
+
+
 def parse_comma_delim_list(s):
     '''
     Convert a string containing a comma delimited list into a list of strings
@@ -139,10 +219,11 @@ class PreServiceConfigOpts(object):
     """
     __slots__ = ['version', 'workdir', 'config_writer', 'directories',
                  'autogen', 'modules', 'service_configs', 'service_files', 
-                 'master_env', '_hodconfdir'
+                 'master_env', 'data_interfaces', 'cpu_pinning', '_hodconfdir'
                 ]
 
-    OPTIONAL_FIELDS = ['master_env', 'modules', 'service_configs', 'directories', 'autogen']
+    OPTIONAL_FIELDS = ['master_env', 'modules', 'service_configs', 'directories', 'autogen', 'data_interfaces',
+                       'cpu_pinning']
 
     @staticmethod
     def from_file_list(filenames, **kwargs):
@@ -184,6 +265,11 @@ class PreServiceConfigOpts(object):
 
         self.service_configs = _collect_configs(_config)
         self.autogen = parse_comma_delim_list(_cfgget(_config, _CONFIG_SECTION, 'autogen', ''))
+        # device names (with wildcards) or networks to use for $dataname/$dataaddress, in order of preference
+        self.data_interfaces = _get_list('data_interfaces')
+        # CPUAffinity/ReservedCores of the services that run on slaves (see slave_cpu_pinning);
+        # filled in by the master, so the slaves don't have to parse the service files
+        self.cpu_pinning = None
 
     @property
     def localworkdir(self):
@@ -197,6 +283,7 @@ class PreServiceConfigOpts(object):
     def hodconfdir(self):
         return self._hodconfdir
 
+    @timed('autogen_configs')
     def autogen_configs(self):
         '''
         Lazily generate the missing configurations as a convenience to
@@ -206,8 +293,10 @@ class PreServiceConfigOpts(object):
         workdir is a directory on a file system that is not accessible from the
         login node then we can't process this information from the login node.
         '''
-        node = Node()
-        node_info = node.go()
+        node_info = node_inventory().node_info()
+        if self.cpu_pinning is None:
+            self.cpu_pinning = slave_cpu_pinning(self.service_files)
+        node_info['reservedcores'] = reserved_service_cores(self.cpu_pinning, node_info['usablecores'])
         _log.debug('Collected Node information: %s', node_info)
         for autocfg in self.autogen:
             fn = autogen_fn(autocfg)
@@ -220,10 +309,10 @@ class PreServiceConfigOpts(object):
     def __str__(self):
         return 'PreServiceConfigOpts(version=%s, workdir=%s, modules=%s, ' \
                 'master_env=%s, service_files=%s, directories=%s, ' \
-                'config_writer=%s, service_configs=%s)' % (self.version,
+                'config_writer=%s, service_configs=%s, data_interfaces=%s)' % (self.version,
                         self.workdir, self.modules, self.master_env,
                         self.service_files, self.directories,
-                        self.config_writer, self.service_configs)
+                        self.config_writer, self.service_configs, self.data_interfaces)
 
 
 def merge(lhs, rhs):
@@ -321,22 +410,50 @@ class ConfigOpts(object):
         start_script = _cfgget(config, _SERVICE_SECTION, 'ExecStart')
         stop_script = _cfgget(config, _SERVICE_SECTION, 'ExecStop')
         env = dict(config.items(_ENVIRONMENT_SECTION))
-
-        return ConfigOpts(name, runs_on, pre_start_script, start_script, stop_script, env, template_resolver)
+        after = _cfgget_unit_list(config, _UNIT_SECTION, 'After')
+        requires = _cfgget_unit_list(config, _UNIT_SECTION, 'Requires')
+        ready_check = _cfgget(config, _SERVICE_SECTION, 'ReadyCheck', '')
+        if ready_check:
+            parse_probe(ready_check)
+        ready_timeout = int(_cfgget(config, _SERVICE_SECTION, 'ReadyTimeout', str(READY_TIMEOUT)))
+        restart = _cfgget(config, _SERVICE_SECTION, 'Restart', RESTART_NO)
+        if restart not in RESTART_POLICIES:
+            raise ValueError("Invalid Restart=%s for service %s: should be one of %s" %
+                             (restart, name, ', '.join(RESTART_POLICIES)))
+        restart_limit = int(_cfgget(config, _SERVICE_SECTION, 'RestartLimit', str(RESTART_LIMIT)))
+        liveness_check = _cfgget(config, _SERVICE_SECTION, 'LivenessCheck', '')
+        if liveness_check:
+            parse_probe(liveness_check)
+        elif restart != RESTART_NO:
+            raise ValueError("Restart=%s for service %s needs a LivenessCheck" % (restart, name))
+        cpu_affinity, reserved_cores = _parse_cpu_pinning(config, name)
+
+        return ConfigOpts(name, runs_on, pre_start_script, start_script, stop_script, env, template_resolver,
+                          after=after, requires=requires, ready_check=ready_check, ready_timeout=ready_timeout,
+                          restart=restart, restart_limit=restart_limit, liveness_check=liveness_check,
+                          cpu_affinity=cpu_affinity, reserved_cores=reserved_cores)
 
     def to_params(self, workdir, modules, master_template_args):
         """Create a ConfigOptsParams object from the ConfigOpts instance"""
         return ConfigOptsParams(self.name, self._runs_on, self._pre_start_script, self._start_script,
-                                self._stop_script, self._env, workdir, modules, master_template_args, self.timeout)
+                                self._stop_script, self._env, workdir, modules, master_template_args, self.timeout,
+                                self.after, self.requires, self._ready_check, self.ready_timeout,
+                                self.restart, self.restart_limit, self._liveness_check, self.cpu_affinity,
+                                self.reserved_cores)
 
     @staticmethod
     def from_params(params, template_resolver):
         """Create a ConfigOpts instance from a ConfigOptsParams instance"""
         return ConfigOpts(params.name, params.runs_on, params.pre_start_script, params.start_script,
-                          params.stop_script, params.env, template_resolver, params.timeout)
+                          params.stop_script, params.env, template_resolver, params.timeout,
+                          params.after, params.requires, params.ready_check, params.ready_timeout,
+                          params.restart, params.restart_limit, params.liveness_check, params.cpu_affinity,
+                          params.reserved_cores)
 
     def __init__(self, name, runs_on, pre_start_script, start_script, stop_script, env, template_resolver, 
-                    timeout=COMMAND_TIMEOUT):
+                    timeout=COMMAND_TIMEOUT, after=None, requires=None, ready_check='', ready_timeout=READY_TIMEOUT,
+                    restart=RESTART_NO, restart_limit=RESTART_LIMIT, liveness_check='', cpu_affinity=None,
+                    reserved_cores=0):
         self.name = name
         self._runs_on = runs_on
         self._tr = template_resolver
@@ -345,6 +462,17 @@ class ConfigOpts(object):
         self._stop_script = stop_script
         self._env = env
         self.timeout = timeout
+        # None means no dependencies were declared; see service_start_phases
+        self.after = after
+        self.requires = requires
+        self._ready_check = ready_check
+        self.ready_timeout = ready_timeout
+        self.restart = restart
+        self.restart_limit = restart_limit
+        self._liveness_check = liveness_check
+        # list of cpus to pin ExecStart to, or the number of usable cores to reserve for it
+        self.cpu_affinity = cpu_affinity
+        self.reserved_cores = reserved_cores
 
     @property
     def pre_start_script(self):
@@ -358,6 +486,14 @@ class ConfigOpts(object):
     def stop_script(self):
         return self._tr(self._stop_script)
 
+    @property
+    def ready_check(self):
+        return self._tr(self._ready_check)
+
+    @property
+    def liveness_check(self):
+        return self._tr(self._liveness_check)
+
     @property
     def workdir(self):
         return self._tr.workdir
@@ -416,8 +552,77 @@ ConfigOptsParams = namedtuple('ConfigOptsParams', [
     'modules',
     'master_template_kwargs',
     'timeout',
+    'after',
+    'requires',
+    'ready_check',
+    'ready_timeout',
+    'restart',
+    'restart_limit',
+    'liveness_check',
+    'cpu_affinity',
+    'reserved_cores',
 ])
 
+
+def service_start_phases(services):
+    '''
+    Group services into start phases using their After= and Requires=
+    dependencies. Services in the same phase do not depend on each other and
+    can be started at the same time.
+
+    A service that declares neither After= nor Requires= starts after all
+    services listed before it, which is how services were started before these
+    options existed. Requires= implies After=; requiring an unknown service is
+    an error while After= on an unknown service is ignored.
+
+    Params
+    ------
+    services : `list of ConfigOpts or ConfigOptsParams`
+
+    Returns
+    -------
+    List of phases in start order; each phase is a list of indices into services.
+    '''
+    indices = dict()
+    for idx, svc in enumerate(services):
+        indices.setdefault(svc.name, []).append(idx)
+
+    deps = []
+    for idx, svc in enumerate(services):
+        if svc.after is None and svc.requires is None:
+            deps.append(range(idx))
+            continue
+        svc_deps = []
+        for name in svc.requires or []:
+            if name not in indices:
+                raise ValueError('Service %s requires unknown service %s' % (svc.name, name))
+            svc_deps.extend(indices[name])
+        for name in svc.after or []:
+            if name not in indices:
+                _log.debug('Service %s wants to start after unknown service %s; ignoring', svc.name, name)
+            svc_deps.extend(indices.get(name, []))
+        deps.append(svc_deps)
+
+    levels = dict()
+    visiting = set()
+    def _level(idx):
+        if idx in levels:
+            return levels[idx]
+        if idx in visiting:
+            raise ValueError('Dependency cycle involving service %s' % services[idx].name)
+        visiting.add(idx)
+        levels[idx] = 1 + max([_level(dep) for dep in deps[idx]] + [-1])
+        visiting.discard(idx)
+        return levels[idx]
+
+    phases = []
+    for idx in range(len(services)):
+        level = _level(idx)
+        while len(phases) <= level:
+            phases.append([])
+        phases[level].append(idx)
+    return phases
+
 def autogen_fn(name):
     """
     Given a product name (hadoop, hdfs, etc), generate default configuration
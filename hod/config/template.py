@@ -85,16 +85,18 @@ def register_templates(template_registry, config_opts):
     '''
     workdir = config_opts.workdir
     modules = config_opts.modules
-    local_data_network = node.sorted_network(node.get_networks())[0]
+    local_data_network = node.node_inventory().data_network()
     templates = [
         _config_template_stub('masterhostname', 'Hostname bound to the Fully Qualified Domain Name (FQDN) of the master node.'),
         _config_template_stub('masterhostaddress', 'Address bound to the Fully Qualified Domain Name (FQDN) of the master node.'),
-        _config_template_stub('masterdataname', 'Hostname bound to the Infiniband adaptor on the master node if available'),
-        _config_template_stub('masterdataaddress', 'Address bound to the Infiniband adaptor on the master node if available'),
+        _config_template_stub('masterdataname', 'Hostname bound to the data interface (the fastest one, or see data_interfaces in hod.conf) on the master node'),
+        _config_template_stub('masterdataaddress', 'Address bound to the data interface on the master node'),
         ConfigTemplate('hostname', socket.getfqdn, 'Fully Qualified Domain Name (FQDN)'),
         ConfigTemplate('hostaddress', lambda: socket.gethostbyname(socket.getfqdn()), 'IP address registered as the FQDN'),
-        ConfigTemplate('dataname', local_data_network.hostname, 'Infiniband hostname if available'),
-        ConfigTemplate('dataaddress', local_data_network.addr, 'Infiniband address if available'),
+        ConfigTemplate('dataname', local_data_network.hostname, 'Hostname of the data interface (the fastest one, or see data_interfaces in hod.conf)'),
+        ConfigTemplate('dataaddress', local_data_network.addr, 'Address of the data interface'),
+        ConfigTemplate('numanodes', lambda: max(1, len(node.node_inventory().numa_nodes())), 'Number of NUMA nodes (sockets) with cores available to the job'),
+        ConfigTemplate('numabind', lambda: node.node_inventory().numa_binding(), 'numactl command binding a daemon to the NUMA nodes available to the job, empty if there is no need or numactl is not available'),
         ConfigTemplate('workdir', workdir, 'Base directory for configuration and logging, e.g. /tmp, or somewhere on a shared file system.'),
         ConfigTemplate('localworkdir', lambda: mklocalworkdir(workdir), 'Subdirectory of workdir with user, host, and pid in the name to make it distinct from other workdirs for use on shared file systems'),
         ConfigTemplate('user', _current_user, 'Current user'),
@@ -105,6 +107,16 @@ def register_templates(template_registry, config_opts):
     for ct in templates:
         template_registry.register(ct)
 
+def mkjobworkdir(workdir):
+    '''
+    Construct the pathname for the dir in workdir with the localworkdirs
+    of all hosts of the job.
+    '''
+    jobid = os.getenv('PBS_JOBID')
+    if jobid is None:
+        raise RuntimeError('$PBS_JOBID must be defined to create a localworkdir.')
+    return mkpath(workdir, 'hod', jobid)
+
 def mklocalworkdir(workdir):
     '''
     Construct the pathname for a workdir with a path local to this
@@ -112,12 +124,10 @@ def mklocalworkdir(workdir):
     '''
     user = _current_user()
     pid = os.getpid()
-    jobid = os.getenv('PBS_JOBID')
-    if jobid is None:
-        raise RuntimeError('$PBS_JOBID must be defined to create a localworkdir.')
+    jobworkdir = mkjobworkdir(workdir)
     hostname = socket.getfqdn()
     dir_name = '.'.join([user, hostname, str(pid)])
-    return mkpath(workdir, 'hod', jobid, dir_name)
+    return mkpath(jobworkdir, dir_name)
 
 def _current_user():
     '''
@@ -0,0 +1,357 @@
+# #
+# Copyright 2009-2015 Ghent University
+#
+# This file is part of hanythingondemand
+# originally created by the HPC team of Ghent University (http://ugent.be/hpc/en),
+# with support of Ghent University (http://ugent.be/hpc),
+# the Flemish Supercomputer Centre (VSC) (https://vscentrum.be/nl/en),
+# the Hercules foundation (http://www.herculesstichting.be/in_English)
+# and the Department of Economy, Science and Innovation (EWI) (http://www.ewi-vlaanderen.be/en).
+#
+# http://github.com/hpcugent/hanythingondemand
+#
+# hanythingondemand is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation v2.
+#
+# hanythingondemand is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with hanythingondemand. If not, see <http://www.gnu.org/licenses/>.
+# #
+"""
+Grow a running cluster with the nodes of another job ('hod grow').
+
+The master of a cluster runs a GrowServer, which listens on a port that is recorded in the
+cluster info dir (hod.d/<label>/grow) together with a random token. The ranks of a grow job
+get the task table from it: rank 0 connects to the server, both sides prove they know the
+token and rank 0 spreads the task table to the other ranks. The grow job then starts the
+services that run on the slaves of the cluster, configured with the templates of the master,
+so they register with the services on the master. The connection stays open: when the
+cluster stops, the grow job stops its services as well.
+"""
+import copy
+import hashlib
+import hmac
+import os
+import select
+import socket
+import struct
+import sys
+import threading
+from os.path import join as mkpath
+
+from vsc.utils import fancylogger
+from vsc.utils.generaloption import GeneralOption
+
+from hod import VERSION as HOD_VERSION
+
+from hod.cluster import cluster_grow_info, rm_grow_info, save_grow_info
+from hod.config.config import RUNS_ON_SLAVE
+from hod.config.template import mklocalworkdir
+from hod.hodproc import ConfiguredSlave
+from hod.mpiservice import (FORCE_STOP_FILE, MASTERRANK, Terminated, _decode_task_table, _encode_task_table,
+                            run_tasks)
+from hod.options import GENERAL_HOD_OPTIONS, SERVICE_OPTIONS
+from hod.utils import only_if_module_is_available
+
+_log = fancylogger.getLogger(fname=False)
+
+GROW_TIMEOUT = 30  # seconds to connect to the master and exchange the task table
+ACCEPT_INTERVAL = 1  # seconds between checks whether the GrowServer is stopped
+NONCE_SIZE = 16
+MAX_FRAME_SIZE = 64 * 1024 * 1024
+
+_HEADER = struct.Struct('!I')
+
+
+def _send_frame(sock, data):
+    """Send data, prefixed with its length"""
+    sock.sendall(_HEADER.pack(len(data)) + data)
+
+
+def _recv_exact(sock, size):
+    """Read exactly size bytes from sock; returns None on EOF"""
+    chunks = []
+    while size:
+        chunk = sock.recv(min(size, 65536))
+        if not chunk:
+            return None
+        chunks.append(chunk)
+        size -= len(chunk)
+    return ''.join(chunks)
+
+
+def _recv_frame(sock):
+    """Receive data sent with _send_frame; returns None on EOF"""
+    header = _recv_exact(sock, _HEADER.size)
+    if header is None:
+        return None
+    size = _HEADER.unpack(header)[0]
+    if size > MAX_FRAME_SIZE:
+        raise RuntimeError("Frame of %d bytes is too large" % size)
+    return _recv_exact(sock, size)
+
+
+def _mac(token, *parts):
+    """Message authentication code of the concatenated parts with token as key"""
+    return hmac.new(str(token), ''.join(parts), hashlib.sha256).digest()
+
+
+def _equal(first, second):
+    """Compare two strings in constant time"""
+    if hasattr(hmac, 'compare_digest'):
+        return hmac.compare_digest(first, second)
+    if len(first) != len(second):
+        return False
+    result = 0
+    for char1, char2 in zip(first, second):
+        result |= ord(char1) ^ ord(char2)
+    return result == 0
+
+
+class GrowServer(object):
+    """Hand out the task table of the cluster to grow jobs"""
+    def __init__(self, svc, label, host=None):
+        self.svc = svc
+        self.label = label
+        self.host = host or socket.getfqdn()
+        self.token = os.urandom(32).encode('hex')
+        self.port = None
+        self._sock = None
+        self._thread = None
+        self._stopping = False
+        self._task_table = None
+        self._clients = []
+        self._lock = threading.Lock()
+
+    def start(self):
+        """Start listening and record where in the cluster info dir"""
+        self._task_table = _encode_task_table(self.svc.master_template_kwargs, self.svc.tasks, self.svc.precfg)
+        self._sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        self._sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        self._sock.bind(('', 0))
+        self._sock.listen(16)
+        self.port = self._sock.getsockname()[1]
+
+        modules = []
+        if self.svc.precfg is not None:
+            modules = self.svc.precfg.modules
+        save_grow_info(self.label, {'host': self.host, 'port': self.port, 'token': self.token, 'modules': modules})
+
+        self._thread = threading.Thread(target=self._serve, name='grow-server')
+        self._thread.daemon = True
+        self._thread.start()
+        _log.info("Cluster %s can be grown through %s:%d", self.label, self.host, self.port)
+
+    def stop(self):
+        """Stop listening and disconnect the grow jobs, which makes them stop their services"""
+        self._stopping = True
+        if self._thread is not None:
+            self._thread.join()
+        if self._sock is not None:
+            self._sock.close()
+        with self._lock:
+            for conn in self._clients:
+                try:
+                    conn.shutdown(socket.SHUT_RDWR)
+                except socket.error:
+                    pass
+        try:
+            rm_grow_info(self.label)
+        except OSError, err:
+            _log.error("Failed to remove the grow info of cluster %s: %s", self.label, err)
+
+    def _serve(self):
+        while not self._stopping:
+            try:
+                readable = select.select([self._sock], [], [], ACCEPT_INTERVAL)[0]
+            except select.error:
+                continue
+            if readable:
+                conn, addr = self._sock.accept()
+                thread = threading.Thread(target=self._handle, args=(conn, addr), name='grow-%s' % addr[0])
+                thread.daemon = True
+                thread.start()
+
+    def _handle(self, conn, addr):
+        """Send the task table to a grow job and wait until it disconnects"""
+        conn.settimeout(GROW_TIMEOUT)
+        try:
+            nonce_s = os.urandom(NONCE_SIZE)
+            _send_frame(conn, nonce_s)
+            reply = _recv_frame(conn)
+            if reply is None or len(reply) <= NONCE_SIZE:
+                _log.warn("Invalid grow request from %s", addr[0])
+                return
+            nonce_c, mac = reply[:NONCE_SIZE], reply[NONCE_SIZE:]
+            if not _equal(mac, _mac(self.token, 'client', nonce_s, nonce_c)):
+                _log.warn("Refused grow request from %s: wrong token", addr[0])
+                return
+            _send_frame(conn, self._task_table)
+            _send_frame(conn, _mac(self.token, 'server', nonce_c, self._task_table))
+
+            _log.info("Grow job on %s joined cluster %s", addr[0], self.label)
+            conn.settimeout(None)
+            with self._lock:
+                self._clients.append(conn)
+            while conn.recv(4096):
+                pass
+            _log.info("Grow job on %s left cluster %s", addr[0], self.label)
+        except (socket.error, socket.timeout, RuntimeError), err:
+            _log.warn("Grow request from %s failed: %s", addr[0], err)
+        finally:
+            with self._lock:
+                if conn in self._clients:
+                    self._clients.remove(conn)
+            conn.close()
+
+
+def start_grow_server(svc, label):
+    """Start a GrowServer for the cluster; returns None if that is not possible, the cluster runs anyway"""
+    server = GrowServer(svc, label)
+    try:
+        server.start()
+    except (socket.error, IOError, OSError), err:
+        _log.error("Cluster %s can not be grown: %s", label, err)
+        return None
+    return server
+
+
+def fetch_task_table(host, port, token, timeout=GROW_TIMEOUT):
+    """
+    Get the task table from the GrowServer at host:port.
+    Returns the connected socket, which the server closes when the cluster stops, and the task table.
+    """
+    sock = socket.create_connection((host, port), timeout)
+    try:
+        nonce_s = _recv_frame(sock)
+        if nonce_s is None or len(nonce_s) != NONCE_SIZE:
+            raise RuntimeError("Invalid reply from %s:%s" % (host, port))
+        nonce_c = os.urandom(NONCE_SIZE)
+        _send_frame(sock, nonce_c + _mac(token, 'client', nonce_s, nonce_c))
+        data = _recv_frame(sock)
+        mac = _recv_frame(sock)
+        if data is None or mac is None:
+            raise RuntimeError("Master at %s:%s refused to hand out the task table" % (host, port))
+        if not _equal(mac, _mac(token, 'server', nonce_c, data)):
+            raise RuntimeError("Master at %s:%s does not know the token" % (host, port))
+    except:
+        sock.close()
+        raise
+    sock.settimeout(None)
+    return sock, data
+
+
+def grow_tasks(tasks, size):
+    """
+    Return the tasks to run in a grow job with size ranks: the tasks that run on the slaves of
+    the cluster, on all ranks. Dependencies on the other tasks are left out, as those run in the cluster.
+    """
+    names = set([task.name for task in tasks if task.config_opts.runs_on & RUNS_ON_SLAVE])
+
+    def _known(deps):
+        if deps is None:
+            return None
+        return [dep for dep in deps if dep in names]
+
+    grown = []
+    for task in tasks:
+        if task.name in names:
+            params = task.config_opts
+            params = params._replace(after=_known(params.after), requires=_known(params.requires))
+            grown.append(task._replace(ranks=range(size), config_opts=params))
+    return grown
+
+
+def _watch_master(sock, controldirs):
+    """Wait until the master disconnects, and force stop the tasks then"""
+    try:
+        while sock.recv(4096):
+            pass
+    except socket.error, err:
+        _log.debug("Connection to the master failed: %s", err)
+    _log.warn("Cluster stopped; stopping the services of this grow job")
+    for controldir in controldirs:
+        try:
+            if not os.path.exists(controldir):
+                os.makedirs(controldir)
+            open(mkpath(controldir, FORCE_STOP_FILE), 'w').close()
+        except (IOError, OSError), err:
+            _log.error("Failed to force stop the work with controldir %s: %s", controldir, err)
+
+
+def setup_grow_tasks(svc, grow_info):
+    """
+    Get the task table of the cluster from its GrowServer and set up the tasks to run in this job.
+    Like setup_tasks, rank 0 fetches the table and spreads it to the other ranks.
+    """
+    data = None
+    master_sock = None
+    if svc.rank == MASTERRANK:
+        try:
+            master_sock, data = fetch_task_table(grow_info['host'], grow_info['port'], grow_info['token'])
+        finally:
+            # don't leave the other ranks waiting for the tasks if this fails
+            if svc.size > 1:
+                svc.comm.bcast(data, root=MASTERRANK)
+    else:
+        data = svc.comm.bcast(None, root=MASTERRANK)
+        if data is None:
+            raise RuntimeError("Failed to get the tasks of the cluster to grow")
+
+    master_template_kwargs, tasks, precfg = _decode_task_table(data)
+    svc.distribution(*master_template_kwargs, precfg=precfg)
+    svc.tasks = grow_tasks(tasks, svc.size)
+    _log.info("Growing the cluster with %d tasks on rank %s: %s", len(svc.tasks), svc.rank,
+              ', '.join([task.name for task in svc.tasks]))
+
+    if master_sock is not None:
+        controldirs = [mkpath(mklocalworkdir(task.config_opts.workdir), 'controldir') for task in svc.tasks]
+        watcher = threading.Thread(target=_watch_master, args=(master_sock, controldirs), name='grow-watch')
+        watcher.daemon = True
+        watcher.start()
+
+
+class GrowLocalOptions(GeneralOption):
+    """Option parser for the grow job"""
+    VERSION = HOD_VERSION
+
+    def config_options(self):
+        """Add general configuration options."""
+        opts = dict([(name, copy.deepcopy(GENERAL_HOD_OPTIONS[name])) for name in ['hod-module', 'label']])
+        opts.update(copy.deepcopy(SERVICE_OPTIONS))
+        descr = ["Grow configuration", "Configuration options for the grow job"]
+
+        self.log.debug("Add config option parser descr %s opts %s", descr, opts)
+        self.add_group_parser(opts, descr)
+
+
+@only_if_module_is_available('mpi4py')
+def run(args):
+    """Run the services of a cluster on the nodes of this job."""
+    optparser = GrowLocalOptions(go_args=args)
+    label = optparser.options.label
+
+    svc = ConfiguredSlave(optparser.options)
+    svc.teardown_budget = optparser.options.teardown_budget
+    try:
+        grow_info = None
+        if svc.rank == MASTERRANK:
+            grow_info = cluster_grow_info(label)
+        setup_grow_tasks(svc, grow_info)
+        run_tasks(svc)
+        svc.stop_service()
+        return 0
+    except Terminated as err:
+        _log.error("Grow job was terminated by signal %d; services not stopped in time: %s",
+                   err.signum, ', '.join(err.not_stopped) or 'none')
+        sys.exit(128 + err.signum)
+    except Exception as err:
+        _log.error(str(err))
+        _log.exception("Growing cluster %s failed", label)
+        sys.exit(1)
+
@@ -0,0 +1,44 @@
+#!/usr/bin/env python
+# #
+# Copyright 2009-2015 Ghent University
+#
+# This file is part of hanythingondemand
+# originally created by the HPC team of Ghent University (http://ugent.be/hpc/en),
+# with support of Ghent University (http://ugent.be/hpc),
+# the Flemish Supercomputer Centre (VSC) (https://vscentrum.be/nl/en),
+# the Hercules foundation (http://www.herculesstichting.be/in_English)
+# and the Department of Economy, Science and Innovation (EWI) (http://www.ewi-vlaanderen.be/en).
+#
+# http://github.com/hpcugent/hanythingondemand
+#
+# hanythingondemand is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation v2.
+#
+# hanythingondemand is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with hanythingondemand. If not, see <http://www.gnu.org/licenses/>.
+# #
+"""
+Main script of a 'hod grow' job, see hod.grow
+
+Like hod.local, this only imports hod.spawn, so main can fork the spawn helper before MPI is initialized.
+"""
+import sys
+
+from hod.spawn import start_spawn_helper_if_requested
+
+
+def main(args):
+    """Run the services of a cluster on the nodes of this job."""
+    start_spawn_helper_if_requested(args)
+    from hod.grow import run
+    return run(args)
+
+
+if __name__ == '__main__':
+    main(sys.argv[1:])
@@ -27,16 +27,20 @@
 @author: Stijn De Weirdt (Ghent University)
 """
 import os
+from copy import deepcopy
 from errno import EEXIST
 from os.path import join as mkpath
-from hod.mpiservice import MpiService, Task, MASTERRANK
+from hod.mpiservice import MpiService, Task, MASTERRANK, master_template_opts
+from hod.node.node import node_inventory
 from hod.config.config import (PreServiceConfigOpts, ConfigOpts, 
         ConfigOptsParams, env2str, service_config_fn, write_service_config,
-        parse_comma_delim_list, resolve_config_paths, RUNS_ON_MASTER)
+        parse_comma_delim_list, resolve_config_paths, service_start_phases, slave_cpu_pinning,
+        RUNS_ON_MASTER)
 from hod.commands.command import NO_TIMEOUT
 from hod.config.template import (TemplateRegistry, TemplateResolver,
         register_templates)
 from hod.work.config_service import ConfiguredService
+from hod.timeline import timed
 
 from vsc.utils import fancylogger
 _log = fancylogger.getLogger(fname=False)
@@ -53,6 +57,7 @@ def _ignore_eexist(fn):
         else:
             raise
 
+@timed('setup_config_paths')
 def _setup_config_paths(precfg, resolver):
     """
     Make the base and config directories; copy target service (i.e. hadoop xml)
@@ -74,6 +79,7 @@ def _setup_config_paths(precfg, resolver):
         dest_path = mkpath(precfg.configdir, dest_file)
         write_service_config(dest_path, cfg, config_writer, resolver)
 
+@timed('load_hod_config')
 def load_hod_config(filenames, workdir, modules):
     '''
     Load the manifest config (hod.conf) files.
@@ -125,6 +131,14 @@ class ConfiguredMaster(MpiService):
         self.tasks = []
         config_path = resolve_config_paths(self.options.hodconf, self.options.dist)
         m_config = load_hod_config(config_path, self.options.workdir, self.options.modules)
+        m_config.cpu_pinning = slave_cpu_pinning(m_config.service_files)
+        # sent to the slaves so they don't need to parse the config files themselves
+        self.precfg = deepcopy(m_config)
+        if m_config.data_interfaces:
+            # the master template args were made before hod.conf was read
+            node_inventory().prefer_interfaces(m_config.data_interfaces)
+            master_template_args = tuple(master_template_opts())
+            self.master_template_kwargs = list(master_template_args)
         m_config.autogen_configs()
 
         resolver = _setup_template_resolver(m_config, master_template_args)
@@ -157,6 +171,11 @@ class ConfiguredMaster(MpiService):
             cfg_opts = config.to_params(m_config.workdir, m_config.modules, master_template_args)
             self.tasks.append(Task(ConfiguredService, config.name, ranks_to_run, cfg_opts, master_env))
 
+        # fail early on unknown requirements or dependency cycles
+        phases = service_start_phases([task.config_opts for task in self.tasks])
+        self.log.info('Services will be started in %d phases: %s', len(phases),
+                      [[self.tasks[idx].name for idx in phase] for phase in phases])
+
 
 class ConfiguredSlave(MpiService):
     """
@@ -171,9 +190,18 @@ class ConfiguredSlave(MpiService):
         Master makes the distribution
 
         This only needs to run if there are more than 1 node (self.size>1)
+
+        If the master sent the parsed hod.conf as the 'precfg' keyword argument,
+        it is used instead of parsing the config files again; only the node specific
+        autogen settings and templates are filled in here.
         """
-        config_path = resolve_config_paths(self.options.hodconf, self.options.dist)
-        m_config = load_hod_config(config_path, self.options.workdir, self.options.modules)
+        m_config = kwargs.get('precfg', None)
+        if m_config is None:
+            config_path = resolve_config_paths(self.options.hodconf, self.options.dist)
+            m_config = load_hod_config(config_path, self.options.workdir, self.options.modules)
+        else:
+            self.log.debug('Using hod.conf as parsed by the master: %s', str(m_config))
+        node_inventory().prefer_interfaces(m_config.data_interfaces)
         m_config.autogen_configs()
         resolver = _setup_template_resolver(m_config, master_template_args)
         _setup_config_paths(m_config, resolver)
@@ -25,85 +25,23 @@
 """
 Main hanythingondemand script, should be invoked in a job
 
+The spawn helper has to be forked before MPI is initialized, which happens as soon as mpi4py.MPI is
+imported, also by fancylogger. So this only imports hod.spawn, which needs nothing but the standard
+library at import time; main forks the helper and only then imports hod.localjob, which runs the cluster.
+
 @author: Ewan Higgs (Universiteit Gent)
 @author: Kenneth Hoste (Universiteit Gent)
 """
-import copy
-import os
-import random
-import string
 import sys
 
-from hod import VERSION as HOD_VERSION
-
-from vsc.utils import fancylogger
-from vsc.utils.generaloption import GeneralOption
-
-from hod.config.config import resolve_config_paths
-from hod.cluster import gen_cluster_info, save_cluster_info
-from hod.hodproc import ConfiguredSlave, ConfiguredMaster
-from hod.mpiservice import MASTERRANK, run_tasks, setup_tasks
-from hod.options import GENERAL_HOD_OPTIONS
-from hod.utils import only_if_module_is_available
-
-# optional packages, not always required
-try:
-    from mpi4py import MPI
-except ImportError:
-    pass
-
-
-_log = fancylogger.getLogger(fname=False)
-
+from hod.spawn import start_spawn_helper_if_requested
 
-class LocalOptions(GeneralOption):
-    """Option parser for 'genconfig' subcommand."""
-    VERSION = HOD_VERSION
 
-    def config_options(self):
-        """Add general configuration options."""
-        opts = copy.deepcopy(GENERAL_HOD_OPTIONS)
-        opts.update({
-            'modules': ("Extra modules to load in each service environment", 'string', 'store', None),
-            'script': ("Script to run on the cluster", "string", "store", None),
-        })
-        descr = ["Local configuration", "Configuration options for the 'genconfig' subcommand"]
-
-        self.log.debug("Add config option parser descr %s opts %s", descr, opts)
-        self.add_group_parser(opts, descr)
-
-
-@only_if_module_is_available('mpi4py')
 def main(args):
     """Run HOD cluster."""
-    optparser = LocalOptions(go_args=args)
-
-    if MPI.COMM_WORLD.rank == MASTERRANK:
-        label = optparser.options.label
-        if label is None:
-            # if no label is specified, use job ID;
-            # if $PBS_JOBID is not set, generate a random string (10 chars)
-            label = os.getenv('PBS_JOBID', ''.join(random.choice(string.letters + string.digits) for _ in range(10)))
-
-        _log.debug("Creating cluster info using label '%s'", label)
-        cluster_info = gen_cluster_info(label, optparser.options)
-        save_cluster_info(cluster_info)
-
-        _log.debug("Starting master process")
-        svc = ConfiguredMaster(optparser.options)
-    else:
-        _log.debug("Starting slave process")
-        svc = ConfiguredSlave(optparser.options)
-
-    try:
-        setup_tasks(svc)
-        run_tasks(svc)
-        svc.stop_service()
-        return 0
-    except Exception as err:
-        _log.error(str(err))
-        _log.exception("HanythingOnDemand failed")
-        sys.exit(1)
+    start_spawn_helper_if_requested(args)
+    from hod.localjob import run
+    return run(args)
 
 
 if __name__ == '__main__':
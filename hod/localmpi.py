@@ -0,0 +1,606 @@
+# #
+# Copyright 2009-2015 Ghent University
+#
+# This file is part of hanythingondemand
+# originally created by the HPC team of Ghent University (http://ugent.be/hpc/en),
+# with support of Ghent University (http://ugent.be/hpc),
+# the Flemish Supercomputer Centre (VSC) (https://vscentrum.be/nl/en),
+# the Hercules foundation (http://www.herculesstichting.be/in_English)
+# and the Department of Economy, Science and Innovation (EWI) (http://www.ewi-vlaanderen.be/en).
+#
+# http://github.com/hpcugent/hanythingondemand
+#
+# hanythingondemand is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation v2.
+#
+# hanythingondemand is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with hanythingondemand. If not, see <http://www.gnu.org/licenses/>.
+# #
+"""
+Stand-in for the part of mpi4py that hod uses, running all ranks as local processes.
+
+This makes it possible to run (and profile) the setup_tasks/run_tasks path of hod.local
+with many ranks on a single machine, without an MPI stack. The launcher starts a hub
+that implements the collectives and one process per rank; the ranks talk to the hub
+over a Unix socket and get a fake mpi4py.MPI module:
+
+    python -m hod.localmpi -n 256 hod.local --hodconf=/path/to/hod.conf --workdir=/tmp/work
+
+Supported: COMM_WORLD, COMM_NULL, Get_rank/Get_size (and the rank/size attributes), barrier,
+bcast, gather, allgather, allreduce, Allreduce, Iallreduce, Get_group/Group.Incl/Create,
+Split, Dup, Disconnect and Free.
+"""
+import cPickle
+import errno
+import os
+import select
+import shutil
+import signal
+import socket
+import struct
+import subprocess
+import sys
+import tempfile
+import time
+import types
+from array import array
+from optparse import OptionParser
+
+# environment variables for the rank processes
+ENV_HUB = 'HOD_LOCALMPI_HUB'
+ENV_RANK = 'HOD_LOCALMPI_RANK'
+ENV_SIZE = 'HOD_LOCALMPI_SIZE'
+ENV_PROFILE = 'HOD_LOCALMPI_PROFILE'
+
+UNDEFINED = -32766
+WORLD_ID = 0
+
+_HEADER = struct.Struct('!I')
+CONNECT_RETRIES = 100
+CONNECT_RETRY_DELAY = 0.1
+ACCEPT_CHECK_INTERVAL = 1
+
+
+def _send(sock, obj):
+    """Send a pickled object, prefixed with its length"""
+    data = cPickle.dumps(obj, cPickle.HIGHEST_PROTOCOL)
+    sock.sendall(_HEADER.pack(len(data)) + data)
+
+
+def _recv_exact(sock, size):
+    """Read exactly size bytes from sock; returns None on EOF"""
+    chunks = []
+    while size:
+        try:
+            chunk = sock.recv(size)
+        except socket.error, err:
+            if err.args[0] == errno.EINTR:
+                continue
+            if err.args[0] == errno.ECONNRESET:
+                return None
+            raise
+        if not chunk:
+            return None
+        chunks.append(chunk)
+        size -= len(chunk)
+    return ''.join(chunks)
+
+
+def _recv(sock):
+    """Receive an object sent with _send; returns None on EOF"""
+    header = _recv_exact(sock, _HEADER.size)
+    if header is None:
+        return None
+    data = _recv_exact(sock, _HEADER.unpack(header)[0])
+    if data is None:
+        return None
+    return cPickle.loads(data)
+
+
+# reduction operations, on single values
+_OPS = {
+    'SUM': lambda a, b: a + b,
+    'PROD': lambda a, b: a * b,
+    'MAX': max,
+    'MIN': min,
+    'BOR': lambda a, b: a | b,
+    'BAND': lambda a, b: a & b,
+    'LOR': lambda a, b: a or b,
+    'LAND': lambda a, b: a and b,
+}
+
+
+def _reduce(values, op, elementwise):
+    """Reduce the contributions of all ranks (in rank order) with op"""
+    fn = _OPS[op]
+    if elementwise:
+        return [reduce(fn, items) for items in zip(*values)]
+    return reduce(fn, values)
+
+
+class Hub(object):
+    """
+    Implements the collectives for all ranks.
+
+    Every rank sends (comm_id, seq, op, args) for each collective it enters, where seq counts the
+    collectives of the rank on that communicator. Once all members of the communicator sent their
+    part, the hub answers each of them with (comm_id, seq, error, result).
+    """
+    def __init__(self, path, size):
+        self.size = size
+        self.listener = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        self.listener.bind(path)
+        self.listener.listen(min(size, socket.SOMAXCONN))
+        self.socks = dict()  # rank -> socket
+        self.comms = {WORLD_ID: range(size)}  # comm id -> world ranks, in comm rank order
+        self.next_comm_id = WORLD_ID + 1
+        self.pending = dict()  # (comm_id, seq) -> {world rank: (op, args)}
+        self.dead = set()
+
+    def accept(self, check=None):
+        """
+        Wait until all ranks connected.
+        check is called every second while waiting, e.g. to raise an error when a rank process died.
+        """
+        self.listener.settimeout(ACCEPT_CHECK_INTERVAL)
+        while len(self.socks) < self.size:
+            try:
+                sock, _ = self.listener.accept()
+            except socket.timeout:
+                if check is not None:
+                    check()
+                continue
+            sock.settimeout(None)
+            rank = _recv(sock)
+            self.socks[rank] = sock
+        self.listener.close()
+
+    def run(self):
+        """Serve collectives until all ranks disconnected"""
+        poller = select.poll()
+        fds = dict()
+        for rank, sock in self.socks.items():
+            poller.register(sock.fileno(), select.POLLIN)
+            fds[sock.fileno()] = rank
+
+        while len(self.dead) < self.size:
+            try:
+                events = poller.poll()
+            except select.error, err:
+                if err.args[0] == errno.EINTR:
+                    continue
+                raise
+            for fd, _ in events:
+                rank = fds[fd]
+                msg = _recv(self.socks[rank])
+                if msg is None:
+                    poller.unregister(fd)
+                    self.socks[rank].close()
+                    self.dead.add(rank)
+                    self._fail_pending()
+                else:
+                    self._contribute(rank, *msg)
+
+    def _reply(self, rank, comm_id, seq, error, result):
+        """Send the outcome of a collective to rank"""
+        if rank not in self.dead:
+            try:
+                _send(self.socks[rank], (comm_id, seq, error, result))
+            except socket.error, err:
+                # the rank exited, which is noticed when its end of the socket is read
+                if err.errno not in (errno.EPIPE, errno.ECONNRESET):
+                    raise
+
+    def _fail_pending(self):
+        """Fail the collectives that wait for ranks that are gone"""
+        for key, parts in self.pending.items():
+            members = self.comms[key[0]]
+            missing = [rank for rank in members if rank not in parts and rank in self.dead]
+            if missing:
+                del self.pending[key]
+                for rank in parts:
+                    self._reply(rank, key[0], key[1], 'rank(s) %s exited during collective' % missing, None)
+
+    def _contribute(self, rank, comm_id, seq, op, args):
+        """Register the part of rank in a collective, and finish it if it is complete"""
+        key = (comm_id, seq)
+        if comm_id not in self.comms:
+            self._reply(rank, comm_id, seq, 'unknown communicator %s' % comm_id, None)
+            return
+        parts = self.pending.setdefault(key, dict())
+        parts[rank] = (op, args)
+        members = self.comms[comm_id]
+        if len(parts) < len(members):
+            self._fail_pending()
+            return
+        del self.pending[key]
+
+        ops = set([part[0] for part in parts.values()])
+        if len(ops) > 1:
+            for member in members:
+                self._reply(member, comm_id, seq, 'mismatched collectives %s' % sorted(ops), None)
+            return
+        results = getattr(self, '_op_%s' % op)(members, [parts[member][1] for member in members])
+        for member, result in zip(members, results):
+            self._reply(member, comm_id, seq, None, result)
+        if op == 'free':
+            del self.comms[comm_id]
+
+    def _new_comm(self, ranks):
+        """Register a new communicator"""
+        comm_id = self.next_comm_id
+        self.next_comm_id += 1
+        self.comms[comm_id] = ranks
+        return comm_id
+
+    # each _op_ method gets the world ranks and arguments of all members (in comm rank order)
+    # and returns the results for all members
+
+    def _op_barrier(self, members, args):
+        return [None] * len(members)
+
+    _op_free = _op_barrier
+
+    def _op_bcast(self, members, args):
+        root = args[0][0]
+        return [args[root][1]] * len(members)
+
+    def _op_gather(self, members, args):
+        root = args[0][0]
+        values = [arg[1] for arg in args]
+        return [(idx == root and values or None) for idx in range(len(members))]
+
+    def _op_allgather(self, members, args):
+        values = [arg[0] for arg in args]
+        return [values] * len(members)
+
+    def _op_allreduce(self, members, args):
+        op, elementwise = args[0][0], args[0][1]
+        result = _reduce([arg[2] for arg in args], op, elementwise)
+        return [result] * len(members)
+
+    def _op_split(self, members, args):
+        colors = dict()
+        for idx, (color, key) in enumerate(args):
+            if color != UNDEFINED:
+                colors.setdefault(color, []).append((key, idx, members[idx]))
+        results = [None] * len(members)
+        for color in sorted(colors):
+            ranks = [member for _, _, member in sorted(colors[color])]
+            comm_id = self._new_comm(ranks)
+            for _, idx, _ in colors[color]:
+                results[idx] = (comm_id, ranks)
+        return results
+
+    def _op_create(self, members, args):
+        ranks = args[0][0]
+        comm_id = self._new_comm(ranks)
+        return [(member in ranks and (comm_id, ranks) or None) for member in members]
+
+
+class _Connection(object):
+    """Connection of a rank process to the hub"""
+    def __init__(self, path, rank):
+        self.sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        for attempt in range(CONNECT_RETRIES):
+            try:
+                self.sock.connect(path)
+                break
+            except socket.error:
+                if attempt == CONNECT_RETRIES - 1:
+                    raise
+                time.sleep(CONNECT_RETRY_DELAY)
+        _send(self.sock, rank)
+        self.seqs = dict()
+        self.replies = dict()
+
+    def start(self, comm_id, op, args):
+        """Enter a collective; returns the key to wait for its result"""
+        seq = self.seqs.get(comm_id, 0)
+        self.seqs[comm_id] = seq + 1
+        _send(self.sock, (comm_id, seq, op, args))
+        return (comm_id, seq)
+
+    def result(self, key, block=True):
+        """
+        Get the result of the collective with key. Returns (True, result) if it finished,
+        (False, None) if it did not finish yet and block is False.
+        """
+        while key not in self.replies:
+            if not block:
+                try:
+                    readable = select.select([self.sock], [], [], 0)[0]
+                except select.error, err:
+                    if err.args[0] == errno.EINTR:
+                        continue
+                    raise
+                if not readable:
+                    return False, None
+            msg = _recv(self.sock)
+            if msg is None:
+                raise RuntimeError('localmpi: connection to the hub was lost')
+            self.replies[msg[:2]] = msg[2:]
+        error, result = self.replies.pop(key)
+        if error is not None:
+            raise RuntimeError('localmpi: %s' % error)
+        return True, result
+
+    def call(self, comm_id, op, args):
+        """Run a collective and return its result"""
+        return self.result(self.start(comm_id, op, args))[1]
+
+
+def _buffer(buf):
+    """The array of an mpi4py style buffer specification, e.g. [array, MPI.LONG]"""
+    if isinstance(buf, (list, tuple)):
+        return buf[0]
+    return buf
+
+
+def _fill_buffer(buf, values):
+    """Copy values into an mpi4py style buffer"""
+    target = _buffer(buf)
+    target[:] = array(target.typecode, values)
+
+
+class Group(object):
+    """Group of world ranks"""
+    def __init__(self, ranks, world_rank):
+        self.ranks = list(ranks)
+        self._world_rank = world_rank
+
+    def Get_rank(self):
+        if self._world_rank in self.ranks:
+            return self.ranks.index(self._world_rank)
+        return UNDEFINED
+
+    def Get_size(self):
+        return len(self.ranks)
+
+    rank = property(Get_rank)
+    size = property(Get_size)
+
+    def Incl(self, ranks):
+        return Group([self.ranks[rank] for rank in ranks], self._world_rank)
+
+    def Free(self):
+        pass
+
+
+class Request(object):
+    """Request for a non-blocking collective"""
+    def __init__(self, conn, key, recvbuf):
+        self._conn = conn
+        self._key = key
+        self._recvbuf = recvbuf
+        self._done = False
+
+    def _finish(self, block):
+        if not self._done:
+            self._done, result = self._conn.result(self._key, block=block)
+            if self._done and self._recvbuf is not None:
+                _fill_buffer(self._recvbuf, result)
+        return self._done
+
+    def Test(self):
+        return self._finish(False)
+
+    def Wait(self):
+        self._finish(True)
+
+
+class Comm(object):
+    """Communicator; all methods are collective over its ranks, except Get_rank/Get_size/Get_group"""
+    def __init__(self, conn, comm_id, ranks, world_rank):
+        self._conn = conn
+        self._id = comm_id
+        self._ranks = list(ranks)
+        self._world_rank = world_rank
+
+    def __eq__(self, other):
+        return isinstance(other, Comm) and self._id == other._id
+
+    def __ne__(self, other):
+        return not self == other
+
+    def __hash__(self):
+        return hash(self._id)
+
+    def __repr__(self):
+        return '<localmpi.Comm %s size %d>' % (self._id, len(self._ranks))
+
+    def Get_rank(self):
+        return self._ranks.index(self._world_rank)
+
+    def Get_size(self):
+        return len(self._ranks)
+
+    rank = property(Get_rank)
+    size = property(Get_size)
+
+    def Get_group(self):
+        return Group(self._ranks, self._world_rank)
+
+    def _call(self, op, *args):
+        return self._conn.call(self._id, op, args)
+
+    def _new(self, result):
+        if result is None:
+            return COMM_NULL
+        return Comm(self._conn, result[0], result[1], self._world_rank)
+
+    def barrier(self):
+        self._call('barrier')
+
+    Barrier = barrier
+
+    def Ibarrier(self):
+        return Request(self._conn, self._conn.start(self._id, 'barrier', ()), None)
+
+    def bcast(self, obj=None, root=0):
+        return self._call('bcast', root, obj)
+
+    def gather(self, sendobj, root=0):
+        return self._call('gather', root, sendobj)
+
+    def allgather(self, sendobj):
+        return self._call('allgather', sendobj)
+
+    def allreduce(self, sendobj, op='SUM'):
+        return self._call('allreduce', op, False, sendobj)
+
+    def Allreduce(self, sendbuf, recvbuf, op='SUM'):
+        _fill_buffer(recvbuf, self._call('allreduce', op, True, list(_buffer(sendbuf))))
+
+    def Iallreduce(self, sendbuf, recvbuf, op='SUM'):
+        key = self._conn.start(self._id, 'allreduce', (op, True, list(_buffer(sendbuf))))
+        return Request(self._conn, key, recvbuf)
+
+    def Split(self, color=0, key=0):
+        return self._new(self._call('split', color, key))
+
+    def Dup(self):
+        return self.Split(0, self.Get_rank())
+
+    def Create(self, group):
+        return self._new(self._call('create', group.ranks))
+
+    def Free(self):
+        self._call('free')
+
+    Disconnect = Free
+
+    def Abort(self, errorcode=0):
+        os._exit(errorcode)
+
+
+class _NullComm(object):
+    """MPI.COMM_NULL"""
+    def __eq__(self, other):
+        return isinstance(other, _NullComm)
+
+    def __ne__(self, other):
+        return not self == other
+
+    def __hash__(self):
+        return 0
+
+    def __repr__(self):
+        return '<localmpi.COMM_NULL>'
+
+
+COMM_NULL = _NullComm()
+
+
+def install(path, rank, size):
+    """Connect to the hub at path and install the fake mpi4py package as mpi4py in sys.modules"""
+    conn = _Connection(path, rank)
+
+    mpi = types.ModuleType('mpi4py.MPI')
+    mpi.COMM_WORLD = Comm(conn, WORLD_ID, range(size), rank)
+    mpi.COMM_NULL = COMM_NULL
+    mpi.UNDEFINED = UNDEFINED
+    mpi.Comm = Comm
+    mpi.Group = Group
+    mpi.Request = Request
+    for op in _OPS:
+        setattr(mpi, op, op)
+    for datatype in ['CHAR', 'INT', 'LONG', 'UNSIGNED', 'UNSIGNED_LONG', 'FLOAT', 'DOUBLE', 'BYTE']:
+        setattr(mpi, datatype, datatype)
+    mpi.Is_initialized = lambda: True
+    mpi.Is_finalized = lambda: False
+    mpi.Finalize = lambda: None
+    mpi.Wtime = time.time
+    mpi.Get_processor_name = socket.gethostname
+
+    pkg = types.ModuleType('mpi4py')
+    pkg.MPI = mpi
+    pkg.__path__ = []
+    sys.modules['mpi4py'] = pkg
+    sys.modules['mpi4py.MPI'] = mpi
+    return mpi
+
+
+def _run_rank(module, args):
+    """Run module as __main__ in a rank process started by launch"""
+    import runpy
+    rank = int(os.environ[ENV_RANK])
+    install(os.environ[ENV_HUB], rank, int(os.environ[ENV_SIZE]))
+    sys.argv = [module] + args
+
+    def _run():
+        runpy.run_module(module, run_name='__main__', alter_sys=True)
+
+    profile_dir = os.environ.get(ENV_PROFILE)
+    if profile_dir:
+        import cProfile
+        profiler = cProfile.Profile()
+        try:
+            profiler.runcall(_run)
+        finally:
+            profiler.dump_stats(os.path.join(profile_dir, 'rank%d.prof' % rank))
+    else:
+        _run()
+
+
+def launch(size, module, args, profile_dir=None):
+    """Run module with args in size rank processes. Returns the highest exit code of the ranks."""
+    tmpdir = tempfile.mkdtemp(prefix='hod-localmpi-')
+    path = os.path.join(tmpdir, 'hub')
+    procs = []
+    try:
+        hub = Hub(path, size)
+        for rank in range(size):
+            env = dict(os.environ)
+            env.update({ENV_HUB: path, ENV_RANK: str(rank), ENV_SIZE: str(size)})
+            if profile_dir:
+                env[ENV_PROFILE] = os.path.abspath(profile_dir)
+            cmd = [sys.executable, '-m', 'hod.localmpi', '--rank-process', module] + args
+            procs.append(subprocess.Popen(cmd, env=env))
+
+        def _check():
+            for rank, proc in enumerate(procs):
+                if proc.poll() is not None:
+                    raise RuntimeError('Rank %d exited with %s before connecting' % (rank, proc.returncode))
+
+        hub.accept(_check)
+        hub.run()
+        # a rank killed by a signal has a negative return code
+        return max([abs(proc.wait()) for proc in procs])
+    finally:
+        for proc in procs:
+            if proc.poll() is None:
+                os.kill(proc.pid, signal.SIGTERM)
+                proc.wait()
+        shutil.rmtree(tmpdir)
+
+
+def main(args):
+    """Parse the options and launch the ranks"""
+    if args and args[0] == '--rank-process':
+        _run_rank(args[1], args[2:])
+        return 0
+
+    parser = OptionParser(usage='%prog [options] <module> [<module args>]')
+    parser.disable_interspersed_args()
+    parser.add_option('-n', '--np', type='int', default=1, help='Number of ranks to start')
+    parser.add_option('--profile', default=None,
+                      help='Directory to dump cProfile statistics to, one rank<N>.prof file per rank')
+    opts, rest = parser.parse_args(args)
+    if not rest:
+        parser.error('No module to run')
+    try:
+        return launch(opts.np, rest[0], rest[1:], profile_dir=opts.profile)
+    except RuntimeError, err:
+        sys.stderr.write('%s\n' % err)
+        return 1
+
+
+if __name__ == '__main__':
+    sys.exit(main(sys.argv[1:]))
@@ -32,7 +32,7 @@ Hanythingondemand main program.
 import sys
 
 import hod
-from hod.subcommands import batch, connect, clean, create, dists, genconfig, helptemplate, relabel, listcmd
+from hod.subcommands import batch, connect, clean, create, dists, genconfig, grow, helptemplate, relabel, listcmd
 
 
 SUBCOMMANDS = [
@@ -45,6 +45,7 @@ SUBCOMMANDS = [
     connect.ConnectSubCommand,
     clean.CleanSubCommand,
     relabel.RelabelSubCommand,
+    grow.GrowSubCommand,
 ]
 
 SUBCOMMAND_CLASSES = dict([(sc.CMD, sc) for sc in SUBCOMMANDS])
@@ -29,15 +29,29 @@ Supporting MPI functionality
 @author: Ewan Higgs (Ghent University)
 @author: Kenneth Hoste (Ghent University)
 """
+import cPickle
+import glob
+import os
+import signal
 import socket
+import sys
 import time
+from array import array
 from collections import namedtuple
+from os.path import join as mkpath
 from vsc.utils import fancylogger
 
+import hod.commands.usage as usage
 import hod.node.node as node
-from hod.config.config import ConfigOpts
-from hod.config.template import ConfigTemplate, TemplateRegistry, TemplateResolver, register_templates
+from hod.commands.command import NO_TIMEOUT
+from hod.commands.executor import MAX_WORKERS, CommandExecutor, wait
+from hod.config.config import ConfigOpts, ConfigOptsParams, LIVENESS_INTERVAL, service_start_phases
+from hod.config.template import (ConfigTemplate, TemplateRegistry, TemplateResolver, register_templates,
+                                 mkjobworkdir, mklocalworkdir)
+from hod.options import TEARDOWN_BUDGET
 from hod.utils import only_if_module_is_available
+from hod.wakeup import WAKEUP_TIMEOUT, Waiter
+import hod.timeline as timeline
 
 # optional packages, not always required
 try:
@@ -50,12 +64,39 @@ _log = fancylogger.getLogger(fname=False)
 
 
 
-__all__ = ['MASTERRANK', 'Task', 'barrier', 'MpiService', 'setup_tasks', 'run_tasks']
+__all__ = ['MASTERRANK', 'Task', 'Terminated', 'barrier', 'MpiService', 'setup_tasks', 'run_tasks']
 
 MASTERRANK = 0
 
+WAIT_ITER_SLEEP = 60  # maximum number of seconds between two checks of the active work
+STATUS_POLL_INTERVAL = 1  # seconds between checks whether the status reduction of all ranks is done
+                          # (and, on the master, whether a slave asked for an early tick)
+BARRIER_POLL_INTERVAL = 0.01  # seconds between checks whether all ranks reached a startup barrier
+
+TERMINATE_SIGNALS = (signal.SIGTERM,)
+
+# control files in the controldir of the work to override its status
+FORCE_STOP_FILE = 'force_stop'
+FORCE_CONTINUE_FILE = 'force_continue'
+
+# fields in the status bitmap, per task
+STATUS_DONE = 0
+STATUS_FORCE_STOP = 1
+STATUS_FORCE_CONTINUE = 2
+STATUS_NOT_READY = 3
+_STATUS_FIELDS = 4
+
+# tag of the messages with which a slave asks the master for an early tick of the supervision loop
+WAKEUP_TAG = 77
+# reason for the master to wake up, next to the ones of hod.wakeup
+WAKEUP_SLAVE = 'slave'
+_STATUS_WORD_BITS = array('L').itemsize * 8
+
 Task = namedtuple('Task', ['type', 'name', 'ranks', 'config_opts', 'master_env'])
 
+# version of the encoding of the task table spread by setup_tasks
+TASK_TABLE_VERSION = 4
+
 def _who_is_out_there(comm, rank):
     """Get all self.ranks of members of communicator"""
     others = comm.allgather(rank)
@@ -85,6 +126,24 @@ def barrier(comm, txt):
     _log.debug("%s with barrier DONE", txt)
 
 
+@only_if_module_is_available('mpi4py')
+def _interruptible_barrier(comm, txt):
+    """
+    Barrier which lets signal handlers run while waiting for the other ranks,
+    so the work can be torn down when the job is killed during the startup.
+    """
+    try:
+        request = comm.Ibarrier()
+    except (AttributeError, NotImplementedError):
+        barrier(comm, txt)
+        return
+
+    _log.debug("%s with barrier", txt)
+    while not request.Test():
+        time.sleep(BARRIER_POLL_INTERVAL)
+    _log.debug("%s with barrier DONE", txt)
+
+
 def _check_group(group, txt):
     """Report details about group"""
     myrank = group.Get_rank()
@@ -106,6 +165,40 @@ def _make_comm_group(comm, ranks):
     return newcomm
 
 
+@only_if_module_is_available('mpi4py')
+def _make_comm_groups(comm, rank_lists):
+    """
+    Make communicators for a number of sets of ranks.
+
+    Identical rank lists share a single communicator, a rank list with all ranks of comm
+    gets comm itself and every other one is made with a single Split.
+    Returns a dict mapping the rank lists (as tuples) to the communicators.
+    """
+    myrank = comm.Get_rank()
+    allranks = tuple(range(comm.Get_size()))
+
+    comms = dict()
+    for ranks in rank_lists:
+        ranks = tuple(ranks)
+        if ranks in comms:
+            continue
+        if ranks == allranks:
+            _log.debug("Using comm %s for all ranks", comm)
+            newcomm = comm
+        else:
+            _log.debug("Splitting comm %s for ranks %s", comm, ranks)
+            if myrank in ranks:
+                # keep the order of the rank list like Group.Incl does
+                newcomm = comm.Split(0, ranks.index(myrank))
+            else:
+                newcomm = comm.Split(MPI.UNDEFINED, myrank)
+        _check_comm(newcomm, 'make_comm_groups')
+        comms[ranks] = newcomm
+
+    _log.debug("Made %d communicators for %d rank lists", len(comms), len(rank_lists))
+    return comms
+
+
 @only_if_module_is_available('mpi4py')
 def _stop_comm(comm):
     """Stop a single communicator"""
@@ -136,6 +229,127 @@ def _slave_spread(comm):
     return tasks
 
 
+def _mk_status(ntasks):
+    """Make an empty status bitmap for ntasks tasks"""
+    nbits = ntasks * _STATUS_FIELDS
+    return array('L', [0] * ((nbits + _STATUS_WORD_BITS - 1) // _STATUS_WORD_BITS))
+
+
+def _set_status(status, idx, field):
+    """Set field in the status bitmap for task idx"""
+    word, bit = divmod(idx * _STATUS_FIELDS + field, _STATUS_WORD_BITS)
+    status[word] |= 1 << bit
+
+
+def _get_status(status, idx, field):
+    """Get field from the status bitmap for task idx"""
+    word, bit = divmod(idx * _STATUS_FIELDS + field, _STATUS_WORD_BITS)
+    return bool(status[word] & (1 << bit))
+
+
+def _check_control_files(controldir, status, idx):
+    """Set the force fields for task idx in the status bitmap according to the control files in controldir"""
+    if os.path.isfile(mkpath(controldir, FORCE_STOP_FILE)):
+        _set_status(status, idx, STATUS_FORCE_STOP)
+    if os.path.isfile(mkpath(controldir, FORCE_CONTINUE_FILE)):
+        _set_status(status, idx, STATUS_FORCE_CONTINUE)
+
+
+@only_if_module_is_available('mpi4py')
+def _reduce_status(comm, status, waiter=None, wake=None):
+    """
+    Combine the status bitmaps of all ranks with a bitwise or.
+
+    The reduction is non-blocking if MPI supports it, so ranks that are waiting for the others
+    sleep in waiter (or poll like _interruptible_barrier if there is no waiter) instead of
+    spinning in MPI. If waiter wakes up for anything but a timeout, wake is called.
+    """
+    result = array('L', [0] * len(status))
+    sendbuf = [status, MPI.UNSIGNED_LONG]
+    recvbuf = [result, MPI.UNSIGNED_LONG]
+    try:
+        request = comm.Iallreduce(sendbuf, recvbuf, op=MPI.BOR)
+    except (AttributeError, NotImplementedError):
+        _log.debug("No non-blocking allreduce available, using a blocking one")
+        comm.Allreduce(sendbuf, recvbuf, op=MPI.BOR)
+        return result
+
+    while not request.Test():
+        if waiter is None:
+            time.sleep(BARRIER_POLL_INTERVAL)
+        elif waiter.wait(STATUS_POLL_INTERVAL) != [WAKEUP_TIMEOUT] and wake is not None:
+            wake()
+    return result
+
+
+def _can_wake_master(comm):
+    """Whether comm supports the point-to-point messages for slaves to wake up the master"""
+    return comm.Get_size() > 1 and hasattr(comm, 'isend') and hasattr(comm, 'Iprobe')
+
+
+def _wake_master(comm, pending):
+    """
+    On a slave: ask the master for an early tick, without blocking. pending is the list of requests
+    of the messages sent before; no message is sent while the master did not get the previous one.
+    """
+    pending[:] = [request for request in pending if not request.Test()]
+    if not pending:
+        _log.debug("Asking the master for an early tick")
+        pending.append(comm.isend(None, dest=MASTERRANK, tag=WAKEUP_TAG))
+
+
+@only_if_module_is_available('mpi4py')
+def _master_woken(comm):
+    """On the master: consume the wakeup messages of the slaves. Returns True if there were any."""
+    woken = False
+    while comm.Iprobe(source=MPI.ANY_SOURCE, tag=WAKEUP_TAG):
+        comm.recv(source=MPI.ANY_SOURCE, tag=WAKEUP_TAG)
+        woken = True
+    return woken
+
+
+@only_if_module_is_available('mpi4py')
+def _end_wakeups(comm, pending):
+    """
+    Once all work is stopped: every slave sends one last message to the master and waits until
+    its messages are received (pending is its list of requests, see _wake_master); the master receives
+    until it has the last message of every slave. Messages of one rank are not overtaken, so
+    no wakeup message or request is left behind. Both poll, so signal handlers still run.
+    """
+    if comm.Get_rank() == MASTERRANK:
+        last = 0
+        while last < comm.Get_size() - 1:
+            if comm.Iprobe(source=MPI.ANY_SOURCE, tag=WAKEUP_TAG):
+                if comm.recv(source=MPI.ANY_SOURCE, tag=WAKEUP_TAG):
+                    last += 1
+            else:
+                time.sleep(BARRIER_POLL_INTERVAL)
+    else:
+        pending.append(comm.isend(True, dest=MASTERRANK, tag=WAKEUP_TAG))
+        for request in pending:
+            while not request.Test():
+                time.sleep(BARRIER_POLL_INTERVAL)
+        pending[:] = []
+
+
+def _master_wait(comm, waiter, remote):
+    """
+    On the master: wait for the next tick, i.e. until waiter wakes up, or, if remote is True,
+    until a slave asks for an early tick (checked every STATUS_POLL_INTERVAL seconds).
+    Returns the reasons for waking up.
+    """
+    if not remote:
+        return waiter.wait()
+    end = time.time() + waiter.interval
+    while True:
+        remaining = end - time.time()
+        reasons = waiter.wait(max(0, min(STATUS_POLL_INTERVAL, remaining)))
+        if _master_woken(comm):
+            reasons = [reason for reason in reasons if reason != WAKEUP_TIMEOUT] + [WAKEUP_SLAVE]
+        if reasons != [WAKEUP_TIMEOUT] or remaining <= STATUS_POLL_INTERVAL:
+            return reasons
+
+
 def master_template_opts(stub_config_opts=None):
     '''
     Generate template options for the master node.
@@ -143,7 +357,7 @@ def master_template_opts(stub_config_opts=None):
     If stub_config_opts is given, this function pulls the doctrings from the existing
     configuration
     '''
-    data_interface = node.sorted_network(node.get_networks())[0]
+    data_interface = node.node_inventory().data_network()
     master_dataname = data_interface.hostname
     master_dataaddress = data_interface.addr
     fqdn = socket.getfqdn()
@@ -157,26 +371,170 @@ def master_template_opts(stub_config_opts=None):
         ConfigTemplate('masterdataaddress', master_dataaddress, docs.get('masterdataaddress', '')),
         ]
  
+def _compress_ranks(ranks):
+    """Compress a list of ranks to a list of (first, last) tuples of consecutive ranks"""
+    runs = []
+    for rank in ranks:
+        if runs and runs[-1][1] == rank - 1:
+            runs[-1] = (runs[-1][0], rank)
+        else:
+            runs.append((rank, rank))
+    return runs
+
+
+def _expand_ranks(runs):
+    """Inverse of _compress_ranks"""
+    ranks = []
+    for first, last in runs:
+        ranks.extend(range(first, last + 1))
+    return ranks
+
+
+def _type_path(cls):
+    """Dotted path of a class, e.g. 'hod.work.config_service.ConfiguredService'"""
+    return '%s.%s' % (cls.__module__, cls.__name__)
+
+
+def _type_from_path(path):
+    """Look up the class for a dotted path made by _type_path"""
+    modname, clsname = path.rsplit('.', 1)
+    __import__(modname)
+    return getattr(sys.modules[modname], clsname)
+
+
+def _encode_task_table(master_template_kwargs, tasks, precfg=None):
+    """
+    Encode the master template args, the tasks and the hod.conf parsed by the master
+    (a PreServiceConfigOpts, if any) into a string for the slaves.
+
+    Values that are usually the same for all tasks (work type, ranks, master environment,
+    workdir, modules and master template args) are stored once and referred to by index.
+    """
+    shared = []
+
+    def _ref(value):
+        """Index of value in shared, adding it if needed"""
+        for idx, known in enumerate(shared):
+            if known == value:
+                return idx
+        shared.append(value)
+        return len(shared) - 1
+
+    entries = []
+    for task in tasks:
+        params = task.config_opts._replace(
+            workdir=_ref(task.config_opts.workdir),
+            modules=_ref(task.config_opts.modules),
+            master_template_kwargs=_ref(task.config_opts.master_template_kwargs),
+        )
+        entries.append((_ref(_type_path(task.type)), task.name, _ref(_compress_ranks(task.ranks)),
+                        _ref(task.master_env), tuple(params)))
+
+    table = (TASK_TABLE_VERSION, shared, _ref(master_template_kwargs), entries, precfg)
+    return cPickle.dumps(table, cPickle.HIGHEST_PROTOCOL)
+
+
+def _decode_task_table(data):
+    """
+    Decode a string made by _encode_task_table.
+    Returns the master template args, the tasks and the hod.conf parsed by the master.
+    """
+    table = cPickle.loads(data)
+    if table[0] != TASK_TABLE_VERSION:
+        raise ValueError("Task table has version %s, expected version %s" % (table[0], TASK_TABLE_VERSION))
+    _, shared, master_template_kwargs_ref, entries, precfg = table
+
+    types = dict()
+    tasks = []
+    for type_ref, name, ranks_ref, master_env_ref, values in entries:
+        if type_ref not in types:
+            types[type_ref] = _type_from_path(shared[type_ref])
+        params = ConfigOptsParams(*values)
+        params = params._replace(
+            workdir=shared[params.workdir],
+            modules=shared[params.modules],
+            master_template_kwargs=shared[params.master_template_kwargs],
+        )
+        tasks.append(Task(types[type_ref], name, _expand_ranks(shared[ranks_ref]), params, shared[master_env_ref]))
+    return shared[master_template_kwargs_ref], tasks, precfg
+
+
+def _gather_cluster_inventory(svc):
+    """
+    Gather a summary of the node of every rank on all ranks, so the autogenerated
+    configurations can take the whole cluster into account (see NodeInventory.set_cluster).
+    A rank that fails to probe its node is left out.
+    """
+    try:
+        summary = node.node_inventory().summary()
+    except Exception, err:
+        _log.error("Failed to probe the node of rank %d: %s", svc.rank, err)
+        summary = None
+    if svc.size > 1:
+        with timeline.span('allgather node inventory', timeline.CATEGORY_MPI):
+            summaries = svc.comm.allgather(summary)
+    else:
+        summaries = [summary]
+    summaries = [summary for summary in summaries if summary is not None]
+    if not summaries:
+        return
+    node.node_inventory().set_cluster(summaries)
+    if svc.rank == MASTERRANK:
+        cluster = node.cluster_info(summaries)
+        _log.info("Cluster of %d nodes with %d to %d cores and %d to %d bytes of memory",
+                  cluster['nodes'], cluster['min_cores'], cluster['max_cores'],
+                  cluster['min_memory'], cluster['max_memory'])
+
+
 def setup_tasks(svc):
-    """Setup the per node services and spread the tasks out."""
+    """
+    Setup the per node services and spread the tasks out.
+
+    All ranks first share a summary of their node, for the autogenerated configurations.
+    The master makes the distribution and sends it together with its template args and
+    the parsed hod.conf to the slaves in a single broadcast; the slaves then set up their
+    nodes with it, without parsing the configuration files again.
+    """
     _log.debug("No tasks found. Running distribution and spread.")
 
-    # Configure
+    _gather_cluster_inventory(svc)
+
     if svc.rank == MASTERRANK:
-        master_template_kwargs = master_template_opts()
-        _master_spread(svc.comm, master_template_kwargs)
+        try:
+            with timeline.span('master_template_opts'):
+                master_template_kwargs = master_template_opts()
+                svc.master_template_kwargs = master_template_kwargs
+            with timeline.span('distribution'):
+                svc.distribution(*master_template_kwargs)
+            # the distribution may redo them with the preferred data interfaces of hod.conf
+            master_template_kwargs = svc.master_template_kwargs
+            if svc.size > 1:
+                with timeline.span('encode task table'):
+                    data = _encode_task_table(master_template_kwargs, svc.tasks, svc.precfg)
+        except Exception:
+            # don't leave the slaves waiting for the tasks
+            if svc.size > 1:
+                svc.comm.bcast(None, root=MASTERRANK)
+            raise
+        if svc.size > 1:
+            start = time.time()
+            with timeline.span('bcast task table', timeline.CATEGORY_MPI, size=len(data)):
+                svc.comm.bcast(data, root=MASTERRANK)
+            _log.info("Spread %d tasks in a %d byte task table in %.3f seconds",
+                      len(svc.tasks), len(data), time.time() - start)
     else:
-        master_template_kwargs = _slave_spread(svc.comm)
+        with timeline.span('bcast task table', timeline.CATEGORY_MPI):
+            data = svc.comm.bcast(None, root=MASTERRANK)
+        if data is None:
+            raise RuntimeError("Master failed to set up the tasks")
+        with timeline.span('decode task table'):
+            master_template_kwargs, tasks, precfg = _decode_task_table(data)
+        with timeline.span('distribution'):
+            svc.distribution(*master_template_kwargs, precfg=precfg)
+        svc.master_template_kwargs = master_template_kwargs
+        svc.tasks = tasks
 
-    svc.distribution(*master_template_kwargs)
     _log.debug("Setup tasks on rank '%d': %s", svc.rank, svc.tasks)
-    barrier(svc.comm, "Setup tasks on rank '%d'" % svc.rank)
-
-    # Collect tasks
-    if svc.rank == MASTERRANK:
-        _master_spread(svc.comm, svc.tasks)
-    else:
-        svc.tasks = _slave_spread(svc.comm)
 
 
 def _mkconfigopts(cfg_opts):
@@ -189,52 +547,399 @@ def _mkconfigopts(cfg_opts):
     return ConfigOpts.from_params(cfg_opts, resolver)
 
 
+def _gather_timeline(svc):
+    """Gather the startup timelines of all ranks on the master, which writes them as a trace"""
+    timelines = svc.comm.gather(timeline.export(svc.rank), root=MASTERRANK)
+    if svc.rank != MASTERRANK:
+        return
+
+    _log.info("Startup critical path: %s", timeline.critical_path_summary(timelines))
+    if not svc.tasks:
+        return
+    trace_fn = mkpath(mklocalworkdir(svc.tasks[0].config_opts.workdir), timeline.TRACE_FILENAME)
+    try:
+        timeline.write_chrome_trace(timelines, trace_fn)
+        _log.info("Wrote startup timeline of %d ranks to %s", len(timelines), trace_fn)
+    except (IOError, OSError), err:
+        _log.error("Failed to write startup timeline to %s: %s", trace_fn, err)
+
+
+def _write_command_usage(svc):
+    """
+    On the master, merge the resource usage records of the commands that all ranks wrote to their
+    localworkdir, and log and write a table of the slowest commands of every service per rank.
+    The localworkdirs are in the shared workdir, so there is no MPI communication: this also works
+    while the job is torn down.
+    """
+    if svc.rank != MASTERRANK or not svc.tasks:
+        return
+
+    paths = []
+    for jobworkdir in sorted(set([mkjobworkdir(task.config_opts.workdir) for task in svc.tasks])):
+        paths.extend(sorted(glob.glob(mkpath(jobworkdir, '*', usage.USAGE_FILENAME))))
+    try:
+        records = usage.read_records(paths)
+    except (IOError, OSError), err:
+        _log.error("Failed to read resource usage of the commands: %s", err)
+        return
+    table = usage.summary_table(records)
+    _log.info("Slowest commands per service and rank:\n%s", '\n'.join(table))
+    summary_fn = mkpath(mklocalworkdir(svc.tasks[0].config_opts.workdir), usage.SUMMARY_FILENAME)
+    try:
+        fh = open(summary_fn, 'w')
+        try:
+            fh.write('\n'.join(table) + '\n')
+        finally:
+            fh.close()
+        _log.info("Wrote resource usage of %d commands to %s", len(records), summary_fn)
+    except (IOError, OSError), err:
+        _log.error("Failed to write resource usage of the commands to %s: %s", summary_fn, err)
+
+
+class Terminated(BaseException):
+    """
+    Raised in run_tasks when the job is killed, e.g. by qdel or when the walltime is reached.
+    Like KeyboardInterrupt, it is not an Exception so it is not swallowed by the work.
+    """
+    def __init__(self, signum, not_stopped=None):
+        BaseException.__init__(self, 'Terminated by signal %d' % signum)
+        self.signum = signum
+        # names of the tasks that did not stop within the teardown budget
+        self.not_stopped = not_stopped or []
+
+
+def _ignore_signal(signum, _):
+    """Signal handler for the signals that arrive during the teardown"""
+    _log.debug("Ignoring signal %d during teardown", signum)
+
+
+def _raise_terminated(signum, _):
+    """Signal handler to abort the startup or supervision of the work"""
+    # a second signal must not interrupt the teardown
+    # (not SIG_IGN, as that would be inherited by the stop scripts)
+    for termsig in TERMINATE_SIGNALS:
+        signal.signal(termsig, _ignore_signal)
+    raise Terminated(signum)
+
+
+def _stop_work(name, act_work):
+    """Stop the work, logging rather than raising errors"""
+    try:
+        act_work.do_work_stop()
+        act_work.work_end()
+    except Exception, err:
+        _log.exception("Failed to stop %s: %s", name, err)
+
+
+def _teardown(svc, task_work, started, phases, budget):
+    """
+    Stop the started work in reverse start order: all work of a phase is stopped at the same time
+    (on at most svc.max_workers threads), and all phases have to be done within budget seconds. The time left is shared by the phases
+    still to be stopped, so work that hangs in its stop script does not keep the work it depends on
+    from being stopped: the stop script is terminated when its time is up. The other ranks are torn down as well, so there is no MPI communication.
+    Returns the names of the tasks that did not stop in time.
+    """
+    _log.warn("Tearing down %d services on rank %s within %s seconds", len(started), svc.rank, budget)
+    start = time.time()
+    deadline = start + budget
+    stop_phases = [[idx for idx in phase if idx in started] for phase in reversed(phases)]
+    stop_phases = [phase for phase in stop_phases if phase]
+    not_stopped = []
+    # a fresh executor: the workers of the startup may be stuck in scripts that hang
+    executor = CommandExecutor(svc.max_workers, name='stop')
+    for phase_nr, phase in enumerate(stop_phases):
+        phase_deadline = time.time() + (deadline - time.time()) / (len(stop_phases) - phase_nr)
+        futures = [executor.submit(_stop_work, svc.tasks[idx].name, task_work[idx]) for idx in phase]
+        wait(futures, max(0, phase_deadline - time.time()))
+        for idx, future in zip(phase, futures):
+            if not future.done():
+                future.cancel()
+                not_stopped.append(svc.tasks[idx].name)
+    executor.shutdown(wait_for_calls=False)
+
+    if not_stopped:
+        _log.error("Services not stopped within the teardown budget of %s seconds on rank %s: %s",
+                   budget, svc.rank, ', '.join(not_stopped))
+    else:
+        _log.info("Stopped all services on rank %s in %.2f seconds", svc.rank, time.time() - start)
+    return not_stopped
+
+
+def _call_all(executor, calls):
+    """
+    Run the calls, (name, function) tuples, at the same time on the executor, each in a timeline
+    span with that name, and wait for all of them. Raises the first error after all calls are done.
+    """
+    futures = [executor.submit(_spanned, name, fn) for name, fn in calls]
+    wait(futures)
+    return [future.result() for future in futures]
+
+
+def _spanned(name, fn):
+    with timeline.span(name):
+        return fn()
+
+
+def _required_tasks(tasks):
+    """For every task, the indices of the tasks it requires (Requires=)"""
+    indices = dict()
+    for idx, task in enumerate(tasks):
+        indices.setdefault(task.name, []).append(idx)
+    required = []
+    for task in tasks:
+        deps = []
+        for name in task.config_opts.requires or []:
+            deps.extend(indices.get(name, []))
+        required.append(deps)
+    return required
+
+
+def _runs_until_end(tasks, phase):
+    """
+    Whether the start scripts of all work in phase have no timeout, i.e. they may run until
+    the job ends, like the script of 'hod batch'
+    """
+    return not [idx for idx in phase if tasks[idx].config_opts.timeout is not NO_TIMEOUT]
+
+
+def _start_work(svc, task_work, phases, started, executor=None, startup_done=None):
+    """
+    Start the work phase by phase; work within a phase is started at the same time on all ranks,
+    and on each rank the scripts of the work in a phase run concurrently on the executor.
+    The indices of the tasks are added to started when their work is started.
+
+    startup_done is called on all ranks when the startup is over: after the last phase, or before
+    it if that phase only has work that runs until the job ends (see _runs_until_end).
+
+    At the end of every phase, the ranks combine which work did not become ready (on any rank).
+    Work that requires such work, directly or through other work that is not started, is not
+    started on any rank. Returns the indices of the tasks that were not started.
+    """
+    if executor is None:
+        executor = CommandExecutor(svc.max_workers, name='start')
+    with timeline.span('start barrier', timeline.CATEGORY_MPI):
+        _interruptible_barrier(svc.comm, "Going to start work in %d phases on rank %s" % (len(phases), svc.rank))
+    startup_start = time.time()
+    required = _required_tasks(svc.tasks)
+    not_ready = set()
+    skipped = set()
+    for phase_nr, phase in enumerate(phases):
+        if startup_done is not None and phase_nr == len(phases) - 1 and _runs_until_end(svc.tasks, phase):
+            startup_done()
+            startup_done = None
+        phase_start = time.time()
+        # all ranks know the same not_ready, so they skip the same work
+        blocked = [idx for idx in phase if not_ready.union(skipped).intersection(required[idx])]
+        skipped.update(blocked)
+        phase_idx = [idx for idx in phase if idx in task_work and idx not in blocked]
+        _log.debug("Phase %d work on rank %s: %s", phase_nr, svc.rank, [task_work[idx] for idx in phase_idx])
+
+        _call_all(executor, [('pre_start %s' % svc.tasks[idx].name, task_work[idx].pre_start_work_service)
+                             for idx in phase_idx])
+        with timeline.span('phase %d pre-start barrier' % phase_nr, timeline.CATEGORY_MPI):
+            _interruptible_barrier(svc.comm, "Ran pre-start work of phase %d on rank %s" % (phase_nr, svc.rank))
+
+        started.extend(phase_idx)
+        _call_all(executor, [('start %s' % svc.tasks[idx].name, task_work[idx].start_work_service)
+                             for idx in phase_idx])
+        # dependent work is only started once this work is up
+        ready = _call_all(executor, [('ready %s' % svc.tasks[idx].name, task_work[idx].wait_ready_work_service)
+                                     for idx in phase_idx])
+        status = _mk_status(len(svc.tasks))
+        for idx, is_ready in zip(phase_idx, ready):
+            if is_ready is False:
+                _set_status(status, idx, STATUS_NOT_READY)
+        with timeline.span('phase %d start barrier' % phase_nr, timeline.CATEGORY_MPI):
+            _log.debug("Started work of phase %d on rank %s", phase_nr, svc.rank)
+            status = _reduce_status(svc.comm, status)
+        phase_not_ready = [idx for idx in phase if _get_status(status, idx, STATUS_NOT_READY)]
+        not_ready.update(phase_not_ready)
+
+        if svc.rank == MASTERRANK:
+            _log.info("Start phase %d/%d (%s) took %.2f seconds", phase_nr + 1, len(phases),
+                      ', '.join([svc.tasks[idx].name for idx in phase]), time.time() - phase_start)
+            if blocked:
+                _log.error("Start phase %d/%d: not starting %s, as services they require are not ready",
+                           phase_nr + 1, len(phases), ', '.join([svc.tasks[idx].name for idx in blocked]))
+            if phase_not_ready:
+                _log.error("Start phase %d/%d: %s did not become ready", phase_nr + 1, len(phases),
+                           ', '.join([svc.tasks[idx].name for idx in phase_not_ready]))
+    if svc.rank == MASTERRANK:
+        _log.info("Started all work in %.2f seconds", time.time() - startup_start)
+    if startup_done is not None:
+        startup_done()
+    return skipped
+
+
+def _supervise_work(svc, task_work, stopped, executor=None):
+    """
+    Wait for the work to be done and stop it; work that is done at the same time is stopped
+    concurrently on the executor. The indices of the tasks are added to stopped when their
+    work is stopped.
+
+    The master sets the pace of the ticks. A slave that wakes up for an event of its own work
+    (a child exited or a deadline passed) asks the master for an early tick, so the event is
+    seen on all ranks within about STATUS_POLL_INTERVAL seconds plus two status reductions,
+    rather than at the next regular tick (WAIT_ITER_SLEEP seconds, or LIVENESS_INTERVAL seconds
+    if there are liveness checks). MPI implementations without point-to-point messages (e.g.
+    hod.localmpi) only have the regular ticks.
+    """
+    if executor is None:
+        executor = CommandExecutor(svc.max_workers, name='supervise')
+    # all work is started now; wake up on child exit, control files or work deadlines,
+    # and often enough to run the liveness checks (of the work on any rank)
+    interval = WAIT_ITER_SLEEP
+    if [task for task in svc.tasks if task.config_opts.liveness_check]:
+        interval = min(interval, LIVENESS_INTERVAL)
+    waiter = Waiter(interval)
+    for act_work in task_work.values():
+        waiter.add_deadline(act_work.work_deadline())
+
+    # every rank looks at the control files in the controldir of the work it runs; the master
+    # also at those in its own controldir for work that does not run on it (e.g. as made by 'hod grow').
+    # the status reduction reports them to all ranks
+    controldirs = dict()
+    for idx, task in enumerate(svc.tasks):
+        if idx in task_work:
+            controldirs[idx] = task_work[idx].controldir
+        elif svc.rank == MASTERRANK:
+            controldirs[idx] = mkpath(mklocalworkdir(task.config_opts.workdir), 'controldir')
+        else:
+            continue
+        waiter.watch(controldirs[idx])
+        _log.info("Watching %s for control files of %s", controldirs[idx], task.name)
+    waiter.start()
+
+    remote = _can_wake_master(svc.comm)
+    if svc.size > 1 and not remote:
+        _log.debug("No point-to-point messages; events on the slaves are seen at the next tick of the master")
+    wake = None
+    pending = []
+    if remote and svc.rank != MASTERRANK:
+        wake = lambda: _wake_master(svc.comm, pending)
+    # the reduction after a slave asked for an early tick may still carry its old status,
+    # so the master does one more tick right away
+    early_ticks = 0
+
+    # every tick, the status of all work is combined with one reduction, so all ranks stop the same tasks
+    ntasks = len(svc.tasks)
+    try:
+        while len(stopped) < ntasks:
+            _log.debug("amount of active tasks %s", ntasks - len(stopped))
+            status = _mk_status(ntasks)
+            for idx, act_work in task_work.items():
+                if idx not in stopped and act_work.work_wait():
+                    _set_status(status, idx, STATUS_DONE)
+            for idx, controldir in controldirs.items():
+                if idx not in stopped:
+                    _check_control_files(controldir, status, idx)
+
+            status = _reduce_status(svc.comm, status, waiter, wake)
+
+            to_stop = []
+            for idx, task in enumerate(svc.tasks):
+                if idx in stopped:
+                    continue
+                if _get_status(status, idx, STATUS_FORCE_STOP):
+                    if svc.rank == MASTERRANK:
+                        _log.warn("Force stop detected for %s", task.name)
+                elif _get_status(status, idx, STATUS_DONE):
+                    if _get_status(status, idx, STATUS_FORCE_CONTINUE):
+                        if svc.rank == MASTERRANK:
+                            _log.warn("Force continue detected for %s", task.name)
+                        continue
+                else:
+                    continue
+
+                stopped.add(idx)
+                if idx in task_work:
+                    to_stop.append(idx)
+            _call_all(executor, [('stop %s' % svc.tasks[idx].name, task_work[idx].do_work_stop) for idx in to_stop])
+            _call_all(executor, [('end %s' % svc.tasks[idx].name, task_work[idx].work_end) for idx in to_stop])
+
+            # the master sets the pace of the ticks; the other ranks wait for it in _reduce_status,
+            # so they see events on the master (e.g. control files) right away
+            if len(stopped) < ntasks and svc.rank == MASTERRANK:
+                if early_ticks:
+                    early_ticks -= 1
+                    continue
+                _log.debug('Still %s active tasks left. waiting at most %s seconds', ntasks - len(stopped),
+                           interval)
+                reasons = _master_wait(svc.comm, waiter, remote)
+                _log.debug('Woke up: %s', ', '.join(reasons))
+                if WAKEUP_SLAVE in reasons:
+                    early_ticks = 1
+        # all ranks leave the loop at the same tick
+        if remote:
+            _end_wakeups(svc.comm, pending)
+    finally:
+        waiter.stop()
+
+
 @only_if_module_is_available('mpi4py')
 def run_tasks(svc):
-    """Make communicators for tasks and execute the work there"""
+    """
+    Make communicators for tasks and execute the work there.
+
+    When the job is killed (TERMINATE_SIGNALS), all started work on this rank is stopped within
+    svc.teardown_budget seconds and Terminated is raised.
+    """
     # Based on initial dist, create the groups and communicators and map with work
-    active_work = []
-    wait_iter_sleep = 60  # run through all active work, then wait wait_iter_sleep seconds
+    task_work = dict()
+    # runs the scripts of the work on this rank; shared by all work, so the number of scripts is bounded
+    executor = CommandExecutor(svc.max_workers, name='work')
+
+    with timeline.span('make communicators', timeline.CATEGORY_MPI):
+        comms = _make_comm_groups(svc.comm, [task.ranks for task in svc.tasks])
 
-    for task in svc.tasks:
+    for idx, task in enumerate(svc.tasks):
         # pass any existing previous work
-        _log.debug("newcomm  for ranks %s for work %s: %s", task.ranks, task.name, task.type)
-        newcomm = _make_comm_group(svc.comm, task.ranks)
+        newcomm = comms[tuple(task.ranks)]
+        _log.debug("newcomm %s for ranks %s for work %s: %s", newcomm, task.ranks, task.name, task.type)
 
         if newcomm == MPI.COMM_NULL:
             _log.debug('Skipping work setup for rank %d of this type %s', svc.rank, task.type)
             continue
 
         _log.debug('Setting up rank %d of this type %s', svc.rank, task.type)
-        svc.tempcomm.append(newcomm)
-        cfg = _mkconfigopts(task.config_opts)
-        work = task.type(cfg, task.master_env)
-        _log.debug("work %s begin", task.type.__name__)
-        work.prepare_work_cfg()
-        # adding started work
-        active_work.append(work)
-
-    for act_work in active_work:
-        _log.debug("work %s start", act_work.__class__.__name__)
-        act_work.do_work_start()
-
-    # all work is started now
-    while len(active_work):
-        _log.debug("amount of active work %s", len(active_work))
-        for act_work in active_work:
-
-            should_cleanup = act_work.do_work_wait()
-            if should_cleanup:
-                _log.debug("work %s stop", act_work.__class__.__name__)
-                act_work.do_work_stop()
-                _log.debug("work %s end", act_work.__class__.__name__)
-                act_work.work_end()
-
-                _log.debug("Removing %s from active_work", act_work)
-                active_work.remove(act_work)
-        if len(active_work):
-            _log.debug('Still %s active work left. sleeping %s seconds', len(active_work), wait_iter_sleep)
-            time.sleep(wait_iter_sleep)
+        # work on all ranks uses svc.comm itself, which stop_service ends separately
+        if newcomm != svc.comm and newcomm not in svc.tempcomm:
+            svc.tempcomm.append(newcomm)
+        with timeline.span('prepare %s' % task.name):
+            cfg = _mkconfigopts(task.config_opts)
+            work = task.type(cfg, task.master_env)
+            _log.debug("work %s begin", task.type.__name__)
+            work.prepare_work_cfg()
+        work.executor = executor
+        task_work[idx] = work
+
+    phases = service_start_phases([task.config_opts for task in svc.tasks])
+    started = []
+    stopped = set()
+    previous_handlers = [(signum, signal.signal(signum, _raise_terminated)) for signum in TERMINATE_SIGNALS]
+    try:
+        try:
+            # work that is not started is not waited for
+            # the timeline is gathered before the script of 'hod batch', which ends the job
+            stopped.update(_start_work(svc, task_work, phases, started, executor, lambda: _gather_timeline(svc)))
+            _supervise_work(svc, task_work, stopped, executor)
+            # wait until all ranks recorded the usage of their stop scripts
+            _interruptible_barrier(svc.comm, 'command usage')
+            _write_command_usage(svc)
+        except Terminated, err:
+            _log.warn("Received signal %d on rank %s", err.signum, svc.rank)
+            started = [idx for idx in started if idx not in stopped]
+            err.not_stopped = _teardown(svc, task_work, started, phases, svc.teardown_budget)
+            # the other ranks are torn down at the same time, so some of their stop scripts may be missing
+            try:
+                _write_command_usage(svc)
+            except Exception, usage_err:
+                _log.exception("Failed to write resource usage of the commands: %s", usage_err)
+            raise
+    finally:
+        for signum, handler in previous_handlers:
+            signal.signal(signum, handler)
+        executor.shutdown(wait_for_calls=False)
     _log.debug("No more active work left.")
 
 
@@ -252,8 +957,16 @@ class MpiService(object):
         self.rank = self.comm.Get_rank()
 
         self.tempcomm = []
+        # seconds to stop all work in when the job is killed
+        self.teardown_budget = TEARDOWN_BUDGET
+        # maximum number of scripts of the work on this rank that run at the same time
+        self.max_workers = MAX_WORKERS
 
         self.tasks = None
+        # hod.conf (PreServiceConfigOpts) as parsed by the master, before autogen
+        self.precfg = None
+        # template args of the master, as used in the distribution
+        self.master_template_kwargs = None
 
     def stop_service(self):
         """End all communicators"""
@@ -0,0 +1,102 @@
+# #
+# Copyright 2009-2015 Ghent University
+#
+# This file is part of hanythingondemand
+# originally created by the HPC team of Ghent University (http://ugent.be/hpc/en),
+# with support of Ghent University (http://ugent.be/hpc),
+# the Flemish Supercomputer Centre (VSC) (https://vscentrum.be/nl/en),
+# the Hercules foundation (http://www.herculesstichting.be/in_English)
+# and the Department of Economy, Science and Innovation (EWI) (http://www.ewi-vlaanderen.be/en).
+#
+# http://github.com/hpcugent/hanythingondemand
+#
+# hanythingondemand is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation v2.
+#
+# hanythingondemand is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with hanythingondemand. If not, see <http://www.gnu.org/licenses/>.
+# #
+"""
+Pinning commands to a set of cpus.
+"""
+import ctypes
+import ctypes.util
+import os
+import sys
+
+from vsc.utils.affinity import cpu_set_t
+
+from hod.node.numa import parse_cpulist
+
+_LIBC = ctypes.CDLL(ctypes.util.find_library('c') or 'libc.so.6', use_errno=True)
+
+# exec wrapper for pinned_command: pins itself to the cpus in argv[1] and executes argv[2:];
+# it only uses the standard library, so it starts quickly and works whatever the environment of the command
+_PIN_EXEC = '''
+import ctypes, os, sys
+cpus = [int(cpu) for cpu in sys.argv[1].split(',')]
+bits = 8 * ctypes.sizeof(ctypes.c_ulong)
+mask = (ctypes.c_ulong * max(16, max(cpus) // bits + 1))()
+for cpu in cpus:
+    mask[cpu // bits] |= 1 << (cpu % bits)
+if ctypes.CDLL(None, use_errno=True).sched_setaffinity(0, ctypes.sizeof(mask), mask) != 0:
+    sys.stderr.write("failed to run '%s': sched_setaffinity: %s\\n" % (sys.argv[-1], os.strerror(ctypes.get_errno())))
+    sys.exit(127)
+os.execv(sys.argv[2], sys.argv[2:])
+'''
+
+
+def parse_cpu_affinity(value):
+    """
+    Parse a list of cpu indices and ranges separated by spaces and/or commas,
+    as used by CPUAffinity=, into a sorted list of cpus.
+
+    >>> parse_cpu_affinity('0-1 8,9')
+    [0, 1, 8, 9]
+    """
+    cpus = set()
+    for token in value.replace(',', ' ').split():
+        cpus.update(parse_cpulist(token))
+    return sorted(cpus)
+
+
+def reserve_cores(usablecores, count):
+    """The count cores of usablecores that are reserved for daemons: the last ones."""
+    if count <= 0:
+        return []
+    return sorted(usablecores)[-count:]
+
+
+def cpu_mask(cpus):
+    """Make a cpu_set_t with the cpus in the list cpus, to pass to set_cpu_mask."""
+    bits = [0] * (max(cpus) + 1)
+    for cpu in cpus:
+        bits[cpu] = 1
+    mask = cpu_set_t()
+    mask.set_bits(bits)
+    return mask
+
+
+def pinned_command(command, cpus):
+    """
+    The argv to run the shell command line command (like Popen with shell=True) pinned to the list
+    of cpus. An exec wrapper sets the affinity before it executes the shell, rather than a preexec_fn,
+    which can deadlock in the child when other threads are running.
+    """
+    return [sys.executable, '-S', '-c', _PIN_EXEC, ','.join([str(cpu) for cpu in cpus]), '/bin/sh', '-c', command]
+
+
+def set_cpu_mask(mask):
+    """
+    Pin the calling process to the cpus in mask (see cpu_mask); raises OSError on failure.
+    This only calls into libc, so it can be used between fork and exec.
+    """
+    if _LIBC.sched_setaffinity(0, ctypes.sizeof(mask), ctypes.byref(mask)) != 0:
+        errno = ctypes.get_errno()
+        raise OSError(errno, 'sched_setaffinity: %s' % os.strerror(errno))
@@ -0,0 +1,192 @@
+# #
+# Copyright 2009-2015 Ghent University
+#
+# This file is part of hanythingondemand
+# originally created by the HPC team of Ghent University (http://ugent.be/hpc/en),
+# with support of Ghent University (http://ugent.be/hpc),
+# the Flemish Supercomputer Centre (VSC) (https://vscentrum.be/nl/en),
+# the Hercules foundation (http://www.herculesstichting.be/in_English)
+# and the Department of Economy, Science and Innovation (EWI) (http://www.ewi-vlaanderen.be/en).
+#
+# http://github.com/hpcugent/hanythingondemand
+#
+# hanythingondemand is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation v2.
+#
+# hanythingondemand is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with hanythingondemand. If not, see <http://www.gnu.org/licenses/>.
+# #
+"""
+Resource limits of the cgroups (v1 and v2) of the current process.
+
+Batch systems such as Torque put every job in its own cgroup. Its limits can be much
+tighter than what the node has, so they are taken into account when sizing the services.
+"""
+import math
+import os
+
+from vsc.utils import fancylogger
+
+_log = fancylogger.getLogger(fname=False)
+
+PROC_CGROUP = '/proc/self/cgroup'
+PROC_MOUNTINFO = '/proc/self/mountinfo'
+# cgroup v2 has a single hierarchy, registered under this name
+UNIFIED = ''
+# cgroup v1 reports 'no memory limit' as a huge (page aligned) number
+UNLIMITED_MEMORY = 2 ** 60
+
+
+def cgroup_dirs(proc_cgroup=PROC_CGROUP, proc_mountinfo=PROC_MOUNTINFO):
+    """
+    Return {controller: (mountpoint, path)} for the cgroups of the current process,
+    with path relative to mountpoint. The cgroup v2 hierarchy has UNIFIED as controller.
+    """
+    groups = {}
+    fh = open(proc_cgroup)
+    try:
+        for line in fh:
+            _, controllers, path = line.rstrip('\n').split(':', 2)
+            for controller in controllers.split(','):
+                groups[controller] = path
+    finally:
+        fh.close()
+
+    mounts = {}
+    fh = open(proc_mountinfo)
+    try:
+        for line in fh:
+            fields = line.split()
+            sep = fields.index('-')
+            root, mountpoint, fstype, superopts = fields[3], fields[4], fields[sep + 1], fields[sep + 3]
+            if fstype == 'cgroup2':
+                mounts[UNIFIED] = (root, mountpoint)
+            elif fstype == 'cgroup':
+                for opt in superopts.split(','):
+                    if opt in groups:
+                        mounts[opt] = (root, mountpoint)
+    finally:
+        fh.close()
+
+    dirs = {}
+    for controller, path in groups.items():
+        if controller in mounts:
+            root, mountpoint = mounts[controller]
+            # the mount only shows part of the hierarchy (e.g. in a container)
+            if root != '/' and (path == root or path.startswith(root + '/')):
+                path = path[len(root):]
+            dirs[controller] = (mountpoint, path.strip('/'))
+    return dirs
+
+
+def _hierarchy(mountpoint, path):
+    """The directory of the cgroup at path and those of its ancestors, up to mountpoint."""
+    dirs = []
+    while path:
+        dirs.append(os.path.join(mountpoint, path))
+        path = os.path.dirname(path)
+    dirs.append(mountpoint)
+    return dirs
+
+
+def _read(path):
+    """Contents of the cgroup file at path, or None if there is no such file."""
+    try:
+        fh = open(path)
+        try:
+            return fh.read().strip()
+        finally:
+            fh.close()
+    except IOError:
+        return None
+
+
+def _tightest(dirs, filename, parse):
+    """Smallest of the limits in filename in the cgroup directories dirs; None if there are none."""
+    limits = []
+    for directory in dirs:
+        value = _read(os.path.join(directory, filename))
+        if value:
+            limit = parse(value)
+            if limit is not None:
+                limits.append(limit)
+    if limits:
+        return min(limits)
+    return None
+
+
+def _parse_memory(value):
+    """Parse memory.limit_in_bytes (v1) or memory.max (v2)"""
+    if value == 'max':
+        return None
+    limit = int(value)
+    if limit >= UNLIMITED_MEMORY:
+        return None
+    return limit
+
+
+def _cpus(quota, period):
+    """Number of cpus that a cpu bandwidth quota per period allows (rounded up)"""
+    if quota <= 0 or period <= 0:
+        return None
+    return int(math.ceil(float(quota) / period))
+
+
+def _parse_cpu_max(value):
+    """Parse cpu.max (v2): '<quota> <period>' or 'max <period>'"""
+    quota, period = value.split()
+    if quota == 'max':
+        return None
+    return _cpus(int(quota), int(period))
+
+
+def memory_limit(dirs):
+    """Memory limit in bytes of the cgroups in dirs (see cgroup_dirs), None if there is none."""
+    limits = []
+    if 'memory' in dirs:
+        limits.append(_tightest(_hierarchy(*dirs['memory']), 'memory.limit_in_bytes', _parse_memory))
+    if UNIFIED in dirs:
+        limits.append(_tightest(_hierarchy(*dirs[UNIFIED]), 'memory.max', _parse_memory))
+    limits = [limit for limit in limits if limit is not None]
+    if limits:
+        return min(limits)
+    return None
+
+
+def cpu_limit(dirs):
+    """Number of cpus the cpu quota of the cgroups in dirs allows, None if there is no quota."""
+    limits = []
+    if 'cpu' in dirs:
+        for directory in _hierarchy(*dirs['cpu']):
+            quota = _read(os.path.join(directory, 'cpu.cfs_quota_us'))
+            period = _read(os.path.join(directory, 'cpu.cfs_period_us'))
+            if quota and period:
+                limits.append(_cpus(int(quota), int(period)))
+    if UNIFIED in dirs:
+        limits.append(_tightest(_hierarchy(*dirs[UNIFIED]), 'cpu.max', _parse_cpu_max))
+    limits = [limit for limit in limits if limit is not None]
+    if limits:
+        return min(limits)
+    return None
+
+
+def get_cgroup_limits(proc_cgroup=PROC_CGROUP, proc_mountinfo=PROC_MOUNTINFO):
+    """
+    Return the limits of the cgroups of the current process as a dict with
+    'memory' (in bytes) and 'cpus'; a limit is None if there is none.
+    """
+    limits = dict(memory=None, cpus=None)
+    try:
+        dirs = cgroup_dirs(proc_cgroup, proc_mountinfo)
+        limits['memory'] = memory_limit(dirs)
+        limits['cpus'] = cpu_limit(dirs)
+    except (IOError, OSError, ValueError, IndexError), err:
+        _log.debug("Failed to determine the cgroup limits: %s", err)
+    _log.debug("cgroup limits: %s", limits)
+    return limits
@@ -29,15 +29,23 @@ Network utilities
 @author: Ewan Higgs (Ghent University)
 @author: Kenneth Hoste (Ghent University)
 """
+import fnmatch
+import json
 import re
 import os
 import socket
+import tempfile
+import threading
+import time
 from collections import namedtuple
 
 from vsc.utils import fancylogger
 from vsc.utils.affinity import sched_getaffinity
 
 from hod.commands.command import ULimit
+from hod.node.cgroup import get_cgroup_limits
+from hod.node.numa import get_numa_topology, numa_binding, numa_nodes_in_use, numactl_available
+from hod.timeline import monotonic, span, timed
 from hod.utils import only_if_module_is_available
 
 # optional packages, not always required
@@ -48,9 +56,30 @@ except ImportError:
     pass
 
 
-NetworkInterface = namedtuple('NetworkInterface', 'hostname,addr,device,mask_bits')
+_NetworkInterface = namedtuple('NetworkInterface', 'hostname,addr,device,mask_bits,speed,mtu,operstate,rdma')
+
+
+class NetworkInterface(_NetworkInterface):
+    """
+    A network interface: its hostname, address, device name and the number of bits in its netmask,
+    plus its link speed in Mbit/s, mtu and operstate (None if unknown) and whether it supports RDMA.
+    """
+    __slots__ = ()
+
+    def __new__(cls, hostname, addr, device, mask_bits, speed=None, mtu=None, operstate=None, rdma=False):
+        return _NetworkInterface.__new__(cls, hostname, addr, device, mask_bits, speed, mtu, operstate, rdma)
+
+
 _log = fancylogger.getLogger(fname=False)
 
+SYSFS_NET = '/sys/class/net'
+SYSFS_INFINIBAND = '/sys/class/infiniband'
+
+DNS_TIMEOUT = 5 # seconds to wait for all reverse lookups of the interfaces
+DNS_CACHE_TTL = 3600 # seconds to keep a resolved hostname in the cache
+DNS_NEGATIVE_CACHE_TTL = 300 # seconds to keep a failed lookup in the cache
+DNS_CACHE_FILENAME = 'hod-dns-cache-%d.json'
+
 
 @only_if_module_is_available('netaddr')
 def netmask2maskbits(netmask):
@@ -59,22 +88,216 @@ def netmask2maskbits(netmask):
     return bin(mask_as_int).count('1')
 
 
+def dns_cache_path():
+    """
+    Path of the reverse DNS cache of the current user. It lives in the
+    (node local) temporary directory so all ranks on a node share it.
+    """
+    return os.path.join(tempfile.gettempdir(), DNS_CACHE_FILENAME % os.getuid())
+
+
+def _load_dns_cache(path, now):
+    """Read the unexpired entries {addr: [hostname, expires]} from the cache file at path."""
+    try:
+        if os.stat(path).st_uid != os.getuid():
+            _log.warning("Ignoring DNS cache %s: not owned by the current user", path)
+            return {}
+        fh = open(path)
+        try:
+            cache = json.load(fh)
+        finally:
+            fh.close()
+    except (IOError, OSError, ValueError), err:
+        _log.debug("No usable DNS cache %s: %s", path, err)
+        return {}
+
+    fresh = {}
+    if isinstance(cache, dict):
+        for addr, entry in cache.items():
+            try:
+                hostname, expires = entry
+            except (TypeError, ValueError):
+                continue
+            if expires > now:
+                fresh[addr] = [hostname, expires]
+    return fresh
+
+
+def _save_dns_cache(path, cache):
+    """Atomically replace the cache file at path; failing to write the cache is not fatal."""
+    tmppath = '%s.%d' % (path, os.getpid())
+    try:
+        fd = os.open(tmppath, os.O_WRONLY | os.O_CREAT | os.O_EXCL, 0600)
+        fh = os.fdopen(fd, 'w')
+        try:
+            json.dump(cache, fh)
+        finally:
+            fh.close()
+        os.rename(tmppath, path)
+    except (IOError, OSError), err:
+        _log.warning("Failed to write DNS cache %s: %s", path, err)
+        try:
+            os.unlink(tmppath)
+        except OSError:
+            pass
+
+
+def resolve_hostnames(addrs, timeout=DNS_TIMEOUT, cache_path=None):
+    """
+    Look up the fully qualified hostnames of addrs and return them as a dict
+    {addr: hostname}.
+
+    Addresses missing from the cache are resolved at the same time, each
+    in its own thread. Lookups that fail or do not finish within timeout
+    seconds fall back to the address itself. The results are cached for
+    DNS_CACHE_TTL seconds (DNS_NEGATIVE_CACHE_TTL for failed lookups) so
+    all ranks on a node do not hit the resolver again.
+    """
+    if cache_path is None:
+        cache_path = dns_cache_path()
+
+    now = time.time()
+    cache = _load_dns_cache(cache_path, now)
+    todo = sorted(set([addr for addr in addrs if addr not in cache]))
+
+    results = {}
+    def lookup(addr):
+        """Resolve addr; socket.getfqdn returns addr itself when the lookup fails."""
+        results[addr] = socket.getfqdn(addr)
+
+    threads = []
+    for addr in todo:
+        thread = threading.Thread(target=lookup, args=(addr,), name='getfqdn-%s' % addr)
+        thread.daemon = True
+        thread.start()
+        threads.append(thread)
+
+    deadline = now + timeout
+    for thread in threads:
+        thread.join(max(0, deadline - time.time()))
+
+    for addr in todo:
+        hostname = results.get(addr)
+        if hostname is None:
+            _log.warning("Reverse lookup of %s did not finish within %ss, using the address", addr, timeout)
+            hostname = addr
+        if hostname == addr:
+            expires = now + DNS_NEGATIVE_CACHE_TTL
+        else:
+            expires = now + DNS_CACHE_TTL
+        cache[addr] = [hostname, expires]
+
+    if todo:
+        _save_dns_cache(cache_path, cache)
+
+    return dict([(addr, cache[addr][0]) for addr in addrs])
+
+
+def _read_sysfs(path):
+    """Contents of the sysfs file at path, None if it can't be read (e.g. the speed of a link that is down)"""
+    try:
+        fh = open(path)
+        try:
+            return fh.read().strip()
+        finally:
+            fh.close()
+    except (IOError, OSError):
+        return None
+
+
+def _read_sysfs_int(path):
+    """Integer in the sysfs file at path, None if it can't be read"""
+    try:
+        return int(_read_sysfs(path))
+    except (TypeError, ValueError):
+        return None
+
+
+def _listdir(path):
+    """Entries of the directory at path, an empty list if there is no such directory"""
+    try:
+        return os.listdir(path)
+    except OSError:
+        return []
+
+
+def _infiniband_rate(rate):
+    """
+    Parse the rate of an infiniband port into Mbit/s.
+
+    >>> _infiniband_rate('100 Gb/sec (4X EDR)')
+    100000
+    """
+    match = re.match(r'^\s*(\d+(?:\.\d+)?)\s*Gb/sec', rate or '')
+    if match:
+        return int(float(match.group(1)) * 1000)
+    return None
+
+
+def get_rdma_devices(sysfs_infiniband=None):
+    """
+    Return a dict mapping the names of the network devices backed by an RDMA capable adapter
+    (IPoIB and RoCE) to the highest rate (in Mbit/s) of the ports of that adapter (or None).
+    """
+    if sysfs_infiniband is None:
+        sysfs_infiniband = SYSFS_INFINIBAND
+    devices = {}
+    for hca in _listdir(sysfs_infiniband):
+        ports = os.path.join(sysfs_infiniband, hca, 'ports')
+        rates = [_infiniband_rate(_read_sysfs(os.path.join(ports, port, 'rate'))) for port in _listdir(ports)]
+        rates = [rate for rate in rates if rate]
+        rate = max(rates or [None])
+        netdevs = set(_listdir(os.path.join(sysfs_infiniband, hca, 'device', 'net')))
+        for port in _listdir(ports):
+            ndevs = os.path.join(ports, port, 'gid_attrs', 'ndevs')
+            for idx in _listdir(ndevs):
+                netdevs.add(_read_sysfs(os.path.join(ndevs, idx)))
+        for netdev in netdevs:
+            if netdev:
+                devices[netdev] = max(devices.get(netdev), rate)
+    return devices
+
+
+def get_link_info(device, rdma_devices, sysfs_net=None):
+    """
+    Return the speed (in Mbit/s), mtu and operstate of the network device and whether it supports
+    RDMA (see get_rdma_devices). Values that are unknown are None.
+    """
+    if sysfs_net is None:
+        sysfs_net = SYSFS_NET
+    path = os.path.join(sysfs_net, device)
+    speed = _read_sysfs_int(os.path.join(path, 'speed'))
+    if speed is not None and speed <= 0:
+        speed = None
+    rdma = device in rdma_devices
+    if speed is None and rdma:
+        speed = rdma_devices[device]
+    return speed, _read_sysfs_int(os.path.join(path, 'mtu')), _read_sysfs(os.path.join(path, 'operstate')), rdma
+
+
 @only_if_module_is_available('netifaces')
-def get_networks():
+def get_networks(cache_path=None):
     """
     Returns list of NetworkInterface tuples by interface.
-    Of the form: [hostname, ipaddr, iface, subnetmask]
+    Of the form: [hostname, ipaddr, iface, subnetmask, speed, mtu, operstate, rdma]
+
+    The hostnames are looked up with resolve_hostnames, using the DNS cache
+    at cache_path (see dns_cache_path).
     """
     devices = netifaces.interfaces()
-    networks = []
+    interfaces = []
     for device in devices:
         iface = netifaces.ifaddresses(device)
         if netifaces.AF_INET in iface:
             iface = iface[netifaces.AF_INET][0]
-            addr = iface['addr']
-            mask_bits = netmask2maskbits(iface['netmask'])
-            hostname = socket.getfqdn(addr)
-            networks.append(NetworkInterface(hostname, addr, device, mask_bits))
+            interfaces.append((iface['addr'], device, netmask2maskbits(iface['netmask'])))
+
+    hostnames = resolve_hostnames([addr for addr, _, _ in interfaces], cache_path=cache_path)
+    rdma_devices = get_rdma_devices()
+    networks = []
+    for addr, device, mask_bits in interfaces:
+        speed, mtu, operstate, rdma = get_link_info(device, rdma_devices)
+        networks.append(NetworkInterface(hostnames[addr], addr, device, mask_bits, speed, mtu, operstate, rdma))
     return networks
 
 
@@ -111,53 +334,63 @@ def ip_interface_to(networks, ip):
     return None
 
 
-def sorted_network(network):
-    """Try to find a preferred network (can be advanced like IPoIB of high-speed ethernet)"""
-    nw = []
-    _log.debug("Preferred network selection")
-    # step 1 alphabetical ordering (who knows in what order ip returns the addresses) on hostname field
-    network.sort()
+def _preference(intf, preferred):
+    """
+    Index of the first pattern in preferred that intf matches, None if it matches none.
+    A pattern is a device name (shell style wildcards are allowed), e.g. ib1 or enp*,
+    or a network, e.g. 10.141.0.0/16.
+    """
+    for idx, pattern in enumerate(preferred):
+        if '/' in pattern:
+            try:
+                if address_in_network(intf.addr, pattern):
+                    return idx
+            except Exception, err: # netaddr raises its own errors on invalid networks
+                _log.warning("Ignoring invalid network %s in the preferred data interfaces: %s", pattern, err)
+        elif fnmatch.fnmatchcase(intf.device, pattern):
+            return idx
+    return None
+
+
+def sorted_network(network, preferred=None):
+    """
+    Sort the network interfaces so the preferred one (used for the data traffic) comes first.
+
+    Interfaces that match the patterns in preferred (see _preference) come first, in the order
+    of the patterns. Next are the interfaces that have a hostname assigned and are neither
+    loopback, VLAN or down, then the remaining non-loopback interfaces and finally the loopback
+    interfaces. Within each group, the interfaces are ranked by link speed, RDMA support and mtu;
+    when those are unknown, infiniband interfaces come first.
+    """
+    if preferred is None:
+        preferred = []
+    _log.debug("Preferred network selection (preferred interfaces: %s)", preferred)
 
     # filter for interfaces which have not been assigned hostnames
     ip_hostname = re.compile(r"^\d+\.\d+\.\d+\.\d+$")
-
-    # look for ib network
     ib_reg = re.compile(r"^(ib)\d+$")
-    for intf in network:
-        if ib_reg.search(intf.device) and not ip_hostname.search(intf.hostname):
-            if not intf in nw:
-                _log.debug("Added intf %s as ib interface", str(intf))
-                nw.append(intf)
-
-    # final selection prefer non-vlan
     vlan_reg = re.compile(r"^(.*)\.\d+$")
     loopback_reg = re.compile(r"^(lo)\d*$")
-    for intf in network:
-        if not (vlan_reg.search(intf.device) or 
-                loopback_reg.search(intf.device) or
-                ip_hostname.search(intf.hostname)):
-            if not intf in nw:
-                _log.debug("Added intf %s as non-vlan or non-loopback interface",
-                        str(intf))
-                nw.append(intf)
-
-    # add remainder non-loopback
-    for intf in network:
-        if not loopback_reg.search(intf.device):
-            if not intf in nw:
-                _log.debug("Added intf %s as remaining non-loopback interface",
-                        str(intf))
-                nw.append(intf)
-
-    # add remainder
-    for intf in network:
-        if not intf in nw:
-            _log.debug("Added intf %s as remaining interface",
-                    str(intf))
-            nw.append(intf)
-
-    _log.debug("ordered network %s",
-            nw)
+
+    def _group(intf):
+        """Group of the interface, see above"""
+        preference = _preference(intf, preferred)
+        if preference is not None:
+            return (0, preference)
+        if loopback_reg.search(intf.device):
+            return (3, 0)
+        if (ip_hostname.search(intf.hostname) or vlan_reg.search(intf.device) or
+                (intf.operstate or '').lower() == 'down'):
+            return (2, 0)
+        return (1, 0)
+
+    def _rank(intf):
+        """Sort key: group first, then capability; the tuple itself keeps the order stable"""
+        return (_group(intf), -(intf.speed or 0), not intf.rdma, -(intf.mtu or 0),
+                not ib_reg.search(intf.device), intf)
+
+    nw = sorted(network, key=_rank)
+    _log.debug("ordered network %s", nw)
     return nw
 
 
@@ -207,13 +440,102 @@ def _get_memory_ulimit_v():
         return int(stdout) * 1024
 
 
-def get_memory():
-    """Extract information about the available memory"""
+def get_memory(cgroup_limits=None):
+    """
+    Extract information about the available memory.
+    The memory limit of the cgroup (in bytes, or "unlimited") is taken from
+    cgroup_limits (see get_cgroup_limits), which is probed if not given.
+    """
+    if cgroup_limits is None:
+        cgroup_limits = get_cgroup_limits()
     memory = {}
     memory['meminfo'] = _get_memory_proc_meminfo()
     memory['ulimit'] = _get_memory_ulimit_v()
+    memory['cgroup'] = cgroup_limits['memory'] or 'unlimited'
     return memory
 
+
+def _get_pbs_num_ppn():
+    """Number of cores per node the job requested from PBS, None if unknown"""
+    try:
+        return int(os.environ['PBS_NUM_PPN'])
+    except (KeyError, ValueError):
+        return None
+
+
+def get_cpu_limits(usablecores, cgroup_limits):
+    """
+    Return the number of cores that may be used: the tightest of the cpuset/affinity
+    (usablecores), the cpu quota of the cgroup and $PBS_NUM_PPN; and the individual limits.
+    """
+    limits = {
+        'affinity': len(usablecores),
+        'cgroup': cgroup_limits['cpus'],
+        'pbs_num_ppn': _get_pbs_num_ppn(),
+    }
+    cores = min([limit for limit in limits.values() if limit])
+    return cores, limits
+
+
+def memory_limit(memory):
+    """The tightest of the total memory, the cgroup limit and the ulimit in a memory dict (see get_memory)"""
+    limits = [memory['meminfo']['memtotal']]
+    for name in ('cgroup', 'ulimit'):
+        limit = memory.get(name, 'unlimited')
+        if limit != 'unlimited':
+            limits.append(int(limit))
+    return min(limits)
+
+
+def node_summary(node_info):
+    """
+    A compact description of a node (as returned by Node.go) to send to the other ranks:
+    everything but the pid, with the network interfaces reduced to (device, addr, speed, rdma)
+    and the memory to the total memory and the limits that memory_limit uses.
+    """
+    summary = dict([(key, node_info[key]) for key in
+                    ('fqdn', 'cores', 'usablecores', 'totalcores', 'cpulimits', 'topology')])
+    memory = node_info['memory']
+    summary['memory'] = dict([(name, memory[name]) for name in ('cgroup', 'ulimit') if name in memory])
+    summary['memory']['meminfo'] = {'memtotal': memory['meminfo']['memtotal']}
+    summary['interfaces'] = [(intf.device, intf.addr, intf.speed, intf.rdma) for intf in node_info['network']]
+    return summary
+
+
+def prefer_summary_interfaces(summary, preferred):
+    """
+    The node summary (see node_summary) with the interfaces that match the patterns in preferred
+    first, in the order of the patterns, as sorted_network does; the other interfaces keep their order.
+    """
+    def _rank(item):
+        idx, (device, addr, _, _) = item
+        preference = _preference(_NetworkInterface(None, addr, device, None, None, None, None, None), preferred)
+        if preference is None:
+            return (1, 0, idx)
+        return (0, preference, idx)
+
+    summary = dict(summary)
+    summary['interfaces'] = [intf for _, intf in sorted(enumerate(summary['interfaces']), key=_rank)]
+    return summary
+
+
+def cluster_info(summaries):
+    """
+    Aggregate the node summaries (see node_summary) of all ranks: the number of nodes, the
+    smallest and largest number of cores and memory limit (see memory_limit) and the summaries.
+    """
+    cores = [summary['cores'] for summary in summaries]
+    memory = [memory_limit(summary['memory']) for summary in summaries]
+    return {
+        'nodes': len(summaries),
+        'min_cores': min(cores),
+        'max_cores': max(cores),
+        'min_memory': min(memory),
+        'max_memory': max(memory),
+        'members': summaries,
+    }
+
+
 class Node(object):
     """Detect localnode properties"""
     def __init__(self):
@@ -225,25 +547,34 @@ class Node(object):
         self.cores = -1
         self.usablecores = None
         self.totalcores = None
+        self.cpulimits = {}
 
-        self.topology = [0] # default topology plain set
+        self.topology = [] # NUMA nodes, see get_numa_topology
 
         self.memory = {}
 
     def __str__(self):
         return "FQDN %s PID %s" % (self.fqdn, self.pid)
 
-    def go(self):
-        """A wrapper around some common functions"""
+    @timed('Node.go')
+    def go(self, network=None):
+        """
+        A wrapper around some common functions.
+        An already sorted network can be passed to avoid probing it again.
+        """
         self.fqdn = socket.getfqdn()
-        self.network = sorted_network(get_networks())
+        if network is None:
+            network = sorted_network(get_networks())
+        self.network = network
 
         self.pid = os.getpid()
+        cgroup_limits = get_cgroup_limits()
         self.usablecores = [idx for idx, used in enumerate(sched_getaffinity().cpus) if used]
-        self.cores = len(self.usablecores)
+        self.cores, self.cpulimits = get_cpu_limits(self.usablecores, cgroup_limits)
         self.totalcores = os.sysconf('SC_NPROCESSORS_ONLN')
+        self.topology = get_numa_topology()
 
-        self.memory = get_memory()
+        self.memory = get_memory(cgroup_limits)
 
         descr = {
             'fqdn': self.fqdn,
@@ -252,7 +583,146 @@ class Node(object):
             'cores': self.cores,
             'usablecores': self.usablecores,
             'totalcores': self.totalcores,
+            'cpulimits': self.cpulimits,
             'topology': self.topology,
             'memory': self.memory,
         }
         return descr
+
+
+class NodeInventory(object):
+    """
+    Properties of the local node, probed lazily and at most once.
+    Use node_inventory() to get the one shared by the whole process.
+    """
+    def __init__(self):
+        self.log = fancylogger.getLogger(name=self.__class__.__name__, fname=False)
+        self._lock = threading.RLock()
+        self._interfaces = None
+        self._preferred = []
+        self._usable_cores = None
+        self._numa_nodes = None
+        self._node_info = None
+        self._cluster = None
+
+    def set_cluster(self, summaries):
+        """
+        Set the node summaries (see node_summary) of all nodes in the job, in rank order.
+        Their aggregates are added to the node info as 'cluster' (see cluster_info).
+        """
+        self._lock.acquire()
+        try:
+            self._cluster = list(summaries)
+        finally:
+            self._lock.release()
+
+    def summary(self):
+        """A compact description of this node to send to the other ranks (see node_summary)."""
+        return node_summary(self.node_info())
+
+    def prefer_interfaces(self, preferred):
+        """Set the patterns of the interfaces to prefer for the data traffic (see sorted_network)."""
+        self._lock.acquire()
+        try:
+            self._preferred = list(preferred)
+        finally:
+            self._lock.release()
+
+    def network(self):
+        """The network interfaces of this node, preferred interface first (see sorted_network)."""
+        self._lock.acquire()
+        try:
+            if self._interfaces is None:
+                start = monotonic()
+                with span('NodeInventory.network'):
+                    self._interfaces = get_networks()
+                self.log.info("Probed %d network interfaces in %.2fs", len(self._interfaces), monotonic() - start)
+            return sorted_network(self._interfaces, self._preferred)
+        finally:
+            self._lock.release()
+
+    def data_network(self):
+        """The preferred network interface of this node, used for the data traffic."""
+        return self.network()[0]
+
+    def usable_cores(self):
+        """The cores this process may run on (its cpu affinity)."""
+        self._lock.acquire()
+        try:
+            if self._usable_cores is None:
+                self._usable_cores = [idx for idx, used in enumerate(sched_getaffinity().cpus) if used]
+            return list(self._usable_cores)
+        finally:
+            self._lock.release()
+
+    def numa_nodes(self):
+        """The NUMA nodes (see get_numa_topology) with cores this process may use."""
+        self._lock.acquire()
+        try:
+            if self._numa_nodes is None:
+                self._numa_nodes = numa_nodes_in_use(get_numa_topology(), self.usable_cores())
+            return list(self._numa_nodes)
+        finally:
+            self._lock.release()
+
+    def numa_binding(self):
+        """
+        numactl command prefix binding a command to the NUMA nodes in use, or an
+        empty string if the node is not a NUMA system or numactl is not available.
+        """
+        node_ids = [numa_node['node'] for numa_node in self.numa_nodes()]
+        if len(get_numa_topology()) > 1 and node_ids and numactl_available():
+            return numa_binding(node_ids)
+        return ''
+
+    def node_info(self):
+        """
+        The description of this node, as returned by Node.go, plus the aggregates of
+        all nodes in the job as 'cluster' (see cluster_info); if those were not set
+        with set_cluster, this node is taken to be the whole cluster.
+        The interfaces are in the order of the current preference (see prefer_interfaces),
+        also when they were probed or gathered before it was set.
+        """
+        self._lock.acquire()
+        try:
+            if self._node_info is None:
+                network = self.network()
+                start = monotonic()
+                self._node_info = Node().go(network=network)
+                self.log.info("Probed node in %.2fs: %s", monotonic() - start, self._node_info)
+            info = dict(self._node_info)
+            info['network'] = self.network()
+            if self._cluster:
+                info['cluster'] = cluster_info([prefer_summary_interfaces(summary, self._preferred)
+                                                for summary in self._cluster])
+            else:
+                info['cluster'] = cluster_info([node_summary(info)])
+            return info
+        finally:
+            self._lock.release()
+
+
+_inventory = None
+_inventory_lock = threading.Lock()
+
+
+def node_inventory():
+    """Return the NodeInventory of this process, creating it on first use."""
+    global _inventory
+    _inventory_lock.acquire()
+    try:
+        if _inventory is None:
+            _inventory = NodeInventory()
+        return _inventory
+    finally:
+        _inventory_lock.release()
+
+
+def reset_node_inventory():
+    """Forget the probed node properties, so they are probed again on next use."""
+    global _inventory
+    _inventory_lock.acquire()
+    try:
+        _inventory = None
+    finally:
+        _inventory_lock.release()
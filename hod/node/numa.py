@@ -0,0 +1,118 @@
+# #
+# Copyright 2009-2015 Ghent University
+#
+# This file is part of hanythingondemand
+# originally created by the HPC team of Ghent University (http://ugent.be/hpc/en),
+# with support of Ghent University (http://ugent.be/hpc),
+# the Flemish Supercomputer Centre (VSC) (https://vscentrum.be/nl/en),
+# the Hercules foundation (http://www.herculesstichting.be/in_English)
+# and the Department of Economy, Science and Innovation (EWI) (http://www.ewi-vlaanderen.be/en).
+#
+# http://github.com/hpcugent/hanythingondemand
+#
+# hanythingondemand is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation v2.
+#
+# hanythingondemand is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with hanythingondemand. If not, see <http://www.gnu.org/licenses/>.
+# #
+"""
+NUMA topology of the local node, from /sys/devices/system/node.
+"""
+import os
+import re
+
+from vsc.utils import fancylogger
+
+_log = fancylogger.getLogger(fname=False)
+
+SYSFS_NODE = '/sys/devices/system/node'
+NUMACTL = 'numactl'
+
+_NODE_DIR = re.compile(r'^node(\d+)$')
+_MEMTOTAL = re.compile(r'^Node\s+\d+\s+MemTotal:\s*(\d+)\s*kB', re.M)
+
+
+def parse_cpulist(cpulist):
+    """
+    Parse a cpu list as used by sysfs and cpusets into a list of cpu ids.
+
+    >>> parse_cpulist('0-3,8,10-11')
+    [0, 1, 2, 3, 8, 10, 11]
+    """
+    cpus = []
+    for part in cpulist.strip().split(','):
+        if not part:
+            continue
+        if '-' in part:
+            first, last = part.split('-')
+            cpus.extend(range(int(first), int(last) + 1))
+        else:
+            cpus.append(int(part))
+    return cpus
+
+
+def get_numa_topology(sysfs=SYSFS_NODE):
+    """
+    Return the NUMA nodes as a list of dicts with the id of the 'node', its 'cpus'
+    and its 'memory' in bytes (None if unknown), sorted by id.
+    An empty list is returned if the topology is not available.
+    """
+    try:
+        names = os.listdir(sysfs)
+    except OSError, err:
+        _log.debug("No NUMA topology in %s: %s", sysfs, err)
+        return []
+
+    topology = []
+    for name in names:
+        match = _NODE_DIR.match(name)
+        if not match:
+            continue
+        path = os.path.join(sysfs, name)
+        try:
+            cpus = parse_cpulist(open(os.path.join(path, 'cpulist')).read())
+        except (IOError, ValueError), err:
+            _log.debug("Failed to read the cpus of NUMA node %s: %s", path, err)
+            continue
+        memory = None
+        try:
+            memtotal = _MEMTOTAL.search(open(os.path.join(path, 'meminfo')).read())
+            if memtotal:
+                memory = int(memtotal.group(1)) * 1024
+        except IOError, err:
+            _log.debug("Failed to read the memory of NUMA node %s: %s", path, err)
+        topology.append(dict(node=int(match.group(1)), cpus=cpus, memory=memory))
+
+    topology.sort(key=lambda numa_node: numa_node['node'])
+    _log.debug("NUMA topology: %s", topology)
+    return topology
+
+
+def numa_nodes_in_use(topology, usablecores):
+    """The NUMA nodes of topology that have at least one of the usablecores"""
+    usable = set(usablecores)
+    return [numa_node for numa_node in topology if usable.intersection(numa_node['cpus'])]
+
+
+def numactl_available():
+    """Whether numactl can be found in $PATH"""
+    for path in os.environ.get('PATH', '').split(os.pathsep):
+        if path and os.access(os.path.join(path, NUMACTL), os.X_OK):
+            return True
+    return False
+
+
+def numa_binding(node_ids):
+    """
+    Command prefix that binds a command to the cpus and memory of the NUMA nodes node_ids,
+    e.g. 'numactl --cpunodebind=0 --membind=0'.
+    """
+    nodes = ','.join([str(node_id) for node_id in node_ids])
+    return '%s --cpunodebind=%s --membind=%s' % (NUMACTL, nodes, nodes)
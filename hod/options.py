@@ -52,6 +52,18 @@ RESOURCE_MANAGER_OPTIONS = {
     'account': ("Account name (empty string is default Account)", "string", "store", "", "A"),
 }
 
+# seconds to stop all work when the job is killed; keep it below the kill delay of the resource manager
+TEARDOWN_BUDGET = 60
+
+# options of the processes that run the services (hod.local and the grow job), which the
+# subcommands that submit them pass on
+SERVICE_OPTIONS = {
+    'teardown-budget': ("Seconds to stop all services in when the job is killed (qdel, walltime); "
+                        "should be less than the kill delay of the resource manager", 'int', 'store', TEARDOWN_BUDGET),
+    'spawn-helper': ("Start the service scripts from a small helper process that is forked before "
+                     "MPI is initialized", None, 'store_true', False),
+}
+
 _log = fancylogger.getLogger('create', fname=False)
 
 def validate_required_option(options):
@@ -42,6 +42,8 @@ class HodJob(Job):
     """Hanything on demand job"""
 
     OPTION_IGNORE_PREFIX = ['job', 'action']
+    # appended to the job name
+    NAME_SUFFIX = ''
 
     def __init__(self, options):
         super(HodJob, self).__init__(options)
@@ -60,7 +62,7 @@ class HodJob(Job):
         label = self.options.options.label
         if label is None:
             label = 'job'
-        options_dict['job']['name'] = "%s_%s" % (self.name_prefix, label)
+        options_dict['job']['name'] = "%s_%s%s" % (self.name_prefix, label, self.NAME_SUFFIX)
 
         self.type = self.type_class(options_dict['job'])
 
@@ -87,6 +89,8 @@ class HodJob(Job):
 class MympirunHod(HodJob):
     """Hod type job using mympirun cmd style."""
     OPTION_IGNORE_PREFIX = ['job', 'action', 'mympirun']
+    # module that is run by mympirun
+    MAIN_MODULE = 'hod.local'
 
     def generate_exe(self):
         """Mympirun executable"""
@@ -104,7 +108,7 @@ class MympirunHod(HodJob):
 
         main.append('--variablesprefix=%s' % ','.join(self.hodenvvarprefix))
 
-        main.append("%s -m hod.local" % self.pythonexe)
+        main.append("%s -m %s" % (self.pythonexe, self.MAIN_MODULE))
 
         main.extend(self.hodargs)
 
@@ -136,3 +140,23 @@ class PbsHodJob(MympirunHod):
         """Set the typeclass"""
         self.log.debug("Using default class Pbs.")
         self.type_class = Pbs
+
+
+class PbsHodGrowJob(MympirunHod):
+    """PbsHodJob type job that adds its nodes to a running cluster, see hod.grow"""
+    NAME_SUFFIX = '_grow'
+    MAIN_MODULE = 'hod.growjob'
+
+    def __init__(self, options, grow_info):
+        super(PbsHodGrowJob, self).__init__(options)
+
+        # the modules of the cluster, as the master loaded them
+        self.modules = [options.options.hod_module]
+        for module in grow_info.get('modules', []):
+            self.log.debug("Adding '%s' module to startup script.", module)
+            self.modules.append(module)
+
+    def set_type_class(self):
+        """Set the typeclass"""
+        self.log.debug("Using default class Pbs.")
+        self.type_class = Pbs
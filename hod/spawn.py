@@ -0,0 +1,423 @@
+# #
+# Copyright 2009-2015 Ghent University
+#
+# This file is part of hanythingondemand
+# originally created by the HPC team of Ghent University (http://ugent.be/hpc/en),
+# with support of Ghent University (http://ugent.be/hpc),
+# the Flemish Supercomputer Centre (VSC) (https://vscentrum.be/nl/en),
+# the Hercules foundation (http://www.herculesstichting.be/in_English)
+# and the Department of Economy, Science and Innovation (EWI) (http://www.ewi-vlaanderen.be/en).
+#
+# http://github.com/hpcugent/hanythingondemand
+#
+# hanythingondemand is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation v2.
+#
+# hanythingondemand is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with hanythingondemand. If not, see <http://www.gnu.org/licenses/>.
+# #
+"""
+Spawn helper: a small process that starts the commands of hod.commands.command.Command
+on behalf of the process that runs the services.
+
+Forking the hod.local process once MPI is initialized is slow (its memory is large and
+registered with the interconnect) and not safe with some InfiniBand verbs libraries.
+The spawn helper is forked before mpi4py initializes MPI, so it stays small; Command hands
+it the command, environment and working directory over a socket, and the helper reports
+the pid and, when it exits, the exit status back. The output of a command reaches the
+caller through named pipes the caller creates, since Python 2 can't pass file descriptors
+over a socket.
+
+The helper ignores SIGTERM and SIGINT, so the stop scripts can still be started when the
+job is killed; it exits when the process that started it closes the socket.
+
+Importing fancylogger imports mpi4py.MPI, which initializes MPI; so this module only imports
+the standard library (and hod.commands.usage) up front, and fancylogger once the helper runs.
+"""
+import atexit
+import cPickle
+import errno
+import fcntl
+import os
+import select
+import shutil
+import signal
+import socket
+import struct
+import tempfile
+import threading
+import traceback
+
+from hod.commands.usage import returncode, rusage_fields
+
+# command line option of hod.local and hod.growjob that enables the spawn helper; it has to be
+# started before MPI is initialized, so long before the options are parsed
+SPAWN_HELPER_OPTION = '--spawn-helper'
+
+# seconds between checks while waiting, so signal handlers run in the waiting thread
+WAIT_INTERVAL = 0.1
+# exit status reported for commands whose exit status got lost with the spawn helper
+LOST_RETURNCODE = -1
+
+_HEADER = struct.Struct('!I')
+
+_client = None
+
+
+def _log():
+    """The logger, see the module docstring"""
+    from vsc.utils import fancylogger
+    return fancylogger.getLogger(fname=False)
+
+
+class SpawnError(Exception):
+    """The spawn helper failed to start a command"""
+    pass
+
+
+def _send(sock, msg):
+    data = cPickle.dumps(msg, cPickle.HIGHEST_PROTOCOL)
+    sock.sendall(_HEADER.pack(len(data)) + data)
+
+
+def _recv_exact(sock, size):
+    chunks = []
+    while size:
+        try:
+            chunk = sock.recv(size)
+        except socket.error, err:
+            if err.errno == errno.EINTR:
+                continue
+            raise
+        if not chunk:
+            return None
+        chunks.append(chunk)
+        size -= len(chunk)
+    return ''.join(chunks)
+
+
+def _recv(sock):
+    """Receive a message sent with _send; returns None on EOF"""
+    header = _recv_exact(sock, _HEADER.size)
+    if header is None:
+        return None
+    data = _recv_exact(sock, _HEADER.unpack(header)[0])
+    if data is None:
+        return None
+    return cPickle.loads(data)
+
+
+def _wait(event):
+    """Wait for event; with a timeout in the main thread, so signal handlers run while waiting"""
+    if isinstance(threading.current_thread(), threading._MainThread):
+        while not event.is_set():
+            event.wait(WAIT_INTERVAL)
+    else:
+        event.wait()
+
+
+def _maxfd():
+    try:
+        return os.sysconf('SC_OPEN_MAX')
+    except (AttributeError, ValueError, OSError):
+        return 256
+
+
+def _spawn(command, env, cwd, out_path, err_path, cpus=None):
+    """
+    Start command with /bin/sh (like Popen with shell=True), with its output to the named pipes,
+    pinned to the list of cpus if given
+    """
+    from hod.node.affinity import cpu_mask, set_cpu_mask
+
+    mask = None
+    if cpus:
+        mask = cpu_mask(cpus)
+    # the caller opened the read ends, so this does not block
+    out_fd = os.open(out_path, os.O_WRONLY)
+    try:
+        err_fd = os.open(err_path, os.O_WRONLY)
+    except OSError:
+        os.close(out_fd)
+        raise
+    try:
+        pid = os.fork()
+        if pid == 0:
+            try:
+                os.dup2(out_fd, 1)
+                os.dup2(err_fd, 2)
+                os.closerange(3, _maxfd())
+                for signum in (signal.SIGTERM, signal.SIGINT, signal.SIGCHLD):
+                    signal.signal(signum, signal.SIG_DFL)
+                signal.set_wakeup_fd(-1)
+                if cwd:
+                    os.chdir(cwd)
+                if mask is not None:
+                    set_cpu_mask(mask)
+                os.execve('/bin/sh', ['/bin/sh', '-c', command], env)
+            except BaseException, err:
+                try:
+                    os.write(2, "spawn helper: failed to run '%s': %s\n" % (command, err))
+                finally:
+                    os._exit(127)
+    finally:
+        os.close(out_fd)
+        os.close(err_fd)
+    return pid
+
+
+def _reap(sock):
+    """Report the exit status and resource usage of all children that exited"""
+    while True:
+        try:
+            pid, status, rusage = os.wait3(os.WNOHANG)
+        except OSError, err:
+            if err.errno == errno.EINTR:
+                continue
+            # ECHILD: no children
+            return
+        if pid == 0:
+            return
+        _send(sock, ('exit', pid, (returncode(status), rusage_fields(rusage))))
+
+
+def _serve(sock):
+    """Main loop of the spawn helper"""
+    # hod.node.affinity imports fancylogger, which should not initialize MPI in the helper
+    os.environ['FANCYLOGGER_IGNORE_MPI4PY'] = '1'
+    for signum in (signal.SIGTERM, signal.SIGINT):
+        signal.signal(signum, signal.SIG_IGN)
+    # wake up the select below when a child exits
+    wake_r, wake_w = os.pipe()
+    for fd in (wake_r, wake_w):
+        fcntl.fcntl(fd, fcntl.F_SETFL, fcntl.fcntl(fd, fcntl.F_GETFL) | os.O_NONBLOCK)
+    signal.set_wakeup_fd(wake_w)
+    signal.signal(signal.SIGCHLD, lambda signum, frame: None)
+
+    while True:
+        try:
+            ready = select.select([sock, wake_r], [], [])[0]
+        except select.error, err:
+            if err.args[0] != errno.EINTR:
+                raise
+            ready = []
+        if wake_r in ready:
+            try:
+                os.read(wake_r, 4096)
+            except OSError:
+                pass
+        _reap(sock)
+
+        if sock in ready:
+            request = _recv(sock)
+            if request is None:
+                return
+            req_id, command, env, cwd, out_path, err_path, cpus = request
+            try:
+                _send(sock, ('spawned', req_id, _spawn(command, env, cwd, out_path, err_path, cpus)))
+            except OSError, err:
+                _send(sock, ('error', req_id, str(err)))
+
+
+class SpawnedProcess(object):
+    """The part of the subprocess.Popen interface that Command uses, for a command started by the spawn helper"""
+    def __init__(self, client, pid, stdout, stderr):
+        self._client = client
+        self.pid = pid
+        self.stdout = stdout
+        self.stderr = stderr
+        self.returncode = None
+        # resource usage as reported by the spawn helper, see hod.commands.usage.rusage_fields
+        self.usage = dict()
+
+    def poll(self):
+        if self.returncode is None:
+            self.returncode, self.usage = self._client.poll(self.pid)
+        return self.returncode
+
+    def wait(self):
+        if self.returncode is None:
+            self.returncode, self.usage = self._client.wait(self.pid)
+        return self.returncode
+
+
+class SpawnClient(object):
+    """Connection to a spawn helper; can be used from several threads"""
+    def __init__(self, sock, pid):
+        self.sock = sock
+        self.pid = pid
+        self.alive = True
+        self._closing = False
+        self._lock = threading.Lock()
+        self._next_id = 0
+        # req_id -> [event, reply] and pid -> [event, returncode]
+        self._requests = dict()
+        self._exits = dict()
+        self._fifodir = tempfile.mkdtemp(prefix='hod-spawn-')
+        self._reader = threading.Thread(target=self._read, name='spawn-helper')
+        self._reader.daemon = True
+        self._reader.start()
+
+    def spawn(self, command, env=None, cwd=None, cpus=None):
+        """
+        Start command (a shell command line) in the spawn helper, pinned to the list of cpus
+        if given; returns a SpawnedProcess
+        """
+        if env is None:
+            env = dict(os.environ)
+        if cwd is None:
+            cwd = os.getcwd()
+        with self._lock:
+            req_id = self._next_id
+            self._next_id += 1
+            request = [threading.Event(), None]
+            self._requests[req_id] = request
+
+        paths = [os.path.join(self._fifodir, '%d.%s' % (req_id, name)) for name in ('out', 'err')]
+        fds = []
+        try:
+            for path in paths:
+                os.mkfifo(path, 0600)
+                fds.append(os.open(path, os.O_RDONLY | os.O_NONBLOCK))
+            with self._lock:
+                if not self.alive:
+                    raise SpawnError("spawn helper is not running")
+                _send(self.sock, (req_id, command, env, cwd, paths[0], paths[1], cpus))
+            _wait(request[0])
+            kind, value = request[1]
+            if kind != 'spawned':
+                raise SpawnError(value)
+        except (socket.error, OSError), err:
+            for fd in fds:
+                os.close(fd)
+            raise SpawnError(str(err))
+        except SpawnError:
+            for fd in fds:
+                os.close(fd)
+            raise
+        finally:
+            with self._lock:
+                del self._requests[req_id]
+            for path in paths:
+                if os.path.exists(path):
+                    os.unlink(path)
+
+        for fd in fds:
+            fcntl.fcntl(fd, fcntl.F_SETFL, fcntl.fcntl(fd, fcntl.F_GETFL) & ~os.O_NONBLOCK)
+        return SpawnedProcess(self, value, os.fdopen(fds[0], 'rb'), os.fdopen(fds[1], 'rb'))
+
+    def poll(self, pid):
+        """Return the exit status and resource usage of process pid, or (None, {}) if it is still running"""
+        with self._lock:
+            event, result = self._exits[pid]
+            if event.is_set():
+                del self._exits[pid]
+        return result or (None, dict())
+
+    def wait(self, pid):
+        """Wait for process pid to exit and return its exit status and resource usage"""
+        _wait(self._exits[pid][0])
+        return self.poll(pid)
+
+    def close(self):
+        """Stop the spawn helper; the commands it started keep running"""
+        if self.sock is None:
+            return
+        self._closing = True
+        try:
+            self.sock.shutdown(socket.SHUT_RDWR)
+        except socket.error:
+            pass
+        self.sock.close()
+        self.sock = None
+        try:
+            os.waitpid(self.pid, 0)
+        except OSError:
+            pass
+        shutil.rmtree(self._fifodir, ignore_errors=True)
+
+    def _read(self):
+        """Handle the messages of the spawn helper"""
+        try:
+            while True:
+                msg = _recv(self.sock)
+                if msg is None:
+                    break
+                kind, key, value = msg
+                with self._lock:
+                    if kind == 'exit':
+                        entry = self._exits.get(key)
+                        if entry is not None:
+                            entry[1] = value
+                            entry[0].set()
+                        continue
+                    if kind == 'spawned':
+                        self._exits[value] = [threading.Event(), None]
+                    request = self._requests.get(key)
+                if request is not None:
+                    request[1] = (kind, value)
+                    request[0].set()
+        except (socket.error, EOFError, cPickle.UnpicklingError), err:
+            _log().debug("Reading from spawn helper failed: %s", err)
+
+        with self._lock:
+            self.alive = False
+            if not self._closing:
+                _log().error("Spawn helper (pid %s) exited; exit status of %d running commands is lost",
+                           self.pid, len(self._exits))
+            for request in self._requests.values():
+                request[1] = ('error', "spawn helper exited")
+                request[0].set()
+            for entry in self._exits.values():
+                if not entry[0].is_set():
+                    entry[1] = (LOST_RETURNCODE, dict())
+                    entry[0].set()
+
+
+def start_spawn_helper():
+    """Fork the spawn helper (once); call this before MPI is initialized"""
+    global _client
+    if _client is not None:
+        return _client
+    parent, child = socket.socketpair()
+    pid = os.fork()
+    if pid == 0:
+        status = 0
+        try:
+            parent.close()
+            _serve(child)
+        except BaseException:
+            traceback.print_exc()
+            status = 1
+        os._exit(status)
+    child.close()
+    _client = SpawnClient(parent, pid)
+    atexit.register(stop_spawn_helper)
+    _log().debug("Started spawn helper with pid %s", pid)
+    return _client
+
+
+def start_spawn_helper_if_requested(argv):
+    """Start the spawn helper if SPAWN_HELPER_OPTION is in the command line arguments argv"""
+    if SPAWN_HELPER_OPTION in argv:
+        start_spawn_helper()
+
+
+def stop_spawn_helper():
+    global _client
+    if _client is not None:
+        _client.close()
+        _client = None
+
+
+def spawn_client():
+    """Return the SpawnClient for the running spawn helper, or None if there is none"""
+    if _client is not None and _client.alive:
+        return _client
+    return None
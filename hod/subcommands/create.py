@@ -36,7 +36,7 @@ from vsc.utils import fancylogger
 from vsc.utils.generaloption import GeneralOption
 
 from hod import VERSION as HOD_VERSION
-from hod.options import GENERAL_HOD_OPTIONS, RESOURCE_MANAGER_OPTIONS, validate_pbs_option
+from hod.options import GENERAL_HOD_OPTIONS, RESOURCE_MANAGER_OPTIONS, SERVICE_OPTIONS, validate_pbs_option
 from hod.rmscheduler.hodjob import PbsHodJob
 from hod.subcommands.subcommand import SubCommand
 
@@ -64,6 +64,7 @@ class CreateOptions(GeneralOption):
         opts.update({
             'modules': ("Extra modules to load in each service environment", 'string', 'store', None),
         })
+        opts.update(copy.deepcopy(SERVICE_OPTIONS))
         descr = ["Create configuration", "Configuration options for the 'create' subcommand"]
 
         self.log.debug("Add config option parser descr %s opts %s", descr, opts)
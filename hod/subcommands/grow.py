@@ -0,0 +1,107 @@
+# #
+# Copyright 2009-2015 Ghent University
+#
+# This file is part of hanythingondemand
+# originally created by the HPC team of Ghent University (http://ugent.be/hpc/en),
+# with support of Ghent University (http://ugent.be/hpc),
+# the Flemish Supercomputer Centre (VSC) (https://vscentrum.be/nl/en),
+# the Hercules foundation (http://www.herculesstichting.be/in_English)
+# and the Department of Economy, Science and Innovation (EWI) (http://www.ewi-vlaanderen.be/en).
+#
+# http://github.com/hpcugent/hanythingondemand
+#
+# hanythingondemand is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation v2.
+#
+# hanythingondemand is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with hanythingondemand. If not, see <http://www.gnu.org/licenses/>.
+# #
+"""
+Add nodes to a running hod cluster.
+"""
+import copy
+import sys
+
+from vsc.utils import fancylogger
+from vsc.utils.generaloption import GeneralOption
+
+from hod import VERSION as HOD_VERSION
+from hod.cluster import cluster_grow_info
+from hod.options import GENERAL_HOD_OPTIONS, RESOURCE_MANAGER_OPTIONS, SERVICE_OPTIONS
+from hod.rmscheduler.hodjob import PbsHodGrowJob
+from hod.subcommands.subcommand import SubCommand
+
+
+_log = fancylogger.getLogger('grow', fname=False)
+
+
+class GrowOptions(GeneralOption):
+    """Option parser for 'grow' subcommand."""
+    VERSION = HOD_VERSION
+    ALLOPTSMANDATORY = False # let us use optionless arguments.
+
+    def resource_manager_options(self):
+        """Add configuration options for job being submitted."""
+        opts = copy.deepcopy(RESOURCE_MANAGER_OPTIONS)
+        descr = ["Resource manager / Scheduler",
+                 "Provide resource manager/scheduler related options (eg number of nodes)"]
+        prefix = 'job'
+
+        self.log.debug("Add resourcemanager option parser prefix %s descr %s opts %s", prefix, descr, opts)
+        self.add_group_parser(opts, descr, prefix=prefix)
+
+    def config_options(self):
+        """Add general configuration options."""
+        opts = dict([(name, copy.deepcopy(GENERAL_HOD_OPTIONS[name])) for name in ['hod-module', 'label']])
+        opts.update(copy.deepcopy(SERVICE_OPTIONS))
+        descr = ["Grow configuration", "Configuration options for the 'grow' subcommand"]
+
+        self.log.debug("Add config option parser descr %s opts %s", descr, opts)
+        self.add_group_parser(opts, descr)
+
+
+class GrowSubCommand(SubCommand):
+    """
+    Implementation of 'grow' subcommand.
+    The job that is submitted runs the services of the slaves of the cluster on its nodes.
+    """
+    CMD = 'grow'
+    EXAMPLE = "<label> --job-nodes=<number of nodes> --hod-module=<hanythingondemand module>"
+    HELP = "Submit a job that adds nodes to a running cluster"
+
+    def run(self, args):
+        """Run 'grow' subcommand."""
+        optparser = GrowOptions(go_args=args, envvar_prefix=self.envvar_prefix, usage=self.usage_txt)
+        if len(optparser.args) > 1:
+            optparser.options.label = optparser.args[1]
+        label = optparser.options.label
+        if label is None:
+            _log.error("No label provided.")
+            return 1
+        if not optparser.options.hod_module:
+            _log.error('No hod-module ("--hod-module") provided')
+            return 1
+
+        try:
+            grow_info = cluster_grow_info(label)
+        except (ValueError, IOError) as err:
+            _log.error("Cluster '%s' can not be grown (is it running?): %s", label, err)
+            return 1
+
+        try:
+            j = PbsHodGrowJob(optparser, grow_info)
+            print "Submitting job to grow HOD cluster with label '%s'..." % label
+            j.run()
+            jobs = j.state()
+            print "Jobs submitted: %s" % [str(j) for j in jobs]
+            return 0
+        except StandardError as e:
+            fancylogger.setLogFormat(fancylogger.TEST_LOGGING_FORMAT)
+            fancylogger.logToScreen(enable=True)
+            _log.raiseException(e.message)
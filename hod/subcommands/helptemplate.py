@@ -34,7 +34,7 @@ import hod.config.template as hct
 from hod import VERSION as HOD_VERSION
 from hod.subcommands.subcommand import SubCommand
 from hod.mpiservice import master_template_opts
-from hod.config.config import ConfigOptsParams
+from hod.config.config import ConfigOptsParams, READY_TIMEOUT, RESTART_LIMIT, RESTART_NO
 from hod.commands.command import COMMAND_TIMEOUT
 
 
@@ -47,7 +47,10 @@ def mk_registry():
     """Make a TemplateRegistry and register basic items"""
     config_opts = ConfigOptsParams('svc-name', 'MASTER', 'ExecPreStart', 'ExecStart', 'ExecStop',
                                    dict(), workdir='WORKDIR', modules=['MODULES'], master_template_kwargs=[],
-                                   timeout=COMMAND_TIMEOUT)
+                                   timeout=COMMAND_TIMEOUT, after=None, requires=None,
+                                   ready_check='', ready_timeout=READY_TIMEOUT,
+                                   restart=RESTART_NO, restart_limit=RESTART_LIMIT, liveness_check='',
+                                   cpu_affinity=None, reserved_cores=0)
     reg = hct.TemplateRegistry()
     hct.register_templates(reg, config_opts)
     master_template_kwargs = master_template_opts(reg.fields.values())
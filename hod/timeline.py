@@ -0,0 +1,224 @@
+# #
+# Copyright 2009-2015 Ghent University
+#
+# This file is part of hanythingondemand
+# originally created by the HPC team of Ghent University (http://ugent.be/hpc/en),
+# with support of Ghent University (http://ugent.be/hpc),
+# the Flemish Supercomputer Centre (VSC) (https://vscentrum.be/nl/en),
+# the Hercules foundation (http://www.herculesstichting.be/in_English)
+# and the Department of Economy, Science and Innovation (EWI) (http://www.ewi-vlaanderen.be/en).
+#
+# http://github.com/hpcugent/hanythingondemand
+#
+# hanythingondemand is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation v2.
+#
+# hanythingondemand is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with hanythingondemand. If not, see <http://www.gnu.org/licenses/>.
+# #
+"""
+Timeline of the startup phases of a rank, to find out where the startup time goes.
+
+Phases are recorded with monotonic timestamps using the span context manager or the timed
+decorator. At the end of the startup, run_tasks gathers the timelines of all ranks on the
+master, which writes them as a Chrome trace (chrome://tracing, https://ui.perfetto.dev) and
+logs a summary of the slowest phases.
+"""
+import json
+import os
+import socket
+import threading
+import time
+from contextlib import contextmanager
+from functools import wraps
+
+from vsc.utils import fancylogger
+
+_log = fancylogger.getLogger(fname=False)
+
+CLOCK_MONOTONIC = 1
+CATEGORY_STARTUP = 'startup'
+CATEGORY_MPI = 'mpi'
+TRACE_FILENAME = 'startup-trace.json'
+# number of phases in the critical path summary
+SUMMARY_PHASES = 5
+
+# recorded phases of this process: (name, category, start, end, args, thread index)
+_events = []
+# threads that recorded phases, in the order they did: {thread ident: (thread index, thread name)}
+_threads = {}
+_threads_lock = threading.Lock()
+
+
+def _clock_gettime():
+    """Return clock_gettime from libc or librt if available, None otherwise."""
+    try:
+        import ctypes
+        import ctypes.util
+
+        class _Timespec(ctypes.Structure):
+            _fields_ = [('tv_sec', ctypes.c_long), ('tv_nsec', ctypes.c_long)]
+
+        for libname in ('c', 'rt'):
+            path = ctypes.util.find_library(libname)
+            if path is None:
+                continue
+            lib = ctypes.CDLL(path, use_errno=True)
+            if hasattr(lib, 'clock_gettime'):
+                fn = lib.clock_gettime
+                fn.argtypes = [ctypes.c_int, ctypes.POINTER(_Timespec)]
+
+                def _gettime(clock):
+                    tspec = _Timespec()
+                    if fn(clock, ctypes.byref(tspec)) != 0:
+                        raise OSError(ctypes.get_errno(), 'clock_gettime failed')
+                    return tspec.tv_sec + tspec.tv_nsec * 1e-9
+                _gettime(CLOCK_MONOTONIC)
+                return _gettime
+    except (ImportError, OSError, AttributeError):
+        pass
+    return None
+
+
+_GETTIME = _clock_gettime()
+
+
+def monotonic():
+    """Seconds on a monotonic clock; falls back to time.time if there is none."""
+    if _GETTIME is None:
+        return time.time()
+    return _GETTIME(CLOCK_MONOTONIC)
+
+
+def _thread_index():
+    """Small index of the calling thread, so phases of concurrent threads end up on their own track"""
+    thread = threading.current_thread()
+    _threads_lock.acquire()
+    try:
+        if thread.ident not in _threads:
+            _threads[thread.ident] = (len(_threads), thread.name)
+        return _threads[thread.ident][0]
+    finally:
+        _threads_lock.release()
+
+
+def record(name, start, end, category=CATEGORY_STARTUP, **args):
+    """Record a phase of the calling thread that ran from start to end (monotonic timestamps)"""
+    _events.append((name, category, start, end, args, _thread_index()))
+
+
+@contextmanager
+def span(name, category=CATEGORY_STARTUP, **args):
+    """Record the time spent in the with block as a phase"""
+    start = monotonic()
+    try:
+        yield
+    finally:
+        record(name, start, monotonic(), category, **args)
+
+
+def timed(name, category=CATEGORY_STARTUP):
+    """Decorator recording each call of the function as a phase"""
+    def _decorator(fn):
+        @wraps(fn)
+        def _wrapped(*args, **kwargs):
+            with span(name, category):
+                return fn(*args, **kwargs)
+        return _wrapped
+    return _decorator
+
+
+def events():
+    """Return the phases recorded so far"""
+    return list(_events)
+
+
+def reset():
+    """Forget all recorded phases"""
+    del _events[:]
+    _threads.clear()
+
+
+def export(rank):
+    """
+    Return the recorded phases of this process, to be sent to the master.
+    Timestamps are converted to the wall clock so they can be compared between nodes,
+    while the durations still come from the monotonic clock.
+    """
+    offset = time.time() - monotonic()
+    return {
+        'rank': rank,
+        'hostname': socket.gethostname(),
+        'pid': os.getpid(),
+        'threads': dict(_threads.values()),
+        'events': [(name, cat, start + offset, end + offset, args, tid)
+                   for name, cat, start, end, args, tid in _events],
+    }
+
+
+def chrome_trace(timelines):
+    """Make a Chrome trace (as a dict) of the exported timelines of all ranks, with a track per thread"""
+    if not timelines:
+        return {'traceEvents': []}
+    origin = min([event[2] for timeline in timelines for event in timeline['events']] or [0])
+    trace_events = []
+    for timeline in timelines:
+        rank = timeline['rank']
+        trace_events.append({
+            'name': 'process_name', 'ph': 'M', 'pid': rank, 'tid': 0,
+            'args': {'name': 'rank %d (%s, pid %s)' % (rank, timeline['hostname'], timeline['pid'])},
+        })
+        trace_events.append({'name': 'process_sort_index', 'ph': 'M', 'pid': rank, 'tid': 0,
+                             'args': {'sort_index': rank}})
+        for tid, thread_name in sorted(timeline['threads'].items()):
+            trace_events.append({'name': 'thread_name', 'ph': 'M', 'pid': rank, 'tid': tid,
+                                 'args': {'name': thread_name}})
+        for name, cat, start, end, args, tid in timeline['events']:
+            trace_events.append({
+                'name': name, 'cat': cat, 'ph': 'X', 'pid': rank, 'tid': tid,
+                'ts': int((start - origin) * 1e6), 'dur': int((end - start) * 1e6), 'args': args,
+            })
+    return {'traceEvents': trace_events, 'displayTimeUnit': 'ms'}
+
+
+def write_chrome_trace(timelines, path):
+    """Write the Chrome trace of the exported timelines of all ranks to path"""
+    fh = open(path, 'w')
+    try:
+        json.dump(chrome_trace(timelines), fh)
+    finally:
+        fh.close()
+
+
+def critical_path_summary(timelines, nphases=SUMMARY_PHASES):
+    """
+    One line summary of the startup: the total time and, for the phases that took longest
+    on their slowest rank, how long they took and on which rank (the phases are mostly
+    separated by barriers, so the slowest rank sets the pace). Collectives are left out.
+    """
+    alltimes = [(start, end) for timeline in timelines for _, _, start, end, _, _ in timeline['events']]
+    if not alltimes:
+        return 'no startup phases recorded'
+    total = max([end for _, end in alltimes]) - min([start for start, _ in alltimes])
+
+    slowest = dict()
+    for timeline in timelines:
+        durations = dict()
+        for name, cat, start, end, _, _ in timeline['events']:
+            # time spent in collectives is mostly waiting for the other ranks
+            if cat != CATEGORY_MPI:
+                durations[name] = durations.get(name, 0) + end - start
+        for name, duration in durations.items():
+            if name not in slowest or duration > slowest[name][0]:
+                slowest[name] = (duration, timeline['rank'], timeline['hostname'])
+
+    phases = sorted(slowest.items(), key=lambda item: item[1][0], reverse=True)[:nphases]
+    return 'startup took %.2fs; slowest phases: %s' % (total, ', '.join([
+        '%s %.2fs (rank %d on %s)' % (name, duration, rank, hostname)
+        for name, (duration, rank, hostname) in phases]))
@@ -0,0 +1,352 @@
+# #
+# Copyright 2009-2015 Ghent University
+#
+# This file is part of hanythingondemand
+# originally created by the HPC team of Ghent University (http://ugent.be/hpc/en),
+# with support of Ghent University (http://ugent.be/hpc),
+# the Flemish Supercomputer Centre (VSC) (https://vscentrum.be/nl/en),
+# the Hercules foundation (http://www.herculesstichting.be/in_English)
+# and the Department of Economy, Science and Innovation (EWI) (http://www.ewi-vlaanderen.be/en).
+#
+# http://github.com/hpcugent/hanythingondemand
+#
+# hanythingondemand is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation v2.
+#
+# hanythingondemand is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with hanythingondemand. If not, see <http://www.gnu.org/licenses/>.
+# #
+"""
+Wakeup sources for the service supervision loop.
+
+Instead of sleeping a fixed amount of time between checks, the supervision loop
+blocks until a child process exits (SIGCHLD), a control file shows up in one of
+the watched control directories or a deadline passes. The sleep interval is
+only an upper bound.
+"""
+import errno
+import fcntl
+import os
+import select
+import signal
+import time
+
+from vsc.utils import fancylogger
+
+_log = fancylogger.getLogger(fname=False)
+
+# constants from <sys/inotify.h>
+IN_ATTRIB = 0x00000004
+IN_CLOSE_WRITE = 0x00000008
+IN_MOVED_FROM = 0x00000040
+IN_MOVED_TO = 0x00000080
+IN_CREATE = 0x00000100
+IN_DELETE = 0x00000200
+IN_NONBLOCK = 0x00000800
+IN_CLOEXEC = 0x00080000
+
+CONTROL_EVENTS = IN_ATTRIB | IN_CLOSE_WRITE | IN_MOVED_FROM | IN_MOVED_TO | IN_CREATE | IN_DELETE
+
+CONTROL_POLL_INTERVAL = 5  # seconds between control dir scans when inotify is not available
+
+WAKEUP_SIGNAL = 'signal'
+WAKEUP_CONTROL = 'control'
+WAKEUP_DEADLINE = 'deadline'
+WAKEUP_TIMEOUT = 'timeout'
+
+
+def _set_nonblocking(fd):
+    """Make fd non-blocking and close it on exec."""
+    flags = fcntl.fcntl(fd, fcntl.F_GETFL)
+    fcntl.fcntl(fd, fcntl.F_SETFL, flags | os.O_NONBLOCK)
+    flags = fcntl.fcntl(fd, fcntl.F_GETFD)
+    fcntl.fcntl(fd, fcntl.F_SETFD, flags | fcntl.FD_CLOEXEC)
+
+
+class WakeupPipe(object):
+    """
+    Self-pipe which can be written to from signal handlers and other threads
+    and waited on with select.
+    """
+    def __init__(self):
+        self.rfd, self.wfd = os.pipe()
+        _set_nonblocking(self.rfd)
+        _set_nonblocking(self.wfd)
+
+    def fileno(self):
+        return self.rfd
+
+    def notify(self):
+        """Wake up whoever is waiting on this pipe."""
+        try:
+            os.write(self.wfd, '\0')
+        except OSError, err:
+            # a full pipe means there is a wakeup pending already
+            if err.errno != errno.EAGAIN:
+                raise
+
+    def drain(self):
+        """Consume all pending wakeups. Returns True if there were any."""
+        woken = False
+        while True:
+            try:
+                data = os.read(self.rfd, 4096)
+            except OSError, err:
+                if err.errno in (errno.EAGAIN, errno.EINTR):
+                    break
+                raise
+            if not data:
+                break
+            woken = True
+        return woken
+
+    def close(self):
+        os.close(self.rfd)
+        os.close(self.wfd)
+
+
+_SIGNAL_PIPES = {}
+_PREVIOUS_HANDLERS = {}
+# pipes registered with add_signal_wakeup; the last one is the wakeup fd of the process
+_WAKEUP_PIPES = []
+
+
+def _set_wakeup_fd():
+    """Make the last registered pipe the wakeup fd of the process, or unset it if there is none."""
+    if _WAKEUP_PIPES:
+        signal.set_wakeup_fd(_WAKEUP_PIPES[-1].wfd)
+    else:
+        signal.set_wakeup_fd(-1)
+
+
+def _signal_wakeup(signum, _):
+    """
+    Signal handler: notify the pipes registered for signum other than the wakeup fd,
+    which the interpreter already wrote to when the signal was delivered.
+    """
+    for pipe in list(_SIGNAL_PIPES.get(signum, [])):
+        if not _WAKEUP_PIPES or pipe is not _WAKEUP_PIPES[-1]:
+            pipe.notify()
+
+
+def add_signal_wakeup(signum, pipe):
+    """
+    Notify pipe whenever signum is delivered.
+
+    The pipe is made the wakeup fd of the process (see signal.set_wakeup_fd), so
+    it is written to as soon as the signal arrives, even if it arrives in another
+    thread while the main thread is blocked in select; the Python level signal
+    handler only runs when the main thread gets to it. Only one wakeup fd can be
+    set, so pipes registered earlier are notified by the handler.
+
+    The first registration for a signal installs the handler, which is only
+    possible from the main thread (ValueError otherwise). The handler is
+    installed with SA_RESTART so that blocking reads in other code are not
+    interrupted.
+    """
+    if signum not in _SIGNAL_PIPES:
+        _PREVIOUS_HANDLERS[signum] = signal.signal(signum, _signal_wakeup)
+        signal.siginterrupt(signum, False)
+        _SIGNAL_PIPES[signum] = []
+    _SIGNAL_PIPES[signum].append(pipe)
+    _WAKEUP_PIPES.append(pipe)
+    _set_wakeup_fd()
+
+
+def remove_signal_wakeup(signum, pipe):
+    """Undo add_signal_wakeup; restores the previous handler after the last pipe is removed."""
+    pipes = _SIGNAL_PIPES.get(signum, [])
+    if pipe in pipes:
+        pipes.remove(pipe)
+        _WAKEUP_PIPES.remove(pipe)
+        _set_wakeup_fd()
+    if signum in _SIGNAL_PIPES and not pipes:
+        del _SIGNAL_PIPES[signum]
+        previous = _PREVIOUS_HANDLERS.pop(signum)
+        if previous is None:
+            previous = signal.SIG_DFL
+        signal.signal(signum, previous)
+
+
+def _inotify_libc():
+    """Return libc if it provides inotify, None otherwise."""
+    try:
+        import ctypes
+        import ctypes.util
+        libc = ctypes.CDLL(ctypes.util.find_library('c') or 'libc.so.6', use_errno=True)
+        libc.inotify_init1
+        libc.inotify_add_watch
+        return libc
+    except (ImportError, OSError, AttributeError):
+        return None
+
+
+def _get_errno():
+    """Return errno of the last failed libc call."""
+    try:
+        import ctypes
+        return ctypes.get_errno()
+    except ImportError:
+        return None
+
+
+def _dir_state(path):
+    """Cheap fingerprint of a directory for polling: its mtime and entries."""
+    try:
+        return (os.stat(path).st_mtime, tuple(sorted(os.listdir(path))))
+    except OSError:
+        return None
+
+
+class ControlDirWatcher(object):
+    """
+    Watch directories for control files being created or removed. Uses inotify
+    where available and falls back to polling the directories.
+    """
+    def __init__(self, use_inotify=True):
+        self._libc = None
+        self._fd = None
+        if use_inotify:
+            self._libc = _inotify_libc()
+        if self._libc is not None:
+            fd = self._libc.inotify_init1(IN_NONBLOCK | IN_CLOEXEC)
+            if fd >= 0:
+                self._fd = fd
+            else:
+                _log.debug("inotify_init1 failed (errno %s); polling control dirs", _get_errno())
+        self._polled = {}
+        self._watched = set()
+
+    def watch(self, path):
+        """Start watching path."""
+        if path in self._watched or path in self._polled:
+            return
+        if self._fd is not None:
+            wd = self._libc.inotify_add_watch(self._fd, path, CONTROL_EVENTS)
+            if wd >= 0:
+                self._watched.add(path)
+                _log.debug("Watching %s with inotify", path)
+                return
+            _log.debug("inotify_add_watch on %s failed (errno %s); polling it", path, _get_errno())
+        self._polled[path] = _dir_state(path)
+
+    @property
+    def polling(self):
+        """True if some directories can only be watched by polling."""
+        return bool(self._polled)
+
+    def fileno(self):
+        """File descriptor to select on, None if there is nothing to select on."""
+        if self._watched:
+            return self._fd
+        return None
+
+    def changed(self):
+        """Consume pending events and rescan polled dirs. Returns True if anything changed."""
+        changed = False
+        if self._fd is not None:
+            while True:
+                try:
+                    data = os.read(self._fd, 4096)
+                except OSError, err:
+                    if err.errno in (errno.EAGAIN, errno.EINTR):
+                        break
+                    raise
+                if not data:
+                    break
+                changed = True
+        for path, state in self._polled.items():
+            new_state = _dir_state(path)
+            if new_state != state:
+                self._polled[path] = new_state
+                changed = True
+        return changed
+
+    def close(self):
+        if self._fd is not None:
+            os.close(self._fd)
+            self._fd = None
+
+
+class Waiter(object):
+    """
+    Block until the supervision loop has something to look at: a child exited,
+    a control dir changed, a deadline passed, or at most 'interval' seconds
+    went by.
+    """
+    def __init__(self, interval, use_inotify=True):
+        self.interval = interval
+        self.pipe = WakeupPipe()
+        self.watcher = ControlDirWatcher(use_inotify=use_inotify)
+        self.deadlines = []
+        self._signals = []
+
+    def start(self, signums=(signal.SIGCHLD,)):
+        """Start listening for signals. Needs to be called from the main thread."""
+        for signum in signums:
+            add_signal_wakeup(signum, self.pipe)
+            self._signals.append(signum)
+
+    def stop(self):
+        """Stop listening and release all resources."""
+        for signum in self._signals:
+            remove_signal_wakeup(signum, self.pipe)
+        self._signals = []
+        self.watcher.close()
+        self.pipe.close()
+
+    def watch(self, path):
+        """Wake up when control files in path change."""
+        self.watcher.watch(path)
+
+    def add_deadline(self, when):
+        """Wake up at time 'when' (seconds since the epoch)."""
+        self.deadlines.append(when)
+        self.deadlines.sort()
+
+    def wait(self, timeout=None):
+        """
+        Wait for a wakeup. Returns the list of reasons for waking up
+        (WAKEUP_SIGNAL, WAKEUP_CONTROL, WAKEUP_DEADLINE or WAKEUP_TIMEOUT).
+        """
+        if timeout is None:
+            timeout = self.interval
+        end = time.time() + timeout
+        deadline_hit = False
+        if self.deadlines and self.deadlines[0] <= end:
+            end = self.deadlines[0]
+            deadline_hit = True
+
+        while True:
+            remaining = end - time.time()
+            if remaining <= 0:
+                if deadline_hit:
+                    now = time.time()
+                    self.deadlines = [when for when in self.deadlines if when > now]
+                    return [WAKEUP_DEADLINE]
+                return [WAKEUP_TIMEOUT]
+
+            if self.watcher.polling:
+                remaining = min(remaining, CONTROL_POLL_INTERVAL)
+            fds = [self.pipe]
+            if self.watcher.fileno() is not None:
+                fds.append(self.watcher)
+            try:
+                select.select(fds, [], [], remaining)
+            except select.error, err:
+                if err.args[0] != errno.EINTR:
+                    raise
+
+            reasons = []
+            if self.pipe.drain():
+                reasons.append(WAKEUP_SIGNAL)
+            if self.watcher.changed():
+                reasons.append(WAKEUP_CONTROL)
+            if reasons:
+                return reasons
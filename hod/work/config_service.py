@@ -27,12 +27,21 @@
 """
 
 import os
+import time
 from errno import EEXIST
 from os.path import join as mkpath
 
 from hod.work.work import Work
-from hod.config.config import env2str
-from hod.commands.command import Command
+from hod.config.config import RESTART_ON_FAILURE, env2str
+from hod.commands.command import COMMAND_TIMEOUT, Command, RotatingFile
+from hod.commands.executor import attach_command
+from hod.commands.usage import USAGE_FILENAME, write_record
+from hod.node.affinity import reserve_cores
+from hod.node.node import node_inventory
+from hod.work.probe import probe, wait_for_probe
+
+# timeout for a single LivenessCheck, in seconds
+LIVENESS_TIMEOUT = 2
 
 class ConfiguredService(Work):
     """
@@ -45,6 +54,13 @@ class ConfiguredService(Work):
         self._config = config
         self._master_env = master_env
         self.name = self._config.name
+        self.restarts = 0
+        # time of the last restart while the service is not alive again yet
+        self._restarted_at = None
+        # set when the service is down and will not be restarted anymore
+        self._given_up = False
+        # CommandFuture of a restart that runs on the executor
+        self._restarting = None
 
     def pre_start_work_service(self):
         """Run the ExecStartPre script"""
@@ -53,46 +69,188 @@ class ConfiguredService(Work):
             self.log.info('Prestarting %s service on rank %s: No work.',
                 self._config.name, rank)
             return
-        env = os.environ
-        env.update(self._config.env)
-        env.update(self._master_env)
+        env = self._env()
 
         self.log.info('Prestarting %s service on rank %s: "%s"',
                 self._config.name, rank, self._config.pre_start_script)
-        command = Command(self._config.pre_start_script, env=env)
-        output = command.run()
+        output = self._run_script('ExecStartPre', self._config.pre_start_script, env)
         self.log.info('Ran %s service on rank %s prestart script. Output: "%s"',
                 self._config.name, rank, output)
 
     def start_work_service(self):
         """Start service by running the ExecStart script."""
-        env = os.environ
-        env.update(self._config.env)
-        env.update(self._master_env)
+        env = self._env()
         rank = self.svc.rank
 
         self.log.info('Starting %s service on rank %s: "%s"',
                 self._config.name, rank, self._config.start_script)
         self.log.info("Env for %s service on rank %s: %s",
                 self._config.name, rank, env2str(env))
-        command = Command(self._config.start_script, env=env, timeout=self._config.timeout)
-        output = command.run()
+        output = self._run_script('ExecStart', self._config.start_script, env, timeout=self._config.timeout,
+                                  cpus=self._cpus())
         self.log.info('Ran %s service on rank %s start script. Output: "%s"',
                 self._config.name, rank, output)
 
+    def wait_ready_work_service(self):
+        """Wait until the ReadyCheck of the service succeeds."""
+        rank = self.svc.rank
+        ready_check = self._config.ready_check
+        if not ready_check:
+            self.log.debug('No ReadyCheck for %s service on rank %s', self._config.name, rank)
+            return True
+
+        self.log.info('Waiting up to %s seconds for %s service on rank %s to be ready: "%s"',
+                self._config.ready_timeout, self._config.name, rank, ready_check)
+        start = time.time()
+        ready = wait_for_probe(ready_check, self._config.ready_timeout)
+        if ready:
+            self.log.info('%s service on rank %s is ready after %.2f seconds',
+                    self._config.name, rank, time.time() - start)
+        else:
+            self.log.error('%s service on rank %s is not ready after %s seconds: "%s" still fails',
+                    self._config.name, rank, self._config.ready_timeout, ready_check)
+        return ready
+
+    def work_wait(self):
+        """Check the liveness of the service, and restart it if it died. Returns True if the wait is over."""
+        if Work.work_wait(self):
+            return True
+        self.check_liveness()
+        return False
+
+    def check_liveness(self):
+        """
+        Run the LivenessCheck of the service, and restart it according to its Restart policy if it fails.
+        A restarted service has ReadyTimeout seconds to pass the check again.
+        """
+        liveness_check = self._config.liveness_check
+        if not liveness_check or self._given_up:
+            return
+        if self._restarting is not None:
+            if not self._restarting.done():
+                return
+            if self._restarting.exception() is not None:
+                self.log.error('Restarting %s service on rank %s failed: %s',
+                        self._config.name, self.svc.rank, self._restarting.exception())
+            self._restarting = None
+
+        rank = self.svc.rank
+        if probe(liveness_check, timeout=LIVENESS_TIMEOUT):
+            if self._restarted_at is not None:
+                self.log.info('%s service on rank %s is alive again after %.2f seconds',
+                        self._config.name, rank, time.time() - self._restarted_at)
+                self._restarted_at = None
+            return
+        if self._restarted_at is not None and time.time() - self._restarted_at < self._config.ready_timeout:
+            self.log.debug('%s service on rank %s is still starting', self._config.name, rank)
+            return
+
+        if self._config.restart != RESTART_ON_FAILURE:
+            self.log.error('%s service on rank %s is down: "%s" fails; not restarting it',
+                    self._config.name, rank, liveness_check)
+            self._given_up = True
+        elif self.restarts >= self._config.restart_limit:
+            self.log.error('%s service on rank %s is down: "%s" fails; not restarting it after %d restarts',
+                    self._config.name, rank, liveness_check, self.restarts)
+            self._given_up = True
+        else:
+            self.restarts += 1
+            self.log.warn('%s service on rank %s is down: "%s" fails; restarting it (restart %d of %d)',
+                    self._config.name, rank, liveness_check, self.restarts, self._config.restart_limit)
+            self._restarted_at = time.time()
+            if self.executor is None:
+                self.start_work_service()
+            else:
+                # don't hold up the supervision of the other services
+                self._restarting = self.executor.submit(self.start_work_service)
+
     def stop_work_service(self):
         """Stop service by running the ExecStop script."""
-        env = os.environ
-        env.update(self._config.env)
-        env.update(self._master_env)
+        env = self._env()
         rank = self.svc.rank
         self.log.info('Stopping %s service on rank %s: "%s"',
             self._config.name, rank, self._config.stop_script)
-        command = Command(self._config.stop_script, env=env)
-        output = command.run()
+        output = self._run_script('ExecStop', self._config.stop_script, env)
         self.log.info('Ran %s service on rank %s stop script. Output: "%s"',
                 self._config.name, rank, output)
 
+    def _env(self):
+        """Environment for the scripts of the service; a copy, as scripts of several services run at the same time"""
+        env = dict(os.environ)
+        env.update(self._config.env)
+        env.update(self._master_env)
+        return env
+
+    def output_paths(self):
+        """Paths of the files the stdout and stderr of the scripts of the service are written to"""
+        logdir = mkpath(self._config.localworkdir, 'log')
+        return mkpath(logdir, '%s.out' % self.name), mkpath(logdir, '%s.err' % self.name)
+
+    def _cpus(self):
+        """
+        The cpus to pin the daemon of the service to, following its CPUAffinity= or
+        ReservedCores=; None if it should not be pinned.
+        """
+        usablecores = node_inventory().usable_cores()
+        if self._config.cpu_affinity:
+            cpus = [cpu for cpu in self._config.cpu_affinity if cpu in usablecores]
+            if len(cpus) < len(self._config.cpu_affinity):
+                self.log.warning('CPUAffinity of %s service on rank %s has cpus that are not available: %s '
+                                 '(available: %s)', self.name, self.svc.rank, self._config.cpu_affinity, usablecores)
+        elif self._config.reserved_cores:
+            cpus = reserve_cores(usablecores, self._config.reserved_cores)
+        else:
+            return None
+        if not cpus:
+            self.log.warning('Not pinning %s service on rank %s: none of its cpus are available', self.name,
+                             self.svc.rank)
+            return None
+        self.log.info('Pinning %s service on rank %s to cpus %s', self.name, self.svc.rank, cpus)
+        return cpus
+
+    def _run_script(self, what, script, env, timeout=COMMAND_TIMEOUT, cpus=None):
+        """
+        Run script, streaming its output to the output files of the service, which are rotated
+        when they get large. Returns the tail of the output, for the log; or all of it if the
+        output files can not be made, e.g. when there is no localworkdir.
+        The script is pinned to the list of cpus if given.
+        """
+        start = time.time()
+        try:
+            out_path, err_path = self.output_paths()
+            stdout, stderr = RotatingFile(out_path), RotatingFile(err_path)
+        except (RuntimeError, IOError, OSError), err:
+            self.log.debug('Not streaming the output of %s of %s service: %s', what, self.name, err)
+            stdout, stderr = None, None
+        command = Command(script, env=env, timeout=timeout, stdout=stdout, stderr=stderr, cpus=cpus)
+        attach_command(command)
+        try:
+            if stdout is not None:
+                header = '==> %s %s: %s <==\n' % (time.strftime('%Y-%m-%d %H:%M:%S', time.localtime(start)), what,
+                                                  script)
+                stdout.write(header)
+                stderr.write(header)
+            output = command.run()
+        finally:
+            if stdout is not None:
+                stdout.close()
+                stderr.close()
+        if command.usage is not None:
+            self._record_usage(what, start, command.usage)
+        return output
+
+    def _record_usage(self, what, start, usage):
+        """Log the resource usage of a script and record it in the localworkdir"""
+        record = dict(usage, service=self.name, script=what, rank=self.svc.rank, host=os.uname()[1], start=start)
+        self.command_usage.append(record)
+        self.log.info('%s of %s service on rank %s took %.2fs (user %.2fs, sys %.2fs, max rss %s KB)',
+                what, self.name, self.svc.rank, usage['wall'], usage.get('utime', 0), usage.get('stime', 0),
+                usage.get('maxrss', '-'))
+        try:
+            write_record(mkpath(self._config.localworkdir, USAGE_FILENAME), record)
+        except (RuntimeError, IOError, OSError), err:
+            self.log.error('Failed to write resource usage of %s of %s service: %s', what, self.name, err)
+
     def prepare_work_cfg(self):
         """Prepare the config: collect the parameters and make the necessary xml cfg files"""
         self.controldir = mkpath(self._config.localworkdir, 'controldir')
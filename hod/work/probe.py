@@ -0,0 +1,153 @@
+# #
+# Copyright 2009-2015 Ghent University
+#
+# This file is part of hanythingondemand
+# originally created by the HPC team of Ghent University (http://ugent.be/hpc/en),
+# with support of Ghent University (http://ugent.be/hpc),
+# the Flemish Supercomputer Centre (VSC) (https://vscentrum.be/nl/en),
+# the Hercules foundation (http://www.herculesstichting.be/in_English)
+# and the Department of Economy, Science and Innovation (EWI) (http://www.ewi-vlaanderen.be/en).
+#
+# http://github.com/hpcugent/hanythingondemand
+#
+# hanythingondemand is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation v2.
+#
+# hanythingondemand is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with hanythingondemand. If not, see <http://www.gnu.org/licenses/>.
+# #
+"""
+Probes to check whether a service is up, e.g. before starting services that depend on it.
+
+A probe is specified as a string of the form 'scheme:target':
+ * tcp:host:port - a TCP connection to host:port can be made
+ * http:host:port/path or http://host:port/path - a GET request on the url succeeds
+ * file:path - path exists
+ * pid:path - the process with the pid in the pid file path is running
+"""
+import errno
+import httplib
+import os
+import socket
+import time
+import urllib2
+
+from vsc.utils import fancylogger
+
+_log = fancylogger.getLogger(fname=False)
+
+# timeout for a single attempt of a probe, in seconds
+PROBE_ATTEMPT_TIMEOUT = 5
+# delay before the first retry of a failed probe; this doubles on every retry
+PROBE_INITIAL_DELAY = 0.1
+PROBE_MAX_DELAY = 5
+
+
+def _probe_tcp(target, timeout):
+    """Check whether a TCP connection can be made to target, which is 'host:port'"""
+    host, port = target.rsplit(':', 1)
+    try:
+        sock = socket.create_connection((host, int(port)), timeout)
+    except (socket.error, socket.timeout), err:
+        _log.debug("tcp probe to %s failed: %s", target, err)
+        return False
+    sock.close()
+    return True
+
+
+def _probe_http(target, timeout):
+    """Check whether a GET request on target, an url without the scheme, succeeds"""
+    url = 'http://%s' % target.lstrip('/')
+    try:
+        response = urllib2.urlopen(url, timeout=timeout)
+    except (urllib2.URLError, httplib.HTTPException, socket.error, socket.timeout), err:
+        _log.debug("http probe to %s failed: %s", url, err)
+        return False
+    response.close()
+    return True
+
+
+def _probe_file(target, _):
+    """Check whether target exists"""
+    return os.path.exists(target)
+
+
+def _probe_pid(target, _):
+    """Check whether the process with the pid in the pid file target is running"""
+    try:
+        fh = open(target)
+        try:
+            pid = int(fh.read().strip())
+        finally:
+            fh.close()
+    except (IOError, ValueError), err:
+        _log.debug("pid probe on %s failed: %s", target, err)
+        return False
+
+    try:
+        os.kill(pid, 0)
+    except OSError, err:
+        # the process exists, but belongs to someone else
+        if err.errno == errno.EPERM:
+            return True
+        _log.debug("pid probe on %s failed: process %s: %s", target, pid, err)
+        return False
+    return True
+
+
+PROBES = {
+    'tcp': _probe_tcp,
+    'http': _probe_http,
+    'file': _probe_file,
+    'pid': _probe_pid,
+}
+
+
+def parse_probe(spec):
+    """
+    Split a probe specification into its scheme and target.
+    Raises ValueError if the scheme is not known or the target is incomplete.
+    """
+    scheme, sep, target = spec.strip().partition(':')
+    if not sep or scheme not in PROBES:
+        raise ValueError("Invalid probe '%s': should start with one of %s" %
+                         (spec, ', '.join(['%s:' % name for name in sorted(PROBES)])))
+    if not target:
+        raise ValueError("Invalid probe '%s': no target" % spec)
+    if scheme == 'tcp' and ':' not in target:
+        raise ValueError("Invalid probe '%s': tcp probes need a host:port target" % spec)
+    return scheme, target
+
+
+def probe(spec, timeout=PROBE_ATTEMPT_TIMEOUT):
+    """Run the probe once. Returns True if it succeeds."""
+    scheme, target = parse_probe(spec)
+    return PROBES[scheme](target, timeout)
+
+
+def wait_for_probe(spec, timeout, initial_delay=PROBE_INITIAL_DELAY, max_delay=PROBE_MAX_DELAY):
+    """
+    Run the probe until it succeeds, backing off exponentially between attempts.
+    Returns True if the probe succeeded, False if it still failed after timeout seconds.
+    """
+    deadline = time.time() + timeout
+    delay = initial_delay
+    attempts = 0
+    while True:
+        attempts += 1
+        remaining = deadline - time.time()
+        if probe(spec, timeout=max(min(PROBE_ATTEMPT_TIMEOUT, remaining), 0.1)):
+            _log.debug("Probe %s succeeded after %d attempts", spec, attempts)
+            return True
+        remaining = deadline - time.time()
+        if remaining <= 0:
+            _log.debug("Probe %s still failing after %d attempts", spec, attempts)
+            return False
+        time.sleep(min(delay, remaining))
+        delay = min(delay * 2, max_delay)
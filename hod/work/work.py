@@ -27,10 +27,9 @@
 """
 
 import time
-import os
 
 from vsc.utils.fancylogger import getLogger
-from hod.mpiservice import MpiService, barrier
+from hod.mpiservice import MpiService
 
 
 class Work(object):
@@ -43,6 +42,10 @@ class Work(object):
         self.work_start_time = time.time()
 
         self.controldir = None
+        # CommandExecutor shared by the work on this rank (set by run_tasks), for work that runs in the background
+        self.executor = None
+        # resource usage records of the commands run by the work, see hod.commands.usage
+        self.command_usage = []
 
     def prepare_work_cfg(self):
         """prepare any config"""
@@ -60,8 +63,15 @@ class Work(object):
         """Stop the service"""
         raise NotImplementedError
 
+    def wait_ready_work_service(self):
+        """Wait until the started service is ready for use. Returns False if it did not become ready."""
+        return True
+
     def work_wait(self):
-        """What to do between start and stop (and how stop is triggered). Returns True is the wait is over"""
+        """
+        What to do between start and stop (and how stop is triggered). Returns True is the wait is over.
+        Called on every tick of the supervision loop in run_tasks, so this should not block.
+        """
         now = time.time()
         if (now - self.work_start_time) > self.work_max_age:
             self.log.debug("Work started at %s, now is %s, which is more then max_age %s",
@@ -69,36 +79,15 @@ class Work(object):
             return True  # wait is over
         return False
 
-    def do_work_start(self):
-        """Start the work"""
-        barrier(self.svc.comm, "Going to run pre-start work on rank %s" % self.svc.rank)
-        self.pre_start_work_service()
-        barrier(self.svc.comm, "Going to start work on rank %s" % self.svc.rank)
-        self.start_work_service()
-
-    def do_work_wait(self):
-        barrier(self.svc.comm, "Going to wait work on all. Return True when all is over")
-
-        ans = self.work_wait()  # True when wait is over
-
-        # # override mechanisms
-        force_fn = os.path.join(self.controldir, 'force_stop')
-        if os.path.isfile(force_fn):
-            self.log.warn("Force stop detected. work_wait was %s. return True", ans)
-            return True
-        else:
-            self.log.debug("No force stop file %s found", force_fn)
-
-        force_fn = os.path.join(self.controldir, 'force_continue')
-        if os.path.isfile(force_fn):
-            self.log.warn("Force continue detected. work_wait was %s. return False", ans)
-            return False
-        else:
-            self.log.debug("No force continue file %s found", force_fn)
-
-        return ans
+    def work_deadline(self):
+        """Return the time (seconds since the epoch) at which work_wait will report the wait is over"""
+        return self.work_start_time + self.work_max_age
 
     def do_work_stop(self):
         """Stop the work"""
-        barrier(self.svc.comm, "Going to stop work on ")
+        self.log.debug("Going to stop work on rank %s", self.svc.rank)
         self.stop_work_service()
+
+    def work_end(self):
+        """Clean up after the work was stopped"""
+        pass
@@ -0,0 +1,132 @@
+# #
+# Copyright 2009-2015 Ghent University
+#
+# This file is part of hanythingondemand
+# originally created by the HPC team of Ghent University (http://ugent.be/hpc/en),
+# with support of Ghent University (http://ugent.be/hpc),
+# the Flemish Supercomputer Centre (VSC) (https://vscentrum.be/nl/en),
+# the Hercules foundation (http://www.herculesstichting.be/in_English)
+# and the Department of Economy, Science and Innovation (EWI) (http://www.ewi-vlaanderen.be/en).
+#
+# http://github.com/hpcugent/hanythingondemand
+#
+# hanythingondemand is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation v2.
+#
+# hanythingondemand is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with hanythingondemand. If not, see <http://www.gnu.org/licenses/>.
+# #
+"""
+Benchmark the setup of the per task communicators in run_tasks.
+
+Compares one Create per task (as run_tasks used to do) with _make_comm_groups.
+Run it under MPI for a single rank count:
+
+    mpirun -n 16 python test/benchmark/bench_comm_setup.py
+
+or let it start mpirun for a number of rank counts:
+
+    python test/benchmark/bench_comm_setup.py --ranks 2,4,8,16
+"""
+import subprocess
+import sys
+import time
+from optparse import OptionParser
+
+# hod is only imported in the processes started by mpirun: importing it initialises MPI
+# (through vsc.utils.fancylogger), after which this process can no longer start mpirun itself.
+
+# runs_on of the tasks of a typical Hadoop/HBase setup
+RUNS_ON_MIX = ['master', 'slave', 'all', 'all', 'master', 'all']
+DEFAULT_TASKS = len(RUNS_ON_MIX)
+
+
+def task_ranks(size, ntasks):
+    """Rank lists for ntasks tasks on size ranks"""
+    from hod.config.config import _parse_runs_on, ConfigOpts
+    from hod.mpiservice import MASTERRANK
+    ranks = range(size)
+    lists = []
+    for idx in range(ntasks):
+        runs_on = _parse_runs_on(RUNS_ON_MIX[idx % len(RUNS_ON_MIX)])
+        cfg = ConfigOpts('task%d' % idx, runs_on, '', '', '', dict(), None)
+        lists.append(cfg.runs_on(MASTERRANK, ranks) or [MASTERRANK])
+    return lists
+
+
+def per_task_create(comm, rank_lists):
+    """Communicator setup as it used to be done in run_tasks"""
+    from hod.mpiservice import _make_comm_group
+    return [_make_comm_group(comm, ranks) for ranks in rank_lists]
+
+
+def free_comms(comms):
+    """Free all communicators except COMM_NULL and COMM_WORLD"""
+    from mpi4py import MPI
+    for newcomm in comms:
+        if newcomm not in (MPI.COMM_NULL, MPI.COMM_WORLD):
+            newcomm.Free()
+
+
+def bench(comm, rank_lists, repeat):
+    """Time both methods; returns dict with the slowest rank's average time in seconds per method"""
+    from mpi4py import MPI
+    from hod.mpiservice import _make_comm_groups
+    methods = [
+        ('per_task_create', lambda: per_task_create(comm, rank_lists)),
+        ('make_comm_groups', lambda: _make_comm_groups(comm, rank_lists).values()),
+    ]
+    results = dict()
+    for name, method in methods:
+        total = 0.0
+        for _ in range(repeat):
+            comm.barrier()
+            start = time.time()
+            comms = method()
+            total += time.time() - start
+            free_comms(comms)
+        results[name] = comm.allreduce(total / repeat, op=MPI.MAX)
+    return results
+
+
+def run_mpi(opts):
+    """Run the benchmark on the ranks this process was started with"""
+    from mpi4py import MPI
+    from hod.mpiservice import MASTERRANK
+    comm = MPI.COMM_WORLD
+    results = bench(comm, task_ranks(comm.Get_size(), opts.tasks), opts.repeat)
+    if comm.Get_rank() == MASTERRANK:
+        print "%6d %6d %18.6f %18.6f" % (comm.Get_size(), opts.tasks,
+                                         results['per_task_create'], results['make_comm_groups'])
+        sys.stdout.flush()
+
+
+def main():
+    parser = OptionParser(usage=__doc__)
+    parser.add_option('--tasks', type='int', default=DEFAULT_TASKS, help='Number of tasks')
+    parser.add_option('--repeat', type='int', default=10, help='Number of times to repeat each measurement')
+    parser.add_option('--ranks', default=None,
+                      help='Comma separated list of rank counts to start mpirun with')
+    parser.add_option('--mpirun', default='mpirun', help='mpirun command to use with --ranks')
+    opts, _ = parser.parse_args()
+
+    if opts.ranks is None:
+        run_mpi(opts)
+        return
+
+    print "%6s %6s %18s %18s" % ('ranks', 'tasks', 'per_task_create', 'make_comm_groups')
+    sys.stdout.flush()
+    for nranks in [int(x) for x in opts.ranks.split(',')]:
+        cmd = opts.mpirun.split() + ['-n', str(nranks), sys.executable, __file__,
+                                     '--tasks', str(opts.tasks), '--repeat', str(opts.repeat)]
+        subprocess.check_call(cmd)
+
+
+if __name__ == '__main__':
+    main()
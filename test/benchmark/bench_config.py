@@ -0,0 +1,345 @@
+# #
+# Copyright 2009-2015 Ghent University
+#
+# This file is part of hanythingondemand
+# originally created by the HPC team of Ghent University (http://ugent.be/hpc/en),
+# with support of Ghent University (http://ugent.be/hpc),
+# the Flemish Supercomputer Centre (VSC) (https://vscentrum.be/nl/en),
+# the Hercules foundation (http://www.herculesstichting.be/in_English)
+# and the Department of Economy, Science and Innovation (EWI) (http://www.ewi-vlaanderen.be/en).
+#
+# http://github.com/hpcugent/hanythingondemand
+#
+# hanythingondemand is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation v2.
+#
+# hanythingondemand is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with hanythingondemand. If not, see <http://www.gnu.org/licenses/>.
+# #
+"""
+Benchmark the config generation pipeline.
+
+Times each stage of the config generation as done in ConfiguredMaster.distribution,
+and the pipeline as a whole, for all dists in etc/hod and for synthetic manifests with
+many properties and services:
+
+    python test/benchmark/bench_config.py --properties 100,1000 --services 10,100 --output results.json
+
+The results are written as JSON (to stdout by default) so they can be compared between
+releases; --compare prints the median time per stage relative to an earlier run:
+
+    python test/benchmark/bench_config.py --compare results-previous.json
+
+Autogen and the templates use fixed node information (see NODE_INFO) and the master
+templates use fixed values, so the results do not depend on the hardware information
+of the benchmark host.
+"""
+import json
+import os
+import platform
+import shutil
+import sys
+import tempfile
+import time
+from copy import deepcopy
+from optparse import OptionParser
+from os.path import join as mkpath
+
+# mklocalworkdir needs a job id
+os.environ.setdefault('PBS_JOBID', 'bench_config')
+
+import hod
+import hod.node.node as hn
+import hod.timeline as timeline
+from hod.config.config import ConfigOpts, PreServiceConfigOpts, merge, service_config_fn, write_service_config
+from hod.config.template import ConfigTemplate, TemplateRegistry, TemplateResolver, register_templates
+from hod.node.node import NetworkInterface, NodeInventory
+
+ETC_HOD = os.path.normpath(mkpath(os.path.dirname(os.path.abspath(__file__)), '..', '..', 'etc', 'hod'))
+
+STAGES = ['from_file_list', 'merge', 'autogen_configs', 'service_configs', 'resolve', 'hadoop_xml',
+          'write_service_config', 'pipeline']
+
+# node information used by autogen and the templates: a 16 core node with 64GB of memory
+NETWORK = [NetworkInterface('node001.ib.example.com', '10.1.0.1', 'ib0', 16)]
+
+NODE_INFO = {
+    'fqdn': 'node001.example.com',
+    'network': NETWORK,
+    'pid': 1,
+    'cores': 16,
+    'usablecores': range(16),
+    'totalcores': 16,
+    'cpulimits': {},
+    'topology': [0],
+    'memory': {'meminfo': {'memtotal': 64 * 1024 ** 3}, 'ulimit': 'unlimited'},
+}
+
+MASTER_TEMPLATES = [
+    ConfigTemplate('masterhostname', 'node001.example.com', 'master hostname'),
+    ConfigTemplate('masterhostaddress', '10.0.0.1', 'master address'),
+    ConfigTemplate('masterdataname', 'node001.ib.example.com', 'master data hostname'),
+    ConfigTemplate('masterdataaddress', '10.1.0.1', 'master data address'),
+]
+
+# config files of the synthetic manifests, the properties are spread over them
+# (autogen=hadoop only keeps the config files it generates itself)
+SYNTHETIC_FILES = ['core-site.xml', 'mapred-site.xml', 'yarn-site.xml', 'capacity-scheduler.xml']
+
+
+class _FixedInventory(NodeInventory):
+    """NodeInventory of the node in NODE_INFO, which never probes the benchmark host"""
+    def __init__(self):
+        super(_FixedInventory, self).__init__()
+        self._interfaces = list(NETWORK)
+        self._usable_cores = list(NODE_INFO['usablecores'])
+        self._numa_nodes = []
+        self._node_info = deepcopy(NODE_INFO)
+
+    def numa_binding(self):
+        return ''
+
+
+def write_synthetic_manifest(dirname, nproperties, nservices):
+    """Write a hod.conf with nproperties properties and nservices services in dirname; returns its path"""
+    services = []
+    for idx in range(nservices):
+        fn = 'service%d.conf' % idx
+        fh = open(mkpath(dirname, fn), 'w')
+        fh.write('[Unit]\nName=service%d\nRunsOn=%s\n' % (idx, ['master', 'slave', 'all'][idx % 3]))
+        if idx:
+            fh.write('After=service%d\n' % (idx - 1))
+        fh.write('\n[Service]\n')
+        fh.write('ExecStartPre=mkdir -p $localworkdir/service%d\n' % idx)
+        fh.write('ExecStart=$$EBROOTHADOOP/sbin/service.sh start service%d\n' % idx)
+        fh.write('ExecStop=$$EBROOTHADOOP/sbin/service.sh stop service%d\n' % idx)
+        fh.write('\n[Environment]\nCONF_DIR=$localworkdir/conf\nLOG_DIR=$localworkdir/log/service%d\n' % idx)
+        fh.close()
+        services.append(fn)
+
+    sections = dict([(fn, []) for fn in SYNTHETIC_FILES])
+    for idx in range(nproperties):
+        values = ['value%d' % idx, '$localworkdir/data/dir%d' % idx, '$masterhostaddress:%d' % (10000 + idx),
+                  '%d' % (idx * 1024)]
+        sections[SYNTHETIC_FILES[idx % len(SYNTHETIC_FILES)]].append(
+            'synthetic.property%d=%s' % (idx, values[idx % len(values)]))
+
+    path = mkpath(dirname, 'hod.conf')
+    fh = open(path, 'w')
+    fh.write('[Meta]\nversion=1\n\n[Config]\nmodules=Hadoop/2.5.0\nmaster_env=JAVA_HOME\n')
+    fh.write('services=%s\n' % ','.join(services))
+    fh.write('config_writer=hod.config.writer.hadoop_xml\nautogen=hadoop\n')
+    fh.write('directories=$localworkdir/dfs/name,$localworkdir/dfs/data\n')
+    for fn in SYNTHETIC_FILES:
+        fh.write('\n[%s]\n%s\n' % (fn, '\n'.join(sections[fn])))
+    fh.close()
+    return path
+
+
+def _load(hodconf, workdir):
+    return PreServiceConfigOpts.from_file_list([hodconf], workdir=workdir, modules='')
+
+
+def _autogen(precfg):
+    precfg = deepcopy(precfg)
+    precfg.autogen_configs()
+    return precfg
+
+
+def _resolver(precfg):
+    reg = TemplateRegistry()
+    register_templates(reg, precfg)
+    for ct in MASTER_TEMPLATES:
+        reg.register(ct)
+    return TemplateResolver(**reg.to_kwargs())
+
+
+def _service_configs(precfg, resolver):
+    return [ConfigOpts.from_file(open(fn, 'r'), resolver) for fn in precfg.service_files]
+
+
+def _resolve(precfg):
+    resolver = _resolver(precfg)
+    for dest_file, cfg in precfg.service_configs.items():
+        # the writers leave the templates in .properties files alone
+        if not dest_file.endswith('.properties'):
+            for key, value in cfg.items():
+                resolver(key)
+                resolver(value)
+    return resolver
+
+
+def _render(precfg, resolver):
+    config_writer = service_config_fn(precfg.config_writer)
+    for dest_file, cfg in precfg.service_configs.items():
+        config_writer(mkpath(precfg.configdir, dest_file), cfg, resolver)
+
+
+def _write(precfg, resolver):
+    config_writer = service_config_fn(precfg.config_writer)
+    for dest_file, cfg in precfg.service_configs.items():
+        write_service_config(mkpath(precfg.configdir, dest_file), cfg, config_writer, resolver)
+
+
+def _pipeline(hodconf, workdir):
+    precfg = _autogen(_load(hodconf, workdir))
+    resolver = _resolve(precfg)
+    _service_configs(precfg, resolver)
+    _write(precfg, resolver)
+
+
+def _measure(fn, repeat):
+    """Run fn repeat times; returns the statistics of the run times in seconds"""
+    times = []
+    for _ in range(repeat):
+        start = timeline.monotonic()
+        fn()
+        times.append(timeline.monotonic() - start)
+        # the instrumented functions record their calls
+        timeline.reset()
+    times.sort()
+    return {
+        'min': times[0],
+        'median': times[len(times) // 2],
+        'mean': sum(times) / len(times),
+        'max': times[-1],
+    }
+
+
+def bench_manifest(hodconf, workdir, repeat):
+    """Time all stages for the manifest hodconf; returns dict with the statistics per stage"""
+    precfg = _load(hodconf, workdir)
+    generated = _autogen(precfg)
+    resolver = _resolve(generated)
+    if not os.path.isdir(generated.configdir):
+        os.makedirs(generated.configdir)
+
+    stages = [
+        ('from_file_list', lambda: _load(hodconf, workdir)),
+        ('merge', lambda: merge(precfg, generated)),
+        ('autogen_configs', lambda: _autogen(precfg)),
+        ('service_configs', lambda: _service_configs(generated, resolver)),
+        ('resolve', lambda: _resolve(generated)),
+        ('hadoop_xml', lambda: _render(generated, resolver)),
+        ('write_service_config', lambda: _write(generated, resolver)),
+        ('pipeline', lambda: _pipeline(hodconf, workdir)),
+    ]
+    return dict([(name, _measure(fn, repeat)) for name, fn in stages])
+
+
+def manifest_size(hodconf, workdir):
+    """Number of properties and services of the manifest after autogen"""
+    precfg = _autogen(_load(hodconf, workdir))
+    nproperties = sum([len(cfg) for cfg in precfg.service_configs.values()])
+    return nproperties, len(precfg.service_files)
+
+
+def _int_list(value):
+    return [int(x) for x in value.split(',') if x]
+
+
+def run(opts):
+    """Run the benchmark for all manifests; returns the results"""
+    manifests = []
+    if opts.dists:
+        for dist in sorted(os.listdir(opts.etc_dir)):
+            hodconf = mkpath(opts.etc_dir, dist, 'hod.conf')
+            if os.path.exists(hodconf):
+                manifests.append((dist, hodconf))
+
+    # autogen and the templates get the node information from the shared inventory
+    hn._inventory = _FixedInventory()
+    tmpdir = tempfile.mkdtemp(prefix='bench_config_')
+    try:
+        for nproperties in _int_list(opts.properties):
+            for nservices in _int_list(opts.services):
+                name = 'synthetic-%dp-%ds' % (nproperties, nservices)
+                mdir = mkpath(tmpdir, name)
+                os.makedirs(mdir)
+                manifests.append((name, write_synthetic_manifest(mdir, nproperties, nservices)))
+
+        results = []
+        for name, hodconf in manifests:
+            workdir = mkpath(tmpdir, 'work', name)
+            os.makedirs(workdir)
+            try:
+                nproperties, nservices = manifest_size(hodconf, workdir)
+                stages = bench_manifest(hodconf, workdir, opts.repeat)
+            except Exception, err:
+                # e.g. a dist with a template that has to be filled in by the user
+                sys.stderr.write('%-40s failed: %s\n' % (name, err))
+                results.append({'manifest': name, 'error': str(err)})
+                continue
+            results.append({
+                'manifest': name,
+                'properties': nproperties,
+                'services': nservices,
+                'stages': stages,
+            })
+            sys.stderr.write('%-40s %6d properties %4d services: pipeline %.6fs\n' %
+                             (name, nproperties, nservices, stages['pipeline']['median']))
+    finally:
+        shutil.rmtree(tmpdir)
+        hn.reset_node_inventory()
+
+    return {
+        'hod_version': hod.VERSION,
+        'python': platform.python_version(),
+        'hostname': platform.node(),
+        'timestamp': time.strftime('%Y-%m-%dT%H:%M:%S'),
+        'repeat': opts.repeat,
+        'unit': 'seconds',
+        'results': results,
+    }
+
+
+def compare(previous, current):
+    """Print the median time per stage of current relative to previous for the manifests in both"""
+    old = dict([(res['manifest'], res['stages']) for res in previous['results'] if 'stages' in res])
+    print "%-40s %-22s %12s %12s %8s" % ('manifest', 'stage', 'previous', 'current', 'ratio')
+    for res in current['results']:
+        if res['manifest'] not in old or 'stages' not in res:
+            continue
+        for stage in STAGES:
+            before = old[res['manifest']].get(stage, {}).get('median')
+            after = res['stages'][stage]['median']
+            if before:
+                print "%-40s %-22s %12.6f %12.6f %8.2f" % (res['manifest'], stage, before, after, after / before)
+
+
+def main():
+    parser = OptionParser(usage=__doc__)
+    parser.add_option('--properties', default='100,1000',
+                      help='Comma separated list of the number of properties of the synthetic manifests')
+    parser.add_option('--services', default='10,100',
+                      help='Comma separated list of the number of services of the synthetic manifests')
+    parser.add_option('--no-dists', dest='dists', action='store_false', default=True,
+                      help='Do not benchmark the dists in etc/hod')
+    parser.add_option('--etc-dir', default=ETC_HOD, help='Directory with the dists')
+    parser.add_option('--repeat', type='int', default=10, help='Number of times to repeat each measurement')
+    parser.add_option('--output', default='-', help='File to write the JSON results to (default: stdout)')
+    parser.add_option('--compare', default=None, help='JSON results of an earlier run to compare with')
+    opts, _ = parser.parse_args()
+
+    results = run(opts)
+    if opts.output == '-':
+        if opts.compare is None:
+            json.dump(results, sys.stdout, indent=2, sort_keys=True)
+            print
+    else:
+        fh = open(opts.output, 'w')
+        json.dump(results, fh, indent=2, sort_keys=True)
+        fh.close()
+
+    if opts.compare is not None:
+        compare(json.load(open(opts.compare)), results)
+
+
+if __name__ == '__main__':
+    main()
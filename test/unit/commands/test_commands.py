@@ -25,9 +25,18 @@
 @author Ewan Higgs (Universiteit Gent)
 '''
 
+import os
+import shutil
+import signal
+import subprocess
+import tempfile
+import time
 import unittest
 import pytest
 import hod.commands.command as hcc
+import hod.node.node as hn
+
+from mock import patch
 
 class HodCommandsCommandTestCase(unittest.TestCase):
     '''Test Command functions'''
@@ -66,6 +75,26 @@ class HodCommandsCommandTestCase(unittest.TestCase):
         self.assertEqual(out, '')
         self.assertEqual(err, '')
 
+    def test_command_cpus(self):
+        '''test pinning a command to cpus'''
+        cpu = hn.node_inventory().usable_cores()[-1]
+        out, err = hcc.Command('grep Cpus_allowed_list /proc/self/status', cpus=[cpu]).run()
+        self.assertEqual(out.split(), ['Cpus_allowed_list:', str(cpu)])
+        # cpus that do not exist
+        out, err = hcc.Command('true', cpus=[1023]).run()
+        self.assertTrue('sched_setaffinity' in err)
+        self.assertTrue(err.endswith('Exitcode 127\n'))
+
+    def test_command_usage(self):
+        '''test command recording its resource usage'''
+        c = hcc.Command('python -c "x = \'x\' * (64 * 1024 * 1024)"; exit 2')
+        c.run()
+        self.assertEqual(c.usage['returncode'], 2)
+        self.assertTrue(c.usage['wall'] > 0)
+        self.assertTrue(c.usage['maxrss'] > 64 * 1024)
+        for field in ['utime', 'stime', 'inblock', 'oublock']:
+            self.assertTrue(field in c.usage)
+
     def test_command_run_echo_hello(self):
         '''test command echo hello '''
         c = hcc.Command('echo hello')
@@ -80,6 +109,89 @@ class HodCommandsCommandTestCase(unittest.TestCase):
         self.assertEqual(out, '')
         self.assertEqual(err, 'hello')
 
+    def test_command_run_large_output(self):
+        '''test command with more output than fits in a pipe'''
+        c = hcc.Command('head -c 1000000 /dev/zero | tr "\\0" x')
+        out, err = c.run()
+        self.assertEqual(out, 'x' * 1000000)
+        self.assertEqual(err, '')
+
+    def test_command_run_background(self):
+        '''test command that leaves a process with its stdout open'''
+        c = hcc.Command('sleep 5 & echo hello', timeout=10)
+        start = time.time()
+        out, err = c.run()
+        self.assertTrue(time.time() - start < 2)
+        self.assertEqual(out, 'hello')
+
+    def test_command_run_timeout(self):
+        '''test command that times out'''
+        c = hcc.Command('sleep 10', timeout=0.2)
+        start = time.time()
+        out, err = c.run()
+        self.assertTrue(time.time() - start < 2)
+        self.assertEqual(err, 'Exitcode -15\n')
+
+    def test_command_run_output_files(self):
+        '''test command streaming its output to files'''
+        tmpdir = tempfile.mkdtemp()
+        try:
+            stdout = hcc.RotatingFile(os.path.join(tmpdir, 'out'))
+            stderr = hcc.RotatingFile(os.path.join(tmpdir, 'err'))
+            c = hcc.Command('head -c 10000 /dev/zero | tr "\\0" x; echo hello 1>&2', stdout=stdout, stderr=stderr)
+            out, err = c.run()
+            stdout.close()
+            stderr.close()
+            self.assertEqual(out, 'x' * hcc.OUTPUT_TAIL)
+            self.assertEqual(err, 'hello')
+            self.assertEqual(open(os.path.join(tmpdir, 'out')).read(), 'x' * 10000)
+            self.assertEqual(open(os.path.join(tmpdir, 'err')).read(), 'hello\n')
+        finally:
+            shutil.rmtree(tmpdir)
+
+    def test_rotating_file(self):
+        '''test rotating a file that gets too large'''
+        tmpdir = tempfile.mkdtemp()
+        try:
+            path = os.path.join(tmpdir, 'log', 'out')
+            fh = hcc.RotatingFile(path, max_bytes=10, backups=2)
+            for data in ['aaaaaaaa', 'bbbbbbbb', 'cccccccc', 'dddddddd']:
+                fh.write(data)
+            fh.close()
+            self.assertEqual(open(path).read(), 'dddddddd')
+            self.assertEqual(open(path + '.1').read(), 'cccccccc')
+            self.assertEqual(open(path + '.2').read(), 'bbbbbbbb')
+            self.assertFalse(os.path.exists(path + '.3'))
+            # appends to the existing file
+            fh = hcc.RotatingFile(path, max_bytes=10, backups=2)
+            fh.write('e')
+            fh.close()
+            self.assertEqual(open(path).read(), 'dddddddde')
+        finally:
+            shutil.rmtree(tmpdir)
+
+    def test_kill_reaped(self):
+        '''test a reaped command is not signalled anymore'''
+        p = subprocess.Popen('sleep 5', shell=True)
+        with patch('os.kill') as kill:
+            hcc._kill(p, signal.SIGTERM)
+            kill.assert_called_once_with(p.pid, signal.SIGTERM)
+        hcc._kill(p, signal.SIGTERM)
+        hcc._wait(p)
+        self.assertEqual(p.returncode, -signal.SIGTERM)
+        # the pid may belong to another process now
+        with patch('os.kill') as kill:
+            hcc._kill(p, signal.SIGKILL)
+            self.assertFalse(kill.called)
+
+    def test_wait_exited(self):
+        '''test waiting for a command to exit does not reap it'''
+        p = subprocess.Popen('exit 3', shell=True)
+        hcc._wait_exited(p.pid)
+        # the pid is still ours until it is reaped
+        self.assertEqual(os.waitpid(p.pid, os.WNOHANG), (p.pid, 3 << 8))
+        self.assertRaises(OSError, hcc._wait_exited, p.pid)
+
     def test_generate_ssh_key(self):
         '''test generate ssh key'''
         c = hcc.GenerateSshKey('.')
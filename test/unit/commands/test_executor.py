@@ -0,0 +1,135 @@
+###
+# Copyright 2009-2015 Ghent University
+#
+# This file is part of hanythingondemand
+# originally created by the HPC team of Ghent University (http://ugent.be/hpc/en),
+# with support of Ghent University (http://ugent.be/hpc),
+# the Flemish Supercomputer Centre (VSC) (https://vscentrum.be/nl/en),
+# the Hercules foundation (http://www.herculesstichting.be/in_English)
+# and the Department of Economy, Science and Innovation (EWI) (http://www.ewi-vlaanderen.be/en).
+#
+# http://github.com/hpcugent/hanythingondemand
+#
+# hanythingondemand is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation v2.
+#
+# hanythingondemand is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with hanythingondemand. If not, see <http://www.gnu.org/licenses/>.
+"""
+Tests for hod.commands.executor
+"""
+import threading
+import time
+import unittest
+
+import hod.commands.command as hcc
+import hod.commands.executor as hce
+
+
+class HodCommandsExecutorTestCase(unittest.TestCase):
+    '''Test CommandExecutor'''
+
+    def test_submit(self):
+        '''test running calls and getting their results'''
+        executor = hce.CommandExecutor(2)
+        futures = [executor.submit(lambda x: x * 2, idx) for idx in range(5)]
+        self.assertEqual([future.result(5) for future in futures], [0, 2, 4, 6, 8])
+        self.assertTrue(len(executor._workers) <= 2)
+        executor.shutdown()
+
+    def test_submit_error(self):
+        '''test errors are raised by result'''
+        executor = hce.CommandExecutor(1)
+        future = executor.submit(int, 'not a number')
+        self.assertRaises(ValueError, future.result, 5)
+        self.assertTrue(isinstance(future.exception(), ValueError))
+        executor.shutdown()
+
+    def test_concurrent(self):
+        '''test calls run at the same time, but on at most max_workers threads'''
+        executor = hce.CommandExecutor(3)
+        lock = threading.Lock()
+        running = [0, 0]
+
+        def _call():
+            with lock:
+                running[0] += 1
+                running[1] = max(running)
+            time.sleep(0.2)
+            with lock:
+                running[0] -= 1
+
+        start = time.time()
+        done, not_done = hce.wait([executor.submit(_call) for _ in range(6)], 5)
+        self.assertEqual((len(done), len(not_done)), (6, 0))
+        self.assertEqual(running[1], 3)
+        self.assertTrue(time.time() - start < 1)
+        executor.shutdown()
+
+    def test_cancel(self):
+        '''test cancelling pending and running commands'''
+        executor = hce.CommandExecutor(1)
+        running = executor.submit_command(hcc.Command('sleep 10'))
+        pending = executor.submit_command(hcc.Command('sleep 10'))
+        time.sleep(0.2)
+        self.assertTrue(pending.cancel())
+        self.assertRaises(hce.CancelledError, pending.result, 1)
+        start = time.time()
+        self.assertTrue(running.cancel())
+        self.assertTrue(running.wait(5))
+        self.assertTrue(time.time() - start < 2)
+        self.assertTrue(running.cancelled())
+        self.assertRaises(hce.CancelledError, running.result)
+        # calls that are done can't be cancelled
+        done = executor.submit(int, '1')
+        self.assertEqual(done.result(5), 1)
+        self.assertFalse(done.cancel())
+        executor.shutdown()
+
+    def test_attach_command(self):
+        '''test cancelling a call terminates the command it attached'''
+        executor = hce.CommandExecutor(1)
+        commands = [hcc.Command('sleep 10'), hcc.Command('sleep 10')]
+
+        def _call():
+            for command in commands:
+                hce.attach_command(command)
+                command.run()
+
+        future = executor.submit(_call)
+        time.sleep(0.2)
+        start = time.time()
+        self.assertTrue(future.cancel())
+        self.assertTrue(future.wait(5))
+        self.assertTrue(time.time() - start < 2)
+        self.assertTrue(future.cancelled())
+        # the command attached after the cancel did not run
+        self.assertEqual(commands[1]._proc, None)
+        # outside of a worker thread there is nothing to attach to
+        hce.attach_command(hcc.Command('true'))
+        executor.shutdown()
+
+    def test_run_commands(self):
+        '''test running commands with aggregated results'''
+        executor = hce.CommandExecutor(4)
+        commands = [hcc.Command('echo one'), hcc.Command('echo two'), hcc.Command('sleep 10')]
+        start = time.time()
+        results = executor.run_commands(commands, timeout=0.5)
+        self.assertTrue(time.time() - start < 2)
+        self.assertEqual([result.output for result in results[:2]], [('one', ''), ('two', '')])
+        self.assertEqual([result.cancelled for result in results], [False, False, True])
+        self.assertTrue(results[2].command is commands[2])
+        executor.shutdown()
+
+    def test_shutdown(self):
+        '''test no calls can be submitted after shutdown'''
+        executor = hce.CommandExecutor(1)
+        executor.shutdown()
+        self.assertRaises(RuntimeError, executor.submit, int, '1')
+        self.assertRaises(ValueError, hce.CommandExecutor, 0)
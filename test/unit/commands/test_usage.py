@@ -0,0 +1,99 @@
+###
+# Copyright 2009-2015 Ghent University
+#
+# This file is part of hanythingondemand
+# originally created by the HPC team of Ghent University (http://ugent.be/hpc/en),
+# with support of Ghent University (http://ugent.be/hpc),
+# the Flemish Supercomputer Centre (VSC) (https://vscentrum.be/nl/en),
+# the Hercules foundation (http://www.herculesstichting.be/in_English)
+# and the Department of Economy, Science and Innovation (EWI) (http://www.ewi-vlaanderen.be/en).
+#
+# http://github.com/hpcugent/hanythingondemand
+#
+# hanythingondemand is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation v2.
+#
+# hanythingondemand is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with hanythingondemand. If not, see <http://www.gnu.org/licenses/>.
+"""
+Tests for hod.commands.usage
+"""
+import json
+import os
+import shutil
+import tempfile
+import unittest
+
+import hod.commands.usage as hcu
+
+
+def _record(service, rank, script, wall, **kwargs):
+    record = dict(service=service, rank=rank, host='node%d' % rank, script=script, wall=wall, returncode=0,
+                  utime=0.5, stime=0.25, maxrss=2048, inblock=0, oublock=8)
+    record.update(kwargs)
+    return record
+
+
+class HodCommandsUsageTestCase(unittest.TestCase):
+    '''Test the resource usage of commands'''
+
+    def test_returncode(self):
+        self.assertEqual(hcu.returncode(3 << 8), 3)
+        self.assertEqual(hcu.returncode(15), -15)
+
+    def test_rusage_fields(self):
+        rusage = os.wait4(os.spawnlp(os.P_NOWAIT, 'true', 'true'), 0)[2]
+        fields = hcu.rusage_fields(rusage)
+        self.assertEqual(sorted(fields.keys()), sorted(hcu.RUSAGE_FIELDS))
+        self.assertTrue(fields['maxrss'] > 0)
+        self.assertEqual(hcu.rusage_fields(None), {})
+
+    def test_write_record(self):
+        tmpdir = tempfile.mkdtemp()
+        try:
+            path = os.path.join(tmpdir, hcu.USAGE_FILENAME)
+            hcu.write_record(path, _record('hdfs', 0, 'ExecStartPre', 12.5))
+            hcu.write_record(path, _record('hdfs', 0, 'ExecStart', 1.5))
+            records = [json.loads(line) for line in open(path)]
+            self.assertEqual([record['script'] for record in records], ['ExecStartPre', 'ExecStart'])
+        finally:
+            shutil.rmtree(tmpdir)
+
+    def test_read_records(self):
+        tmpdir = tempfile.mkdtemp()
+        try:
+            paths = [os.path.join(tmpdir, 'rank%d' % rank) for rank in range(2)]
+            hcu.write_record(paths[0], _record('hdfs', 0, 'ExecStart', 1.5))
+            hcu.write_record(paths[1], _record('hdfs', 1, 'ExecStart', 0.5))
+            # a record that is still being written
+            open(paths[1], 'a').write('{"service": "hd')
+            records = hcu.read_records(paths)
+            self.assertEqual([record['rank'] for record in records], [0, 1])
+            self.assertEqual(hcu.read_records([]), [])
+        finally:
+            shutil.rmtree(tmpdir)
+
+    def test_summary_table(self):
+        records = [
+            _record('yarn', 0, 'ExecStart', 2.0),
+            _record('hdfs', 0, 'ExecStart', 1.0),
+            _record('hdfs', 0, 'ExecStartPre', 12.5, maxrss=512000),
+            _record('hdfs', 1, 'ExecStop', 0.5, returncode=-15),
+        ]
+        table = hcu.summary_table(records)
+        self.assertEqual(table[0].split(), ['service', 'rank', 'host', 'script', 'wall(s)', 'user(s)', 'sys(s)',
+                                            'maxrss(MB)', 'exit', 'commands', 'total(s)'])
+        # slowest service first, slowest command per rank
+        self.assertEqual([line.split() for line in table[1:]], [
+            ['hdfs', '0', 'node0', 'ExecStartPre', '12.50', '0.50', '0.25', '500.0', '0', '2', '13.50'],
+            ['hdfs', '1', 'node1', 'ExecStop', '0.50', '0.50', '0.25', '2.0', '-15', '1', '0.50'],
+            ['yarn', '0', 'node0', 'ExecStart', '2.00', '0.50', '0.25', '2.0', '0', '1', '2.00'],
+        ])
+        self.assertEqual(len(hcu.summary_table(records, slowest=2)), 5)
+        self.assertEqual(len(hcu.summary_table([])), 1)
@@ -131,6 +131,30 @@ class TestConfigAutogenCommon(unittest.TestCase):
                 memory=dict(meminfo=dict(memtotal=total_mem), ulimit='12345'))
         self.assertEqual(hcc.available_memory(node), 12345)
 
+    def test_available_memory_cgroup(self):
+        total_mem = 68719476736
+        node = dict(fqdn='hosty.domain.be', network='ib0', pid=1234,
+                cores=24, totalcores=24, usablecores=range(24), topology=[0],
+                memory=dict(meminfo=dict(memtotal=total_mem), ulimit='unlimited',
+                            cgroup=hcc.parse_memory('16g')))
+        self.assertEqual(hcc.available_memory(node), hcc.parse_memory('14g'))
+        node['memory']['cgroup'] = hcc.parse_memory('2g')
+        self.assertEqual(hcc.available_memory(node), hcc.parse_memory('1g'))
+        # the share of the cores is tighter than the cgroup
+        node['memory']['cgroup'] = hcc.parse_memory('48g')
+        node['cores'] = 8
+        avail = total_mem - hcc.parse_memory('8g')
+        self.assertEqual(hcc.available_memory(node), int(avail * 1./3))
+        node['memory']['ulimit'] = '12345'
+        self.assertEqual(hcc.available_memory(node), 12345)
+
+    def test_available_memory_ulimit_entire_machine(self):
+        total_mem = 68719476736
+        node = dict(fqdn='hosty.domain.be', network='ib0', pid=1234,
+                cores=24, totalcores=24, usablecores=range(24), topology=[0],
+                memory=dict(meminfo=dict(memtotal=total_mem), ulimit='12345'))
+        self.assertEqual(hcc.available_memory(node), 12345)
+
     def test_available_memory_one_third(self):
         total_mem = 68719476736
         node = dict(fqdn='hosty.domain.be', network='ib0', pid=1234,
@@ -70,7 +70,9 @@ class TestConfigAutogenHadoop(unittest.TestCase):
                 cores=24, totalcores=24, usablecores=range(24), topology=[0],
                 memory=dict(meminfo=dict(memtotal=68719476736), ulimit='unlimited'))
         d = hca.yarn_site_xml_defaults('/', node)
-        self.assertEqual(len(d), 13)
+        self.assertEqual(len(d), 15)
+        self.assertEqual(d['yarn.nodemanager.resource.cpu-vcores'], 24)
+        self.assertEqual(d['yarn.scheduler.maximum-allocation-vcores'], 24)
         self.assertEqual(d['yarn.nodemanager.resource.memory-mb'], hcc.round_mb(hcc.parse_memory('56G')))
         self.assertEqual(d['yarn.resourcemanager.webapp.address'], '$masterhostaddress:8088')
         self.assertEqual(d['yarn.resourcemanager.webapp.https.address'], '$masterhostaddress:8090')
@@ -79,6 +81,37 @@ class TestConfigAutogenHadoop(unittest.TestCase):
         self.assertEqual(d['yarn.scheduler.minimum-allocation-mb'], hcc.round_mb(hcc.parse_memory('2G')))
         self.assertEqual(d['yarn.scheduler.maximum-allocation-mb'], hcc.round_mb(hcc.parse_memory('56G')))
 
+    def test_yarn_site_xml_defaults_cluster(self):
+        # the master is a small node, the slaves are big ones
+        master = dict(fqdn='master.domain.be', network='ib0', pid=1234,
+                cores=8, totalcores=8, usablecores=range(8), topology=[0], reservedcores=[7],
+                memory=dict(meminfo=dict(memtotal=hcc.parse_memory('16G')), ulimit='unlimited'))
+        slave = dict(master, fqdn='slave.domain.be', cores=24, totalcores=24, usablecores=range(24),
+                memory=dict(meminfo=dict(memtotal=68719476736), ulimit='unlimited'))
+        master['cluster'] = dict(nodes=3, members=[master, slave, slave])
+        d = hca.yarn_site_xml_defaults('/', master)
+        self.assertEqual(d['yarn.scheduler.maximum-allocation-mb'], hcc.round_mb(hcc.parse_memory('56G')))
+        self.assertEqual(d['yarn.scheduler.maximum-allocation-vcores'], 23)
+        mem_dflts = hca.memory_defaults(master)
+        self.assertEqual(d['yarn.nodemanager.resource.memory-mb'],
+                         hcc.round_mb(mem_dflts.ram_per_container * mem_dflts.num_containers))
+        self.assertEqual(d['yarn.nodemanager.resource.cpu-vcores'], 7)
+        self.assertEqual(d['yarn.scheduler.minimum-allocation-mb'], hcc.round_mb(mem_dflts.ram_per_container))
+
+        # the map containers fit on all nodes
+        d = hca.mapred_site_xml_defaults('/', dict(slave, cluster=master['cluster']))
+        self.assertEqual(d['mapreduce.map.memory.mb'], hcc.round_mb(mem_dflts.ram_per_container))
+        self.assertEqual(d['mapreduce.map.memory.mb'], hca.mapred_site_xml_defaults('/', master)['mapreduce.map.memory.mb'])
+
+    def test_yarn_site_xml_defaults_reserved_cores(self):
+        node = dict(fqdn='hosty.domain.be', network='ib0', pid=1234,
+                cores=24, totalcores=24, usablecores=range(24), topology=[0], reservedcores=[22, 23],
+                memory=dict(meminfo=dict(memtotal=68719476736), ulimit='unlimited'))
+        d = hca.yarn_site_xml_defaults('/', node)
+        self.assertEqual(d['yarn.nodemanager.resource.cpu-vcores'], 22)
+        node['cores'] = 2
+        self.assertEqual(hca.container_vcores(node), 1)
+
     def test_capacity_scheduler_xml_defaults(self):
         node = dict(fqdn='hosty.domain.be', network='ib0', pid=1234,
                 cores=24, totalcores=24, usablecores=range(24), topology=[0],
@@ -92,6 +125,24 @@ class TestConfigAutogenHadoop(unittest.TestCase):
                 'org.apache.hadoop.yarn.util.resource.DominantResourceCalculator')
         self.assertEqual(d['yarn.scheduler.capacity.root.default.acl_submit_applications'], '$user')
         self.assertEqual(d['yarn.scheduler.capacity.root.default.acl_administer_queue'], '$user')
+    def test_memory_defaults_numa(self):
+        node = dict(fqdn='hosty.domain.be', network='ib0', pid=1234,
+                cores=7, totalcores=32, usablecores=range(4) + range(8, 11), topology=[0],
+                memory=dict(meminfo=dict(memtotal=hcc.parse_memory('512g')), ulimit='unlimited'))
+        self.assertEqual(hca.memory_defaults(node).num_containers, 14)
+        node['topology'] = [dict(node=0, cpus=range(8), memory=None),
+                            dict(node=1, cpus=range(8, 16), memory=None),
+                            dict(node=2, cpus=range(16, 24), memory=None),
+                            dict(node=3, cpus=range(24, 32), memory=None)]
+        self.assertEqual(hcc.numa_nodes(node), 2)
+        self.assertEqual(hca.memory_defaults(node).num_containers, 14)
+        node['usablecores'] = range(0, 32, 5)
+        self.assertEqual(hcc.numa_nodes(node), 4)
+        mem_dflts = hca.memory_defaults(node)
+        self.assertEqual(mem_dflts.num_containers, 12)
+        self.assertEqual(mem_dflts.ram_per_container, mem_dflts.available_memory / 12)
+        self.assertEqual(hcc.round_to_numa_nodes(3, node), 3)
+
     def test_autogen_config(self):
         node = dict(fqdn='hosty.domain.be', network='ib0', pid=1234,
                 cores=24, totalcores=24, usablecores=range(24), topology=[0],
@@ -28,6 +28,8 @@
 
 import os
 import os.path
+import shutil
+import tempfile
 import unittest
 from mock import patch 
 from os.path import basename
@@ -133,13 +135,15 @@ autogen=hadoop
         node = dict(fqdn='hosty.domain.be', network='ib0', pid=1234,
                 cores=24, totalcores=24, usablecores=range(24), topology=[0],
                 memory=dict(meminfo=dict(memtotal=68719476736), ulimit='unlimited'))
-        with patch('hod.node.node.Node.go', return_value=node):
-            precfg.autogen_configs()
+        with patch('hod.node.node.NodeInventory.node_info', return_value=node):
+            with patch('hod.config.config.reserved_service_cores', return_value=[22, 23]):
+                precfg.autogen_configs()
         self.assertEqual(len(precfg.service_configs), 4)
         self.assertTrue('core-site.xml' in precfg.service_configs)
         self.assertTrue('mapred-site.xml' in precfg.service_configs)
         self.assertTrue('yarn-site.xml' in precfg.service_configs)
         self.assertTrue('yarn.nodemanager.hostname' in precfg.service_configs['yarn-site.xml'])
+        self.assertEqual(precfg.service_configs['yarn-site.xml']['yarn.nodemanager.resource.cpu-vcores'], 22)
 
 
     def test_PreServiceConfigOpts_autogen_hadoop_override(self):
@@ -164,7 +168,7 @@ yarn.nodemanager.hostname = 192.167.0.1
         node = dict(fqdn='hosty.domain.be', network='ib0', pid=1234,
                 cores=24, totalcores=24, usablecores=range(24), topology=[0],
                 memory=dict(meminfo=dict(memtotal=68719476736), ulimit='unlimited'))
-        with patch('hod.node.node.Node.go', return_value=node):
+        with patch('hod.node.node.NodeInventory.node_info', return_value=node):
             precfg.autogen_configs()
         self.assertEqual(len(precfg.service_configs), 4)
         self.assertTrue('core-site.xml' in precfg.service_configs)
@@ -281,6 +285,218 @@ SOME_ENV=123""")
         self.assertEqual(cfg._runs_on, hcc.RUNS_ON_ALL)
         self.assertEqual(cfg.runs_on(0, [0, 1, 2]), [0, 1, 2])
 
+    def test_ConfigOpts_after_requires(self):
+        config = StringIO("""
+[Unit]
+Name=testconfig
+RunsOn=all
+After=svc1, svc2
+Requires=svc3 svc4
+
+[Service]
+ExecStart=starter
+ExecStop=stopper
+
+[Environment]
+""")
+        cfg = hcc.ConfigOpts.from_file(config, hct.TemplateResolver(workdir=''))
+        self.assertEqual(cfg.after, ['svc1', 'svc2'])
+        self.assertEqual(cfg.requires, ['svc3', 'svc4'])
+        params = cfg.to_params('workdir', 'modules', [])
+        self.assertEqual(params.after, ['svc1', 'svc2'])
+        self.assertEqual(params.requires, ['svc3', 'svc4'])
+        remade_cfg = hcc.ConfigOpts.from_params(params, hct.TemplateResolver(workdir=''))
+        self.assertEqual(remade_cfg.after, ['svc1', 'svc2'])
+        self.assertEqual(remade_cfg.requires, ['svc3', 'svc4'])
+
+    def test_ConfigOpts_ready_check(self):
+        config = StringIO("""
+[Unit]
+Name=testconfig
+RunsOn=master
+
+[Service]
+ExecStart=starter
+ExecStop=stopper
+ReadyCheck=tcp:$workdir:1234
+ReadyTimeout=10
+
+[Environment]
+""")
+        cfg = hcc.ConfigOpts.from_file(config, hct.TemplateResolver(workdir='somehost'))
+        self.assertEqual(cfg.ready_check, 'tcp:somehost:1234')
+        self.assertEqual(cfg.ready_timeout, 10)
+        params = cfg.to_params('workdir', 'modules', [])
+        self.assertEqual(params.ready_check, 'tcp:$workdir:1234')
+        remade_cfg = hcc.ConfigOpts.from_params(params, hct.TemplateResolver(workdir='otherhost'))
+        self.assertEqual(remade_cfg.ready_check, 'tcp:otherhost:1234')
+        self.assertEqual(remade_cfg.ready_timeout, 10)
+
+        config = StringIO("""
+[Unit]
+Name=testconfig
+RunsOn=master
+
+[Service]
+ExecStart=starter
+ExecStop=stopper
+ReadyCheck=udp:somehost:1234
+
+[Environment]
+""")
+        self.assertRaises(ValueError, hcc.ConfigOpts.from_file, config, hct.TemplateResolver(workdir=''))
+
+    def test_ConfigOpts_restart(self):
+        config = StringIO("""
+[Unit]
+Name=testconfig
+RunsOn=all
+
+[Service]
+ExecStart=starter
+ExecStop=stopper
+Restart=on-failure
+RestartLimit=5
+LivenessCheck=pid:$workdir/svc.pid
+
+[Environment]
+""")
+        cfg = hcc.ConfigOpts.from_file(config, hct.TemplateResolver(workdir='/tmp'))
+        self.assertEqual(cfg.restart, hcc.RESTART_ON_FAILURE)
+        self.assertEqual(cfg.restart_limit, 5)
+        self.assertEqual(cfg.liveness_check, 'pid:/tmp/svc.pid')
+        params = cfg.to_params('workdir', 'modules', [])
+        self.assertEqual(params.liveness_check, 'pid:$workdir/svc.pid')
+        remade_cfg = hcc.ConfigOpts.from_params(params, hct.TemplateResolver(workdir='/other'))
+        self.assertEqual(remade_cfg.liveness_check, 'pid:/other/svc.pid')
+        self.assertEqual(remade_cfg.restart, hcc.RESTART_ON_FAILURE)
+        self.assertEqual(remade_cfg.restart_limit, 5)
+
+        config = StringIO("""
+[Unit]
+Name=testconfig
+RunsOn=all
+
+[Service]
+ExecStart=starter
+ExecStop=stopper
+
+[Environment]
+""")
+        cfg = hcc.ConfigOpts.from_file(config, hct.TemplateResolver(workdir='/tmp'))
+        self.assertEqual(cfg.restart, hcc.RESTART_NO)
+        self.assertEqual(cfg.restart_limit, hcc.RESTART_LIMIT)
+        self.assertEqual(cfg.liveness_check, '')
+
+    def test_ConfigOpts_restart_invalid(self):
+        service = """
+[Unit]
+Name=testconfig
+RunsOn=all
+
+[Service]
+ExecStart=starter
+ExecStop=stopper
+%s
+
+[Environment]
+"""
+        for lines in ['Restart=always\nLivenessCheck=pid:/tmp/svc.pid', 'Restart=on-failure',
+                      'LivenessCheck=udp:somehost:1234']:
+            self.assertRaises(ValueError, hcc.ConfigOpts.from_file, StringIO(service % lines),
+                              hct.TemplateResolver(workdir=''))
+
+    def test_ConfigOpts_cpu_pinning(self):
+        service = """
+[Unit]
+Name=testconfig
+RunsOn=%s
+
+[Service]
+ExecStart=starter
+ExecStop=stopper
+%s
+
+[Environment]
+"""
+        cfg = hcc.ConfigOpts.from_file(StringIO(service % ('all', 'CPUAffinity=0-1 4,6')),
+                                       hct.TemplateResolver(workdir=''))
+        self.assertEqual(cfg.cpu_affinity, [0, 1, 4, 6])
+        self.assertEqual(cfg.reserved_cores, 0)
+        remade_cfg = hcc.ConfigOpts.from_params(cfg.to_params('workdir', 'modules', []), hct.TemplateResolver(workdir=''))
+        self.assertEqual(remade_cfg.cpu_affinity, [0, 1, 4, 6])
+
+        cfg = hcc.ConfigOpts.from_file(StringIO(service % ('all', 'ReservedCores=2')), hct.TemplateResolver(workdir=''))
+        self.assertEqual(cfg.cpu_affinity, None)
+        self.assertEqual(cfg.to_params('workdir', 'modules', []).reserved_cores, 2)
+
+        cfg = hcc.ConfigOpts.from_file(StringIO(service % ('all', '')), hct.TemplateResolver(workdir=''))
+        self.assertEqual((cfg.cpu_affinity, cfg.reserved_cores), (None, 0))
+
+        for lines in ['CPUAffinity=0-x', 'ReservedCores=-1', 'CPUAffinity=0\nReservedCores=1']:
+            self.assertRaises(ValueError, hcc.ConfigOpts.from_file, StringIO(service % ('all', lines)),
+                              hct.TemplateResolver(workdir=''))
+
+        tmpdir = tempfile.mkdtemp()
+        try:
+            service_files = []
+            for idx, (runs_on, lines) in enumerate([('all', 'ReservedCores=2'), ('slave', 'CPUAffinity=0 7 99'),
+                                                    ('master', 'CPUAffinity=3'), ('all', '')]):
+                service_files.append(os.path.join(tmpdir, 'svc%d.conf' % idx))
+                open(service_files[-1], 'w').write(service % (runs_on, lines))
+            service_files.append(os.path.join(tmpdir, 'missing.conf'))
+            pinning = hcc.slave_cpu_pinning(service_files)
+            self.assertEqual(pinning, [(None, 2), ([0, 7, 99], 0), (None, 0)])
+            self.assertEqual(hcc.reserved_service_cores(pinning, range(8)), [0, 6, 7])
+        finally:
+            shutil.rmtree(tmpdir)
+
+    def test_ConfigOpts_no_after_requires(self):
+        config = StringIO("""
+[Unit]
+Name=testconfig
+RunsOn=all
+After=
+
+[Service]
+ExecStart=starter
+ExecStop=stopper
+
+[Environment]
+""")
+        cfg = hcc.ConfigOpts.from_file(config, hct.TemplateResolver(workdir=''))
+        self.assertEqual(cfg.after, [])
+        self.assertEqual(cfg.requires, None)
+
+    def test_service_start_phases(self):
+        def _svc(name, after=None, requires=None):
+            return hcc.ConfigOpts(name, hcc.RUNS_ON_ALL, '', 'start', 'stop', {}, None,
+                                  after=after, requires=requires)
+        # no dependencies declared: strictly sequential
+        svcs = [_svc('a'), _svc('b'), _svc('c')]
+        self.assertEqual(hcc.service_start_phases(svcs), [[0], [1], [2]])
+        # hbase-like setup
+        svcs = [
+            _svc('zookeeper', after=[]),
+            _svc('namenode', after=[]),
+            _svc('datanode', requires=['namenode']),
+            _svc('hbase-master', after=['datanode'], requires=['zookeeper', 'namenode']),
+            _svc('regionserver', requires=['hbase-master']),
+            _svc('screen', after=[]),
+            _svc('script'),
+        ]
+        self.assertEqual(hcc.service_start_phases(svcs), [[0, 1, 5], [2], [3], [4], [6]])
+        # unknown After= is ignored
+        svcs = [_svc('a', after=['nosuchservice']), _svc('b', after=[])]
+        self.assertEqual(hcc.service_start_phases(svcs), [[0, 1]])
+        # unknown Requires= is not
+        svcs = [_svc('a', requires=['nosuchservice'])]
+        self.assertRaises(ValueError, hcc.service_start_phases, svcs)
+        # cycles
+        svcs = [_svc('a', after=['b']), _svc('b', after=['a'])]
+        self.assertRaises(ValueError, hcc.service_start_phases, svcs)
+        self.assertEqual(hcc.service_start_phases([]), [])
+
     def test_parse_runs_on(self):
         self.assertEqual(hcc._parse_runs_on('masTeR'), hcc.RUNS_ON_MASTER)
         self.assertEqual(hcc._parse_runs_on('slavE'), hcc.RUNS_ON_SLAVE)
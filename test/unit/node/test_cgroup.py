@@ -0,0 +1,112 @@
+###
+# Copyright 2009-2015 Ghent University
+#
+# This file is part of hanythingondemand
+# originally created by the HPC team of Ghent University (http://ugent.be/hpc/en),
+# with support of Ghent University (http://ugent.be/hpc),
+# the Flemish Supercomputer Centre (VSC) (https://vscentrum.be/nl/en),
+# the Hercules foundation (http://www.herculesstichting.be/in_English)
+# and the Department of Economy, Science and Innovation (EWI) (http://www.ewi-vlaanderen.be/en).
+#
+# http://github.com/hpcugent/hanythingondemand
+#
+# hanythingondemand is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation v2.
+#
+# hanythingondemand is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with hanythingondemand. If not, see <http://www.gnu.org/licenses/>.
+"""
+Tests for hod.node.cgroup
+"""
+import os
+import shutil
+import tempfile
+import unittest
+
+import hod.node.cgroup as hnc
+
+
+class HodNodeCgroupTestCase(unittest.TestCase):
+    '''Test reading the cgroup limits from a fake cgroup file system'''
+
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.proc_cgroup = os.path.join(self.tmpdir, 'cgroup')
+        self.proc_mountinfo = os.path.join(self.tmpdir, 'mountinfo')
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def _write(self, path, txt):
+        path = os.path.join(self.tmpdir, path)
+        if not os.path.isdir(os.path.dirname(path)):
+            os.makedirs(os.path.dirname(path))
+        open(path, 'w').write(txt)
+
+    def _mount(self, lines):
+        self._write('mountinfo', ''.join(['%d 1 0:%d %s\n' % (i + 30, i, line) for i, line in enumerate(lines)]))
+
+    def _limits(self):
+        return hnc.get_cgroup_limits(self.proc_cgroup, self.proc_mountinfo)
+
+    def test_cgroup_v1(self):
+        '''test the limits of a torque job in cgroup v1'''
+        mnt = os.path.join(self.tmpdir, 'sys')
+        self._write('cgroup', '4:memory:/torque/123.master\n3:cpu,cpuacct:/torque/123.master\n2:cpuset:/\n')
+        self._mount([
+            '/ %s/memory rw - cgroup cgroup rw,memory' % mnt,
+            '/ %s/cpu,cpuacct rw - cgroup cgroup rw,cpu,cpuacct' % mnt,
+            '/ %s/cpuset rw - cgroup cgroup rw,cpuset' % mnt,
+            '/ %s/tmp rw - tmpfs tmpfs rw' % mnt,
+        ])
+        self.assertEqual(hnc.cgroup_dirs(self.proc_cgroup, self.proc_mountinfo), {
+            'memory': ('%s/memory' % mnt, 'torque/123.master'),
+            'cpu': ('%s/cpu,cpuacct' % mnt, 'torque/123.master'),
+            'cpuacct': ('%s/cpu,cpuacct' % mnt, 'torque/123.master'),
+            'cpuset': ('%s/cpuset' % mnt, ''),
+        })
+        self.assertEqual(self._limits(), dict(memory=None, cpus=None))
+
+        self._write('sys/memory/memory.limit_in_bytes', '9223372036854771712\n')
+        self._write('sys/memory/torque/memory.limit_in_bytes', '%d\n' % (64 * 1024 ** 3))
+        self._write('sys/memory/torque/123.master/memory.limit_in_bytes', '%d\n' % (16 * 1024 ** 3))
+        self._write('sys/cpu,cpuacct/torque/123.master/cpu.cfs_quota_us', '-1\n')
+        self._write('sys/cpu,cpuacct/torque/123.master/cpu.cfs_period_us', '100000\n')
+        self.assertEqual(self._limits(), dict(memory=16 * 1024 ** 3, cpus=None))
+
+        # a parent limit is tighter
+        self._write('sys/memory/torque/memory.limit_in_bytes', '%d\n' % (8 * 1024 ** 3))
+        self._write('sys/cpu,cpuacct/torque/cpu.cfs_quota_us', '250000\n')
+        self._write('sys/cpu,cpuacct/torque/cpu.cfs_period_us', '100000\n')
+        self.assertEqual(self._limits(), dict(memory=8 * 1024 ** 3, cpus=3))
+
+    def test_cgroup_v2(self):
+        '''test the limits of a job in cgroup v2, seen from a cgroup namespace'''
+        mnt = os.path.join(self.tmpdir, 'sys')
+        self._write('cgroup', '0::/job.123/step\n')
+        self._mount(['/job.123 %s rw - cgroup2 cgroup2 rw' % mnt])
+        self.assertEqual(hnc.cgroup_dirs(self.proc_cgroup, self.proc_mountinfo), {hnc.UNIFIED: (mnt, 'step')})
+
+        self._write('sys/memory.max', '%d\n' % (4 * 1024 ** 3))
+        self._write('sys/cpu.max', 'max 100000\n')
+        self._write('sys/step/memory.max', 'max\n')
+        self._write('sys/step/cpu.max', '400000 100000\n')
+        self.assertEqual(self._limits(), dict(memory=4 * 1024 ** 3, cpus=4))
+
+    def test_no_cgroups(self):
+        '''test reading the limits without cgroup information'''
+        self.assertEqual(self._limits(), dict(memory=None, cpus=None))
+        self._write('cgroup', 'garbage\n')
+        self._write('mountinfo', '')
+        self.assertEqual(self._limits(), dict(memory=None, cpus=None))
+
+    def test_get_cgroup_limits(self):
+        '''test reading the limits of the current process'''
+        limits = hnc.get_cgroup_limits()
+        self.assertEqual(sorted(limits.keys()), ['cpus', 'memory'])
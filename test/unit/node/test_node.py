@@ -28,13 +28,39 @@
 from StringIO import StringIO
 from mock import patch
 import copy
+import json
+import os
+import shutil
 import socket
+import tempfile
+import threading
+import time
 import unittest
 import hod.node.node as hn
 
 class HodNodeTestCase(unittest.TestCase):
     '''Test Node functions'''
 
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.cache_path = os.path.join(self.tmpdir, 'dns-cache.json')
+        self.sysfs_net = os.path.join(self.tmpdir, 'net')
+        self.sysfs_infiniband = os.path.join(self.tmpdir, 'infiniband')
+        for patcher in [patch('hod.node.node.dns_cache_path', return_value=self.cache_path),
+                        patch('hod.node.node.SYSFS_NET', self.sysfs_net),
+                        patch('hod.node.node.SYSFS_INFINIBAND', self.sysfs_infiniband)]:
+            patcher.start()
+            self.addCleanup(patcher.stop)
+
+    def _sysfs(self, path, value):
+        path = os.path.join(self.tmpdir, path)
+        if not os.path.isdir(os.path.dirname(path)):
+            os.makedirs(os.path.dirname(path))
+        open(path, 'w').write('%s\n' % value)
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
     def test_netmask2maskbits(self):
         '''test netmask2maskbits'''
         self.assertEqual(0, hn.netmask2maskbits('0.0.0.0'))
@@ -127,6 +153,54 @@ class HodNodeTestCase(unittest.TestCase):
                             hn.NetworkInterface('wibble01.wibble.data', '10.143.13.2', 'ib0', 16),
                             hn.NetworkInterface('wibble.sitename.nat', '172.24.13.2', 'em1.295@em1', 16),
                             ])
+
+    def test_resolve_hostnames_concurrent(self):
+        '''test resolve_hostnames looking up all addresses at once and falling back to the address'''
+        release = threading.Event()
+        def _getfqdn(addr):
+            if addr == '10.0.0.3':
+                release.wait(5)
+            elif addr == '10.0.0.2':
+                return addr
+            else:
+                time.sleep(0.2)
+            return 'host-%s' % addr
+
+        start = time.time()
+        with patch('socket.getfqdn', side_effect=_getfqdn) as getfqdn:
+            hostnames = hn.resolve_hostnames(['10.0.0.1', '10.0.0.2', '10.0.0.3', '10.0.0.4'], timeout=0.5)
+        release.set()
+        self.assertTrue(time.time() - start < 1.5)
+        self.assertEqual(getfqdn.call_count, 4)
+        self.assertEqual(hostnames, {
+            '10.0.0.1': 'host-10.0.0.1',
+            '10.0.0.2': '10.0.0.2',
+            '10.0.0.3': '10.0.0.3',
+            '10.0.0.4': 'host-10.0.0.4',
+        })
+        cache = json.load(open(self.cache_path))
+        self.assertEqual(cache['10.0.0.1'][0], 'host-10.0.0.1')
+        self.assertTrue(cache['10.0.0.1'][1] > cache['10.0.0.2'][1])
+
+    def test_resolve_hostnames_cache(self):
+        '''test resolve_hostnames reusing and expiring the cached hostnames'''
+        json.dump({'10.0.0.1': ['cached', time.time() + 60], '10.0.0.2': ['expired', time.time() - 1]},
+                  open(self.cache_path, 'w'))
+        with patch('socket.getfqdn', return_value='resolved') as getfqdn:
+            hostnames = hn.resolve_hostnames(['10.0.0.1', '10.0.0.2'])
+            self.assertEqual(hostnames, {'10.0.0.1': 'cached', '10.0.0.2': 'resolved'})
+            getfqdn.assert_called_once_with('10.0.0.2')
+            self.assertEqual(hn.resolve_hostnames(['10.0.0.2']), {'10.0.0.2': 'resolved'})
+            self.assertEqual(getfqdn.call_count, 1)
+        self.assertEqual(sorted(json.load(open(self.cache_path)).keys()), ['10.0.0.1', '10.0.0.2'])
+
+    def test_resolve_hostnames_bad_cache(self):
+        '''test resolve_hostnames ignoring an unreadable cache'''
+        open(self.cache_path, 'w').write('{not json')
+        with patch('socket.getfqdn', return_value='resolved'):
+            self.assertEqual(hn.resolve_hostnames(['10.0.0.1']), {'10.0.0.1': 'resolved'})
+        self.assertEqual(json.load(open(self.cache_path))['10.0.0.1'][0], 'resolved')
+
     def test_address_in_network(self):
         '''test address in network'''
         self.assertTrue(hn.address_in_network('192.168.0.1', '192.168.0.0/24'))
@@ -187,6 +261,193 @@ class HodNodeTestCase(unittest.TestCase):
         print sorted_nw
         self.assertEqual([nw[3], nw[2], nw[1], nw[4], nw[0]], sorted_nw)
 
+    def test_node_inventory(self):
+        '''test node_inventory probing the node once'''
+        nw = [hn.NetworkInterface('localhost', '127.0.0.1', 'lo', 8),
+              hn.NetworkInterface('wibble01.wibble.data', '10.143.13.2', 'ib0', 16)]
+        hn.reset_node_inventory()
+        self.addCleanup(hn.reset_node_inventory)
+        inventory = hn.node_inventory()
+        self.assertTrue(hn.node_inventory() is inventory)
+        with patch('hod.node.node.get_networks', return_value=nw) as get_networks:
+            memory = dict(meminfo=dict(memtotal=1024), ulimit='unlimited', cgroup='unlimited')
+            with patch('hod.node.node.get_memory', return_value=memory) as get_memory:
+                self.assertEqual(inventory.data_network(), nw[1])
+                self.assertEqual(inventory.network(), [nw[1], nw[0]])
+                info = inventory.node_info()
+                self.assertEqual(info['network'], [nw[1], nw[0]])
+                info['cores'] = -2
+                self.assertNotEqual(inventory.node_info()['cores'], -2)
+                self.assertEqual(get_networks.call_count, 1)
+                self.assertEqual(get_memory.call_count, 1)
+
+                hn.reset_node_inventory()
+                self.assertFalse(hn.node_inventory() is inventory)
+                hn.node_inventory().network()
+                self.assertEqual(get_networks.call_count, 2)
+
+    def test_node_inventory_numa(self):
+        '''test node_inventory reporting the NUMA nodes in use'''
+        topology = [dict(node=0, cpus=[0, 1], memory=None), dict(node=1, cpus=[2, 3], memory=None)]
+        hn.reset_node_inventory()
+        self.addCleanup(hn.reset_node_inventory)
+        with patch('hod.node.node.get_numa_topology', return_value=topology):
+            with patch('hod.node.node.sched_getaffinity') as affinity:
+                affinity.return_value.cpus = [0, 0, 1, 0]
+                self.assertEqual(hn.node_inventory().numa_nodes(), [topology[1]])
+                with patch('hod.node.node.numactl_available', return_value=True):
+                    self.assertEqual(hn.node_inventory().numa_binding(), 'numactl --cpunodebind=1 --membind=1')
+                with patch('hod.node.node.numactl_available', return_value=False):
+                    self.assertEqual(hn.node_inventory().numa_binding(), '')
+        with patch('hod.node.node.get_numa_topology', return_value=topology[:1]):
+            with patch('hod.node.node.numactl_available', return_value=True):
+                self.assertEqual(hn.node_inventory().numa_binding(), '')
+
+    def test_get_cpu_limits(self):
+        '''test get_cpu_limits picking the tightest cpu limit'''
+        with patch.dict(os.environ, {'PBS_NUM_PPN': '6'}):
+            self.assertEqual(hn.get_cpu_limits(range(8), dict(memory=None, cpus=None)),
+                             (6, {'affinity': 8, 'cgroup': None, 'pbs_num_ppn': 6}))
+            self.assertEqual(hn.get_cpu_limits(range(8), dict(memory=None, cpus=2))[0], 2)
+            self.assertEqual(hn.get_cpu_limits(range(4), dict(memory=None, cpus=None))[0], 4)
+        with patch.dict(os.environ, {'PBS_NUM_PPN': ''}):
+            self.assertEqual(hn.get_cpu_limits(range(8), dict(memory=None, cpus=None)),
+                             (8, {'affinity': 8, 'cgroup': None, 'pbs_num_ppn': None}))
+
+    def test_node_get_memory_cgroup(self):
+        '''test get_memory reporting the cgroup memory limit'''
+        self.assertEqual(hn.get_memory(dict(memory=1024, cpus=None))['cgroup'], 1024)
+        self.assertEqual(hn.get_memory(dict(memory=None, cpus=None))['cgroup'], 'unlimited')
+        self.assertTrue('cgroup' in hn.get_memory())
+
+    def test_get_link_info(self):
+        '''test reading the link speed, mtu, operstate and RDMA support from sysfs'''
+        self._sysfs('net/eno1/speed', 100000)
+        self._sysfs('net/eno1/mtu', 9000)
+        self._sysfs('net/eno1/operstate', 'up')
+        self._sysfs('net/eno2/speed', -1)
+        self._sysfs('net/eno2/operstate', 'down')
+        self._sysfs('net/ib0/mtu', 65520)
+        # IPoIB on mlx4_0, RoCE on mlx5_0
+        self._sysfs('infiniband/mlx4_0/ports/1/rate', '56 Gb/sec (4X FDR)')
+        self._sysfs('infiniband/mlx4_0/device/net/ib0/mtu', 65520)
+        self._sysfs('infiniband/mlx5_0/ports/1/rate', '25 Gb/sec (1X EDR)')
+        self._sysfs('infiniband/mlx5_0/ports/1/gid_attrs/ndevs/0', 'eno1')
+        self._sysfs('infiniband/mlx5_0/ports/1/gid_attrs/ndevs/1', 'eno1.100')
+        rdma_devices = hn.get_rdma_devices()
+        self.assertEqual(rdma_devices, {'ib0': 56000, 'eno1': 25000, 'eno1.100': 25000})
+        self.assertEqual(hn.get_link_info('eno1', rdma_devices), (100000, 9000, 'up', True))
+        self.assertEqual(hn.get_link_info('eno2', rdma_devices), (None, None, 'down', False))
+        self.assertEqual(hn.get_link_info('ib0', rdma_devices), (56000, 65520, None, True))
+        self.assertEqual(hn.get_link_info('nosuchdev', rdma_devices), (None, None, None, False))
+
+    def test_get_networks_link_info(self):
+        '''test get_networks filling in the link information'''
+        self._sysfs('net/eno1/speed', 10000)
+        self._sysfs('net/eno1/operstate', 'up')
+        with patch('netifaces.interfaces', return_value=['eno1']):
+            with patch('netifaces.ifaddresses', return_value={2:[{'addr':'10.1.1.2', 'netmask':'255.255.0.0'}]}):
+                with patch('socket.getfqdn', return_value='node1'):
+                    self.assertEqual(hn.get_networks(),
+                                     [hn.NetworkInterface('node1', '10.1.1.2', 'eno1', 16, 10000, None, 'up', False)])
+
+    def test_sorted_network_capability(self):
+        '''test sorted_network ranking the interfaces by link speed and RDMA support'''
+        nw = [hn.NetworkInterface('localhost', '127.0.0.1', 'lo', 8, None, 65536, 'unknown', False),
+              hn.NetworkInterface('node1.admin', '10.1.1.2', 'ib0', 16, 10000, 2044, 'up', True),
+              hn.NetworkInterface('node1.data', '10.2.1.2', 'enp94s0f0', 16, 100000, 9000, 'up', False),
+              hn.NetworkInterface('node1.roce', '10.3.1.2', 'enp94s0f1', 16, 100000, 9000, 'up', True),
+              hn.NetworkInterface('node1.bond', '10.4.1.2', 'bond0', 16, 20000, 1500, 'up', False),
+              hn.NetworkInterface('node1.fast', '10.5.1.2', 'eno3', 16, 200000, 9000, 'down', False)]
+        self.assertEqual(hn.sorted_network(nw), [nw[3], nw[2], nw[4], nw[1], nw[5], nw[0]])
+        self.assertEqual(hn.sorted_network(nw, ['ib*']), [nw[1], nw[3], nw[2], nw[4], nw[5], nw[0]])
+        self.assertEqual(hn.sorted_network(nw, ['10.4.0.0/16', 'enp*f0'])[:3], [nw[4], nw[2], nw[3]])
+        self.assertEqual(hn.sorted_network(nw, ['nosuchdev', 'not/a/network']), hn.sorted_network(nw))
+
+    def test_node_inventory_prefer_interfaces(self):
+        '''test the preferred data interfaces of the node_inventory'''
+        nw = [hn.NetworkInterface('node1.eth', '10.1.1.2', 'em1', 16),
+              hn.NetworkInterface('node1.ib', '10.143.13.2', 'ib0', 16)]
+        hn.reset_node_inventory()
+        self.addCleanup(hn.reset_node_inventory)
+        with patch('hod.node.node.get_networks', return_value=nw) as get_networks:
+            self.assertEqual(hn.node_inventory().data_network(), nw[1])
+            hn.node_inventory().prefer_interfaces(['em*'])
+            self.assertEqual(hn.node_inventory().data_network(), nw[0])
+            self.assertEqual(get_networks.call_count, 1)
+
+    def test_node_inventory_prefer_interfaces_node_info(self):
+        '''test the node info follows the preferred data interfaces set after it was gathered'''
+        nw = [hn.NetworkInterface('node1.eth', '10.1.1.2', 'em1', 16),
+              hn.NetworkInterface('node1.ib', '10.143.13.2', 'ib0', 16)]
+        memory = dict(meminfo=dict(memtotal=1024), ulimit='unlimited', cgroup='unlimited')
+        hn.reset_node_inventory()
+        self.addCleanup(hn.reset_node_inventory)
+        with patch('hod.node.node.get_networks', return_value=nw):
+            with patch('hod.node.node.get_memory', return_value=memory):
+                inventory = hn.node_inventory()
+                # as in setup_tasks: the summaries are gathered before hod.conf is read
+                summary = inventory.summary()
+                self.assertEqual([intf[0] for intf in summary['interfaces']], ['ib0', 'em1'])
+                other = dict(summary, fqdn='node2', interfaces=[('ib0', '10.143.13.3', None, False),
+                                                                ('lo', '127.0.0.1', None, False),
+                                                                ('em1', '10.1.1.3', None, False)])
+                inventory.set_cluster([summary, other])
+
+                inventory.prefer_interfaces(['em*'])
+                info = inventory.node_info()
+                self.assertEqual(info['network'], [nw[0], nw[1]])
+                members = info['cluster']['members']
+                self.assertEqual([intf[0] for intf in members[0]['interfaces']], ['em1', 'ib0'])
+                self.assertEqual([intf[0] for intf in members[1]['interfaces']], ['em1', 'ib0', 'lo'])
+                # the gathered summaries themselves are left alone
+                self.assertEqual([intf[0] for intf in other['interfaces']], ['ib0', 'lo', 'em1'])
+
+    def test_cluster_info(self):
+        '''test aggregating the node summaries of all ranks'''
+        nw = [hn.NetworkInterface('node1.ib', '10.143.13.2', 'ib0', 16, 100000, 2044, 'up', True)]
+        info = dict(fqdn='node1', pid=1234, network=nw, cores=24, usablecores=range(24), totalcores=24,
+                    cpulimits=dict(affinity=24), topology=[],
+                    memory=dict(meminfo=dict(memtotal=64 * 1024**3, memfree=1024**3, cached=2 * 1024**3),
+                                ulimit='unlimited', cgroup='unlimited'))
+        summary = hn.node_summary(info)
+        self.assertFalse('pid' in summary)
+        # only the memory limits are sent
+        self.assertEqual(summary['memory'], dict(meminfo=dict(memtotal=64 * 1024**3), ulimit='unlimited',
+                                                 cgroup='unlimited'))
+        self.assertEqual(summary['interfaces'], [('ib0', '10.143.13.2', 100000, True)])
+        self.assertEqual(hn.memory_limit(summary['memory']), 64 * 1024**3)
+
+        small = dict(summary, fqdn='node2', cores=8,
+                     memory=dict(meminfo=dict(memtotal=64 * 1024**3), ulimit=48 * 1024**3, cgroup=str(16 * 1024**3)))
+        self.assertEqual(hn.memory_limit(small['memory']), 16 * 1024**3)
+        cluster = hn.cluster_info([summary, small])
+        self.assertEqual(cluster['nodes'], 2)
+        self.assertEqual((cluster['min_cores'], cluster['max_cores']), (8, 24))
+        self.assertEqual((cluster['min_memory'], cluster['max_memory']), (16 * 1024**3, 64 * 1024**3))
+        self.assertEqual(cluster['members'], [summary, small])
+
+    def test_node_inventory_cluster(self):
+        '''test the cluster aggregates in the node info of the node_inventory'''
+        nw = [hn.NetworkInterface('node1.ib', '10.143.13.2', 'ib0', 16)]
+        memory = dict(meminfo=dict(memtotal=1024), ulimit='unlimited', cgroup='unlimited')
+        hn.reset_node_inventory()
+        self.addCleanup(hn.reset_node_inventory)
+        with patch('hod.node.node.get_networks', return_value=nw):
+            with patch('hod.node.node.get_memory', return_value=memory):
+                inventory = hn.node_inventory()
+                summary = inventory.summary()
+                cluster = inventory.node_info()['cluster']
+                self.assertEqual(cluster['nodes'], 1)
+                self.assertEqual(cluster['members'], [summary])
+
+                other = dict(summary, cores=summary['cores'] + 4, memory=dict(memory, ulimit=512))
+                inventory.set_cluster([summary, other])
+                cluster = inventory.node_info()['cluster']
+                self.assertEqual(cluster['nodes'], 2)
+                self.assertEqual(cluster['max_cores'], summary['cores'] + 4)
+                self.assertEqual(cluster['min_memory'], 512)
+
     def test_node_get_memory_proc_meminfo(self):
         '''test node get memory'''
         meminfo = hn._get_memory_proc_meminfo()
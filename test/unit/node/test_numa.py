@@ -0,0 +1,93 @@
+###
+# Copyright 2009-2015 Ghent University
+#
+# This file is part of hanythingondemand
+# originally created by the HPC team of Ghent University (http://ugent.be/hpc/en),
+# with support of Ghent University (http://ugent.be/hpc),
+# the Flemish Supercomputer Centre (VSC) (https://vscentrum.be/nl/en),
+# the Hercules foundation (http://www.herculesstichting.be/in_English)
+# and the Department of Economy, Science and Innovation (EWI) (http://www.ewi-vlaanderen.be/en).
+#
+# http://github.com/hpcugent/hanythingondemand
+#
+# hanythingondemand is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation v2.
+#
+# hanythingondemand is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with hanythingondemand. If not, see <http://www.gnu.org/licenses/>.
+"""
+Tests for hod.node.numa
+"""
+import os
+import shutil
+import tempfile
+import unittest
+from mock import patch
+
+import hod.node.numa as hnn
+
+
+class HodNodeNumaTestCase(unittest.TestCase):
+    '''Test reading the NUMA topology from a fake sysfs'''
+
+    def setUp(self):
+        self.sysfs = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.sysfs)
+
+    def _numa_node(self, node_id, cpulist, memtotal_kb):
+        path = os.path.join(self.sysfs, 'node%d' % node_id)
+        os.makedirs(path)
+        open(os.path.join(path, 'cpulist'), 'w').write('%s\n' % cpulist)
+        if memtotal_kb is not None:
+            open(os.path.join(path, 'meminfo'), 'w').write(
+                'Node %d MemTotal:       %d kB\nNode %d MemFree:        1024 kB\n' % (node_id, memtotal_kb, node_id))
+
+    def test_parse_cpulist(self):
+        '''test parse_cpulist'''
+        self.assertEqual(hnn.parse_cpulist('0-3,8,10-11\n'), [0, 1, 2, 3, 8, 10, 11])
+        self.assertEqual(hnn.parse_cpulist('5'), [5])
+        self.assertEqual(hnn.parse_cpulist('\n'), [])
+
+    def test_get_numa_topology(self):
+        '''test get_numa_topology on a 2 socket node with hyperthreading'''
+        self._numa_node(1, '8-15,24-31', 16 * 1024 ** 2)
+        self._numa_node(0, '0-7,16-23', 16 * 1024 ** 2)
+        open(os.path.join(self.sysfs, 'online'), 'w').write('0-1\n')
+        os.makedirs(os.path.join(self.sysfs, 'power'))
+        topology = hnn.get_numa_topology(self.sysfs)
+        self.assertEqual([numa_node['node'] for numa_node in topology], [0, 1])
+        self.assertEqual(topology[0]['cpus'], range(8) + range(16, 24))
+        self.assertEqual(topology[1]['memory'], 16 * 1024 ** 3)
+
+        self.assertEqual(hnn.numa_nodes_in_use(topology, range(4)), [topology[0]])
+        self.assertEqual(hnn.numa_nodes_in_use(topology, [0, 30]), topology)
+        self.assertEqual(hnn.numa_nodes_in_use(topology, []), [])
+
+    def test_get_numa_topology_missing(self):
+        '''test get_numa_topology without (complete) NUMA information'''
+        self.assertEqual(hnn.get_numa_topology(os.path.join(self.sysfs, 'nosuchdir')), [])
+        self._numa_node(0, '0-3', None)
+        os.makedirs(os.path.join(self.sysfs, 'node1'))
+        self.assertEqual(hnn.get_numa_topology(self.sysfs), [dict(node=0, cpus=[0, 1, 2, 3], memory=None)])
+
+    def test_numa_binding(self):
+        '''test numa_binding'''
+        self.assertEqual(hnn.numa_binding([1]), 'numactl --cpunodebind=1 --membind=1')
+        self.assertEqual(hnn.numa_binding([0, 1]), 'numactl --cpunodebind=0,1 --membind=0,1')
+
+    def test_numactl_available(self):
+        '''test numactl_available'''
+        with patch.dict(os.environ, {'PATH': self.sysfs}):
+            self.assertFalse(hnn.numactl_available())
+            numactl = os.path.join(self.sysfs, hnn.NUMACTL)
+            open(numactl, 'w').write('#!/bin/sh\n')
+            os.chmod(numactl, 0755)
+            self.assertTrue(hnn.numactl_available())
@@ -36,7 +36,7 @@ class TestGenconfigSubCommand(unittest.TestCase):
     def test_run(self):
         app = GenConfigSubCommand()
         mpi = Mock(COMM_WORLD=0, Get_size=lambda:1)
-        mock_cfg = Mock(modules=lambda:[], master_env=[], hodconfdir='',
+        mock_cfg = Mock(modules=lambda:[], master_env=[], hodconfdir='', data_interfaces=[],
                 service_files=[])
         with patch('mpi4py.MPI', mpi):
             with patch('hod.hodproc._setup_config_paths'):
@@ -48,7 +48,7 @@ class TestGenconfigSubCommand(unittest.TestCase):
     def test_run_no_hod_module(self):
         app = GenConfigSubCommand()
         mpi = Mock(COMM_WORLD=0, Get_size=lambda:1)
-        mock_cfg = Mock(modules=lambda:[], master_env=[], hodconfdir='',
+        mock_cfg = Mock(modules=lambda:[], master_env=[], hodconfdir='', data_interfaces=[],
                 service_files=[])
         with patch('mpi4py.MPI', mpi):
             with patch('hod.hodproc._setup_config_paths'):
@@ -0,0 +1,57 @@
+###
+# Copyright 2009-2015 Ghent University
+#
+# This file is part of hanythingondemand
+# originally created by the HPC team of Ghent University (http://ugent.be/hpc/en),
+# with support of Ghent University (http://ugent.be/hpc),
+# the Flemish Supercomputer Centre (VSC) (https://vscentrum.be/nl/en),
+# the Hercules foundation (http://www.herculesstichting.be/in_English)
+# and the Department of Economy, Science and Innovation (EWI) (http://www.ewi-vlaanderen.be/en).
+#
+# http://github.com/hpcugent/hanythingondemand
+#
+# hanythingondemand is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation v2.
+#
+# hanythingondemand is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with hanythingondemand. If not, see <http://www.gnu.org/licenses/>.
+"""
+Tests for the 'grow' subcommand.
+"""
+import unittest
+from mock import patch
+
+from hod.subcommands.grow import GrowSubCommand
+
+
+class TestGrowSubCommand(unittest.TestCase):
+    def test_run_no_label(self):
+        app = GrowSubCommand()
+        self.assertEqual(app.run(['grow', '--hod-module=hanythingondemand']), 1)
+
+    def test_run_not_running(self):
+        with patch('hod.subcommands.grow.cluster_grow_info', side_effect=ValueError("Unknown cluster label")):
+            app = GrowSubCommand()
+            self.assertEqual(app.run(['grow', 'mylabel', '--hod-module=hanythingondemand']), 1)
+
+    def test_run(self):
+        grow_info = {'host': 'master', 'port': 1234, 'token': 'secret', 'modules': ['Hadoop']}
+        with patch('hod.subcommands.grow.cluster_grow_info', return_value=grow_info):
+            with patch('hod.subcommands.grow.PbsHodGrowJob') as job:
+                app = GrowSubCommand()
+                self.assertEqual(app.run(['grow', 'mylabel', '--job-nodes=2', '--hod-module=hanythingondemand']), 0)
+                optparser = job.call_args[0][0]
+                self.assertEqual(optparser.options.label, 'mylabel')
+                self.assertEqual(optparser.options.job_nodes, 2)
+                self.assertEqual(job.call_args[0][1], grow_info)
+
+    def test_usage(self):
+        app = GrowSubCommand()
+        usage = app.usage()
+        self.assertTrue(isinstance(usage, basestring))
@@ -0,0 +1,120 @@
+###
+# Copyright 2009-2015 Ghent University
+#
+# This file is part of hanythingondemand
+# originally created by the HPC team of Ghent University (http://ugent.be/hpc/en),
+# with support of Ghent University (http://ugent.be/hpc),
+# the Flemish Supercomputer Centre (VSC) (https://vscentrum.be/nl/en),
+# the Hercules foundation (http://www.herculesstichting.be/in_English)
+# and the Department of Economy, Science and Innovation (EWI) (http://www.ewi-vlaanderen.be/en).
+#
+# http://github.com/hpcugent/hanythingondemand
+#
+# hanythingondemand is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation v2.
+#
+# hanythingondemand is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with hanythingondemand. If not, see <http://www.gnu.org/licenses/>.
+"""
+Tests for growing a running cluster (hod.grow).
+"""
+import os
+import shutil
+import socket
+import tempfile
+import unittest
+from mock import Mock, patch
+
+import hod.grow as hg
+import hod.mpiservice as hm
+from hod.config.config import ConfigOptsParams, RUNS_ON_ALL, RUNS_ON_MASTER, RUNS_ON_SLAVE
+from hod.work.config_service import ConfiguredService
+
+
+def _params(name, runs_on, after=None, requires=None):
+    return ConfigOptsParams(name, runs_on, '', 'start', 'stop', dict(), '/workdir', [], [], 1,
+                            after, requires, '', 1, 'no', 3, '', None, 0)
+
+
+def _tasks():
+    return [
+        hm.Task(ConfiguredService, 'master', [0], _params('master', RUNS_ON_MASTER), None),
+        hm.Task(ConfiguredService, 'slave', [1, 2], _params('slave', RUNS_ON_SLAVE, ['master'], ['master']), None),
+        hm.Task(ConfiguredService, 'all', [0, 1, 2], _params('all', RUNS_ON_ALL, ['slave', 'master']), None),
+    ]
+
+
+class TestGrow(unittest.TestCase):
+    """Tests for hod.grow"""
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.saved = dict()
+        self.svc = Mock(master_template_kwargs=[], tasks=_tasks(), precfg=None)
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def _server(self):
+        with patch('hod.grow.save_grow_info', side_effect=self.saved.__setitem__):
+            server = hg.GrowServer(self.svc, 'label', host='localhost')
+            server.start()
+        return server
+
+    def test_grow_tasks(self):
+        tasks = hg.grow_tasks(_tasks(), 4)
+        self.assertEqual([task.name for task in tasks], ['slave', 'all'])
+        self.assertEqual([task.ranks for task in tasks], [range(4), range(4)])
+        self.assertEqual(tasks[0].config_opts.after, [])
+        self.assertEqual(tasks[0].config_opts.requires, [])
+        self.assertEqual(tasks[1].config_opts.after, ['slave'])
+        self.assertEqual(tasks[1].config_opts.requires, None)
+
+    def test_fetch_task_table(self):
+        server = self._server()
+        try:
+            info = self.saved['label']
+            self.assertEqual(info['host'], 'localhost')
+            sock, data = hg.fetch_task_table('localhost', info['port'], info['token'])
+            try:
+                master_template_kwargs, tasks, precfg = hm._decode_task_table(data)
+                self.assertEqual([task.name for task in tasks], ['master', 'slave', 'all'])
+            finally:
+                sock.close()
+        finally:
+            with patch('hod.grow.rm_grow_info') as rm_grow_info:
+                server.stop()
+                rm_grow_info.assert_called_with('label')
+
+    def test_fetch_task_table_wrong_token(self):
+        server = self._server()
+        try:
+            self.assertRaises(RuntimeError, hg.fetch_task_table, 'localhost', self.saved['label']['port'], 'wrong')
+        finally:
+            with patch('hod.grow.rm_grow_info'):
+                server.stop()
+
+    def test_watch_master(self):
+        server, client = socket.socketpair()
+        controldirs = [os.path.join(self.tmpdir, 'svc%d' % idx, 'controldir') for idx in range(2)]
+        server.close()
+        hg._watch_master(client, controldirs)
+        for controldir in controldirs:
+            self.assertTrue(os.path.isfile(os.path.join(controldir, hm.FORCE_STOP_FILE)))
+
+    def test_setup_grow_tasks(self):
+        data = hm._encode_task_table([], _tasks())
+        sock = Mock()
+        sock.recv.return_value = ''
+        svc = Mock(rank=0, size=1)
+        with patch('hod.grow.fetch_task_table', return_value=(sock, data)) as fetch:
+            with patch('hod.grow.mklocalworkdir', return_value=self.tmpdir):
+                hg.setup_grow_tasks(svc, {'host': 'master', 'port': 1234, 'token': 'secret'})
+        fetch.assert_called_with('master', 1234, 'secret')
+        svc.distribution.assert_called_with(precfg=None)
+        self.assertEqual([task.name for task in svc.tasks], ['slave', 'all'])
@@ -34,14 +34,14 @@ import hod.mpiservice as hm
 
 class TestHodLocal(EnhancedTestCase):
     def test_local_no_args(self):
-        with patch('hod.local.gen_cluster_info', return_value={}):
-            with patch('hod.local.save_cluster_info', side_effect=lambda *args: None):
+        with patch('hod.localjob.gen_cluster_info', return_value={}):
+            with patch('hod.localjob.save_cluster_info', side_effect=lambda *args: None):
                 self.assertErrorRegex(SystemExit, '1', hl.main, [])
 
     def test_master_rank(self):
         with patch('mpi4py.MPI.COMM_WORLD', Mock(rank=hm.MASTERRANK)):
-            with patch('hod.local.gen_cluster_info', return_value={}):
-                with patch('hod.local.save_cluster_info', side_effect=lambda *args: None):
+            with patch('hod.localjob.gen_cluster_info', return_value={}):
+                with patch('hod.localjob.save_cluster_info', side_effect=lambda *args: None):
                     self.assertErrorRegex(SystemExit, '1', hl.main, [])
 
     def test_slave_rank(self):
@@ -25,12 +25,17 @@
 @author Ewan Higgs (Universiteit Gent)
 '''
 
+import cPickle
+import os
+import shutil
+import tempfile
 import unittest
 from mock import patch, Mock
 from cStringIO import StringIO
+import hod.config.config as hcc
 import hod.hodproc as hh
 from hod.subcommands.create import CreateOptions
-from hod.config.template import TemplateResolver
+from hod.config.template import ConfigTemplate, TemplateResolver
 
 manifest_config = """
 [Meta]
@@ -89,6 +94,28 @@ class TestHodProcConfiguredMaster(unittest.TestCase):
         self.assertTrue('Python-2.7.9-intel-2015a' in cm.tasks[0].config_opts.modules)
         self.assertTrue('Spark/1.3.0' in cm.tasks[0].config_opts.modules)
 
+    def test_configured_master_distribution_data_interfaces(self):
+        """The master redoes its template args with the data interfaces preferred in hod.conf"""
+        opts = CreateOptions(go_args=['progname', '--hodconf', 'hod.conf'])
+        cm = hh.ConfiguredMaster(opts.options)
+        cm.master_template_kwargs = [ConfigTemplate('masterdataname', 'node1.ib', '')]
+        hodconf = manifest_config + 'data_interfaces=eno*,10.141.0.0/16\n'
+        redone = [ConfigTemplate('masterdataname', 'node1.eth', '')]
+        inventory = Mock()
+        with patch('hod.hodproc._setup_config_paths', side_effect=None):
+            with patch('hod.config.config.PreServiceConfigOpts.autogen_configs'):
+                with patch('hod.hodproc.resolve_config_paths', side_effect=['hod.conf']):
+                    with patch('hod.config.template.mklocalworkdir', return_value='localworkdir'):
+                        with patch('hod.hodproc.node_inventory', return_value=inventory):
+                            with patch('hod.hodproc.master_template_opts', return_value=redone):
+                                with patch('__builtin__.open', side_effect=lambda name, *args: StringIO(
+                                        hodconf if name == 'hod.conf' else service_config)):
+                                    cm.distribution(*cm.master_template_kwargs)
+        inventory.prefer_interfaces.assert_called_once_with(['eno*', '10.141.0.0/16'])
+        self.assertEqual(cm.master_template_kwargs, redone)
+        self.assertEqual(cm.tasks[0].config_opts.master_template_kwargs, tuple(redone))
+        self.assertEqual(cm.precfg.data_interfaces, ['eno*', '10.141.0.0/16'])
+
     def test_configured_slave_distribution(self):
         opts = CreateOptions(go_args=['progname', '--hodconf', 'hod.conf',
         '--modules', 'Python-2.7.9-intel-2015a,Spark/1.3.0'])
@@ -105,6 +132,46 @@ class TestHodProcConfiguredMaster(unittest.TestCase):
         self.assertTrue(autogen_config.called)
         self.assertEqual(autogen_config.call_count, 1)
 
+    def test_configured_slave_distribution_precfg(self):
+        """Configs written from the master's parsed hod.conf are the same as those from parsing it locally"""
+        tmpdir = tempfile.mkdtemp()
+        try:
+            hodconf = os.path.join(tmpdir, 'hod.conf')
+            with open(hodconf, 'w') as fh:
+                fh.write(manifest_config.replace('some.module.function', 'hod.config.writer.hadoop_xml') +
+                         '[core-site.xml]\nfs.defaultFS=hdfs://$masterhostaddress:54310\n'
+                         'hadoop.tmp.dir=$localworkdir\n')
+            with open(os.path.join(tmpdir, 'svc.conf'), 'w') as fh:
+                fh.write(service_config)
+            opts = CreateOptions(go_args=['progname', '--hodconf', hodconf, '--workdir', tmpdir])
+            master_template_args = [ConfigTemplate('masterhostaddress', '10.0.0.1', '')]
+
+            cm = hh.ConfiguredMaster(opts.options)
+            with patch('hod.config.template.mklocalworkdir', return_value=os.path.join(tmpdir, 'master')):
+                cm.distribution(*master_template_args)
+            self.assertTrue(cm.precfg is not None)
+            # the only service runs on the master
+            self.assertEqual(cm.precfg.cpu_pinning, [])
+
+            written = []
+            for label, precfg in [('parsed', None), ('received', cPickle.loads(cPickle.dumps(cm.precfg, 2)))]:
+                localworkdir = os.path.join(tmpdir, 'slave')
+                cs = hh.ConfiguredSlave(opts.options)
+                with patch('hod.config.template.mklocalworkdir', return_value=localworkdir):
+                    with patch('hod.hodproc.load_hod_config', side_effect=hh.load_hod_config) as load:
+                        with patch('hod.config.config.slave_cpu_pinning',
+                                   side_effect=hcc.slave_cpu_pinning) as pinning:
+                            cs.distribution(*master_template_args, precfg=precfg)
+                self.assertEqual(load.called, precfg is None)
+                # the master sent the pinning of the services, so the service files are not parsed
+                self.assertEqual(pinning.called, precfg is None)
+                written.append(open(os.path.join(localworkdir, 'conf', 'core-site.xml')).read())
+                shutil.rmtree(localworkdir)
+            self.assertTrue('10.0.0.1' in written[0])
+            self.assertEqual(written[0], written[1])
+        finally:
+            shutil.rmtree(tmpdir)
+
     def test_script_output_paths_nolabel(self):
         out, err = hh._script_output_paths('script_name')
         self.assertEqual(out, '$PBS_O_WORKDIR/hod-script_name.o${PBS_JOBID}')
@@ -0,0 +1,153 @@
+###
+# Copyright 2009-2015 Ghent University
+#
+# This file is part of hanythingondemand
+# originally created by the HPC team of Ghent University (http://ugent.be/hpc/en),
+# with support of Ghent University (http://ugent.be/hpc),
+# the Flemish Supercomputer Centre (VSC) (https://vscentrum.be/nl/en),
+# the Hercules foundation (http://www.herculesstichting.be/in_English)
+# and the Department of Economy, Science and Innovation (EWI) (http://www.ewi-vlaanderen.be/en).
+#
+# http://github.com/hpcugent/hanythingondemand
+#
+# hanythingondemand is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation v2.
+#
+# hanythingondemand is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with hanythingondemand. If not, see <http://www.gnu.org/licenses/>.
+'''Tests for the local MPI stand-in'''
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import unittest
+from array import array
+
+import hod.localmpi as hl
+
+# run by the launcher in test_launch; checks the collectives hod uses on all ranks
+_PROGRAM = """
+import sys
+from array import array
+from mpi4py import MPI
+
+comm = MPI.COMM_WORLD
+rank, size = comm.Get_rank(), comm.Get_size()
+assert comm.bcast(rank == 0 and 'payload' or None, root=0) == 'payload'
+assert comm.allgather(rank) == range(size)
+odd = comm.Create(comm.Get_group().Incl([x for x in range(size) if x % 2]))
+if rank % 2:
+    assert odd.allreduce(rank, op=MPI.SUM) == sum([x for x in range(size) if x % 2])
+    odd.Disconnect()
+else:
+    assert odd == MPI.COMM_NULL
+status = array('L', [1 << rank])
+result = array('L', [0])
+request = comm.Iallreduce([status, MPI.UNSIGNED_LONG], [result, MPI.UNSIGNED_LONG], op=MPI.BOR)
+request.Wait()
+assert result[0] == (1 << size) - 1
+comm.barrier()
+sys.exit(int(sys.argv[1]) if rank == size - 1 else 0)
+"""
+
+
+class TestLocalMpi(unittest.TestCase):
+    '''Test the local MPI stand-in'''
+
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def _run(self, size, fn):
+        '''Run fn(rank, COMM_WORLD) for all ranks in threads with a hub; return the results per rank'''
+        path = os.path.join(self.tmpdir, 'hub')
+        hub = hl.Hub(path, size)
+        results = [None] * size
+        errors = []
+
+        def _rank(rank):
+            try:
+                conn = hl._Connection(path, rank)
+                results[rank] = fn(rank, hl.Comm(conn, hl.WORLD_ID, range(size), rank))
+                conn.sock.close()
+            except Exception, err:
+                errors.append(err)
+
+        threads = [threading.Thread(target=_rank, args=(rank,)) for rank in range(size)]
+        for thread in threads:
+            thread.start()
+        hub.accept()
+        hub.run()
+        for thread in threads:
+            thread.join()
+        if errors:
+            raise errors[0]
+        return results
+
+    def test_bcast_gather(self):
+        def _fn(rank, comm):
+            return (comm.bcast(rank == 2 and 'x' or None, root=2), comm.allgather(rank * 10),
+                    comm.gather(rank, root=1), comm.allreduce(rank, op='MAX'))
+        results = self._run(4, _fn)
+        self.assertEqual(results[0], ('x', [0, 10, 20, 30], None, 3))
+        self.assertEqual(results[1], ('x', [0, 10, 20, 30], [0, 1, 2, 3], 3))
+
+    def test_split_create(self):
+        def _fn(rank, comm):
+            split = comm.Split(rank < 3 and 1 or hl.UNDEFINED, -rank)
+            created = comm.Create(comm.Get_group().Incl([3, 1]))
+            res = [None, None]
+            if split != hl.COMM_NULL:
+                res[0] = (split.Get_rank(), split.Get_size(), split.allgather(rank))
+                split.Free()
+            if created != hl.COMM_NULL:
+                res[1] = (created.Get_rank(), created.allgather(rank))
+                created.Disconnect()
+            return res
+        results = self._run(4, _fn)
+        self.assertEqual(results[0], [(2, 3, [2, 1, 0]), None])
+        self.assertEqual(results[1], [(1, 3, [2, 1, 0]), (1, [3, 1])])
+        self.assertEqual(results[3], [None, (0, [3, 1])])
+
+    def test_iallreduce(self):
+        def _fn(rank, comm):
+            status = array('L', [1 << rank, rank])
+            result = array('L', [0, 0])
+            request = comm.Iallreduce([status, 'UNSIGNED_LONG'], [result, 'UNSIGNED_LONG'], op='BOR')
+            if rank == 0:
+                time.sleep(0.2)
+            tests = 0
+            while not request.Test():
+                tests += 1
+                time.sleep(0.01)
+            return list(result), tests
+        results = self._run(3, _fn)
+        self.assertEqual([res[0] for res in results], [[7, 3]] * 3)
+        self.assertTrue(results[1][1] > 0)
+
+    def test_rank_exit(self):
+        def _fn(rank, comm):
+            if rank == 1:
+                return None
+            comm.barrier()
+        self.assertRaises(RuntimeError, self._run, 2, _fn)
+
+    def test_launch(self):
+        with open(os.path.join(self.tmpdir, 'localmpi_program.py'), 'w') as fh:
+            fh.write(_PROGRAM)
+        env = dict(os.environ)
+        env['PYTHONPATH'] = os.pathsep.join([self.tmpdir, os.getcwd()] + sys.path)
+        cmd = [sys.executable, '-m', 'hod.localmpi', '-n', '5', 'localmpi_program']
+        self.assertEqual(subprocess.call(cmd + ['0'], env=env), 0)
+        self.assertEqual(subprocess.call(cmd + ['3'], env=env), 3)
@@ -25,12 +25,127 @@
 @author Ewan Higgs (Universiteit Gent)
 '''
 
+import cPickle
+import json
+import os
 import pytest
+import shutil
+import signal
+import tempfile
+import time
 import unittest
+import hod.commands.usage as usage
 import hod.mpiservice as hm
+import hod.wakeup as hw
 
-from mock import sentinel
+from cStringIO import StringIO
+
+from mock import Mock, patch, sentinel
+from hod.config.config import ConfigOptsParams, PreServiceConfigOpts, RUNS_ON_MASTER, service_start_phases
+from hod.commands.command import Command
+from hod.commands.executor import attach_command
 from hod.config.template import ConfigTemplate
+from hod.work.work import Work
+
+_MANIFEST = """
+[Meta]
+version = 1
+[Config]
+modules=mod1,mod2
+services=svc.conf
+config_writer=hod.config.writer.hadoop_xml
+[core-site.xml]
+fs.defaultFS=hdfs://$masterhostaddress:54310
+"""
+
+
+class _DoneWork(Work):
+    '''Work that is over as soon as it is started'''
+    stopped = []
+    ticks = []
+
+    def __init__(self, cfg, master_env):
+        Work.__init__(self)
+        self.name = cfg.name
+        self.controldir = os.path.join(cfg.workdir, 'controldir')
+        self.ticks.append(0)
+        self.tick = len(self.ticks) - 1
+
+    def prepare_work_cfg(self):
+        pass
+
+    def pre_start_work_service(self):
+        pass
+
+    def start_work_service(self):
+        pass
+
+    def work_wait(self):
+        self.ticks[self.tick] += 1
+        return True
+
+    def stop_work_service(self):
+        self.stopped.append(self.name)
+
+
+class _KilledWork(_DoneWork):
+    '''Work during which the job is killed'''
+    stopped = []
+    ticks = []
+
+    def work_wait(self):
+        os.kill(os.getpid(), signal.SIGTERM)
+        return False
+
+
+class _StopWork(object):
+    '''Work that records when it is stopped, optionally after running a stop command'''
+    def __init__(self, name, stopped, delay=0, command=None):
+        self.name = name
+        self.stopped = stopped
+        self.delay = delay
+        self.command = command
+
+    def do_work_stop(self):
+        time.sleep(self.delay)
+        if self.command is not None:
+            attach_command(self.command)
+            self.command.run()
+        self.stopped.append(self.name)
+
+    def work_end(self):
+        pass
+
+
+class _RunningWork(_StopWork):
+    '''Work that keeps running until it is stopped'''
+    def __init__(self, name, stopped, controldir):
+        _StopWork.__init__(self, name, stopped)
+        self.controldir = controldir
+
+    def work_deadline(self):
+        return time.time() + 3600
+
+    def work_wait(self):
+        return False
+
+
+class _StartWork(object):
+    '''Work that records when it is started, and that may not become ready'''
+    def __init__(self, name, started, ready=True):
+        self.name = name
+        self.started = started
+        self.ready = ready
+
+    def pre_start_work_service(self):
+        pass
+
+    def start_work_service(self):
+        self.started.append(self.name)
+
+    def wait_ready_work_service(self):
+        return self.ready
+
 
 class MPIServiceTestCase(unittest.TestCase):
     '''Test MpiService functions'''
@@ -76,6 +191,27 @@ class MPIServiceTestCase(unittest.TestCase):
         ms = hm.MpiService()
         hm._make_comm_group(ms.comm, range(1))
 
+    def test_make_comm_groups(self):
+        '''test making deduplicated communicators'''
+        ms = hm.MpiService()
+        comms = hm._make_comm_groups(ms.comm, [[0], range(1), [0]])
+        self.assertEqual(comms.keys(), [(0,)])
+        self.assertEqual(comms[(0,)], ms.comm)
+
+    def test_make_comm_groups_split(self):
+        '''test making communicators for subsets of the ranks'''
+        comm = Mock()
+        comm.Get_rank.return_value = 2
+        comm.Get_size.return_value = 4
+        comm.Split.side_effect = lambda color, key: (color, key)
+        with patch('hod.mpiservice._check_comm'):
+            comms = hm._make_comm_groups(comm, [[0], [1, 2, 3], range(4), [1, 2, 3], [3, 2]])
+        self.assertEqual(comm.Split.call_count, 3)
+        self.assertEqual(comms[(0,)], (hm.MPI.UNDEFINED, 2))
+        self.assertEqual(comms[(1, 2, 3)], (0, 1))
+        self.assertEqual(comms[(0, 1, 2, 3)], comm)
+        self.assertEqual(comms[(3, 2)], (0, 1))
+
     def test_mpiservice_distribution(self):
         '''test mpiservice distribution'''
         ms = hm.MpiService()
@@ -124,6 +260,358 @@ class MPIServiceTestCase(unittest.TestCase):
         tasks = hm._slave_spread(ms.comm)
         self.assertEqual(tasks, None)
 
+    def test_compress_ranks(self):
+        '''test compressing rank lists'''
+        self.assertEqual(hm._compress_ranks(range(1000)), [(0, 999)])
+        self.assertEqual(hm._compress_ranks([0, 2, 3, 4, 7]), [(0, 0), (2, 4), (7, 7)])
+        self.assertEqual(hm._compress_ranks([]), [])
+        for ranks in (range(1000), [0, 2, 3, 4, 7], [], [5]):
+            self.assertEqual(hm._expand_ranks(hm._compress_ranks(ranks)), ranks)
+
+    def test_task_table(self):
+        '''test encoding and decoding the task table'''
+        master_template_kwargs = [ConfigTemplate('masterhostname', 'node1', 'doc')]
+        master_env = {'PATH': '/bin'}
+        tasks = []
+        for idx, ranks in enumerate([range(100), [0], range(1, 100)]):
+            params = ConfigOptsParams('svc%d' % idx, RUNS_ON_MASTER, '', 'start', 'stop', {'A': str(idx)},
+                                      '/workdir', ['mod1', 'mod2'], master_template_kwargs, 1,
+                                      None, ['svc0'], '', 1, 'no', 3, '', None, 0)
+            tasks.append(hm.Task(_DoneWork, 'svc%d' % idx, ranks, params, master_env))
+
+        data = hm._encode_task_table(master_template_kwargs, tasks)
+        self.assertTrue(len(data) < len(cPickle.dumps(tasks, cPickle.HIGHEST_PROTOCOL)))
+        decoded_kwargs, decoded_tasks, decoded_precfg = hm._decode_task_table(data)
+        self.assertEqual(decoded_kwargs, master_template_kwargs)
+        self.assertEqual(decoded_tasks, tasks)
+        self.assertEqual(decoded_precfg, None)
+
+        precfg = PreServiceConfigOpts(StringIO(_MANIFEST), workdir='/workdir')
+        data = hm._encode_task_table(master_template_kwargs, tasks, precfg)
+        decoded_precfg = hm._decode_task_table(data)[2]
+        for attr in PreServiceConfigOpts.__slots__:
+            self.assertEqual(getattr(decoded_precfg, attr), getattr(precfg, attr))
+
+        bad_data = cPickle.dumps((hm.TASK_TABLE_VERSION + 1, [], 0, [], None))
+        self.assertRaises(ValueError, hm._decode_task_table, bad_data)
+
+    def test_setup_tasks(self):
+        '''test setting up the tasks on the master'''
+        ms = hm.MpiService()
+        ms.distribution = Mock()
+        ms.tasks = []
+        hm.setup_tasks(ms)
+        self.assertEqual(ms.distribution.call_count, 1)
+
+        ms.distribution.side_effect = RuntimeError('broken config')
+        self.assertRaises(RuntimeError, hm.setup_tasks, ms)
+
+    def test_gather_cluster_inventory(self):
+        '''test sharing the node summaries of all ranks'''
+        memory = dict(meminfo=dict(memtotal=1024), ulimit='unlimited', cgroup='unlimited')
+        summaries = [dict(fqdn='node%d' % idx, cores=4 * (idx + 1), memory=memory) for idx in range(3)]
+        svc = Mock(rank=1, size=3)
+        svc.comm.allgather.return_value = [summaries[0], None, summaries[2]]
+        with patch('hod.node.node.node_inventory') as node_inventory:
+            node_inventory.return_value.summary.return_value = summaries[1]
+            hm._gather_cluster_inventory(svc)
+            svc.comm.allgather.assert_called_with(summaries[1])
+            node_inventory.return_value.set_cluster.assert_called_with([summaries[0], summaries[2]])
+
+            # a rank that can't probe its node still takes part in the allgather
+            node_inventory.return_value.summary.side_effect = OSError('no /proc')
+            svc.comm.allgather.return_value = [None, None, None]
+            node_inventory.return_value.set_cluster.reset_mock()
+            hm._gather_cluster_inventory(svc)
+            svc.comm.allgather.assert_called_with(None)
+            self.assertFalse(node_inventory.return_value.set_cluster.called)
+
+    def test_status_bitmap(self):
+        '''test packing the task status in a bitmap'''
+        status = hm._mk_status(100)
+        self.assertTrue(len(status) * status.itemsize * 8 >= 300)
+        hm._set_status(status, 0, hm.STATUS_DONE)
+        hm._set_status(status, 99, hm.STATUS_FORCE_CONTINUE)
+        hm._set_status(status, 42, hm.STATUS_FORCE_STOP)
+        set_fields = [(idx, field) for idx in range(100)
+                      for field in (hm.STATUS_DONE, hm.STATUS_FORCE_STOP, hm.STATUS_FORCE_CONTINUE)
+                      if hm._get_status(status, idx, field)]
+        self.assertEqual(set_fields, [(0, hm.STATUS_DONE), (42, hm.STATUS_FORCE_STOP),
+                                      (99, hm.STATUS_FORCE_CONTINUE)])
+        self.assertEqual(len(hm._mk_status(0)), 0)
+
+    def test_check_control_files(self):
+        '''test reading the control files into the status bitmap'''
+        tmpdir = tempfile.mkdtemp()
+        try:
+            status = hm._mk_status(2)
+            hm._check_control_files(tmpdir, status, 1)
+            self.assertEqual(list(status), [0])
+            open(os.path.join(tmpdir, hm.FORCE_STOP_FILE), 'w').close()
+            open(os.path.join(tmpdir, hm.FORCE_CONTINUE_FILE), 'w').close()
+            hm._check_control_files(tmpdir, status, 1)
+            self.assertFalse(hm._get_status(status, 0, hm.STATUS_FORCE_STOP))
+            self.assertTrue(hm._get_status(status, 1, hm.STATUS_FORCE_STOP))
+            self.assertTrue(hm._get_status(status, 1, hm.STATUS_FORCE_CONTINUE))
+        finally:
+            shutil.rmtree(tmpdir)
+
+    def test_reduce_status(self):
+        '''test combining the status of all ranks'''
+        ms = hm.MpiService()
+        status = hm._mk_status(30)
+        hm._set_status(status, 29, hm.STATUS_DONE)
+        waiter = Mock()
+        result = hm._reduce_status(ms.comm, status, waiter)
+        self.assertEqual(list(result), list(status))
+
+        comm = Mock()
+        comm.Iallreduce.side_effect = NotImplementedError
+        hm._reduce_status(comm, status, waiter)
+        self.assertEqual(comm.Allreduce.call_count, 1)
+
+    def test_reduce_status_wake(self):
+        '''test a slave that wakes up during the status reduction asks for an early tick'''
+        comm = Mock()
+        comm.Iallreduce.return_value.Test.side_effect = [False, False, True]
+        waiter = Mock()
+        waiter.wait.side_effect = [[hw.WAKEUP_TIMEOUT], [hw.WAKEUP_SIGNAL]]
+        wake = Mock()
+        hm._reduce_status(comm, hm._mk_status(3), waiter, wake)
+        self.assertEqual(wake.call_count, 1)
+
+    def test_wake_master(self):
+        '''test a slave asks for an early tick without piling up messages'''
+        comm = Mock()
+        pending = []
+        hm._wake_master(comm, pending)
+        comm.isend.assert_called_once_with(None, dest=hm.MASTERRANK, tag=hm.WAKEUP_TAG)
+        comm.isend.return_value.Test.return_value = False
+        hm._wake_master(comm, pending)
+        self.assertEqual(comm.isend.call_count, 1)
+        # the master got the message
+        comm.isend.return_value.Test.return_value = True
+        hm._wake_master(comm, pending)
+        self.assertEqual(comm.isend.call_count, 2)
+
+    def test_end_wakeups(self):
+        '''test no wakeup message or request is left when the work is stopped'''
+        comm = Mock()
+        comm.Get_rank.return_value = 1
+        request = Mock()
+        request.Test.side_effect = [False, True]
+        comm.isend.return_value.Test.return_value = True
+        pending = [request]
+        hm._end_wakeups(comm, pending)
+        comm.isend.assert_called_once_with(True, dest=hm.MASTERRANK, tag=hm.WAKEUP_TAG)
+        self.assertEqual(request.Test.call_count, 2)
+        self.assertEqual(pending, [])
+        self.assertFalse(request.Cancel.called)
+
+        # the master receives until it has the last message of both slaves
+        comm = Mock()
+        comm.Get_rank.return_value = hm.MASTERRANK
+        comm.Get_size.return_value = 3
+        comm.Iprobe.side_effect = [True, False, True, True]
+        comm.recv.side_effect = [None, True, True]
+        hm._end_wakeups(comm, [])
+        self.assertEqual(comm.recv.call_count, 3)
+
+    def test_master_wait(self):
+        '''test the master wakes up early when a slave asks for it'''
+        comm = Mock()
+        comm.Iprobe.side_effect = [False, True, True, False]
+        waiter = Mock(interval=60)
+        waiter.wait.return_value = [hw.WAKEUP_TIMEOUT]
+        self.assertEqual(hm._master_wait(comm, waiter, True), [hm.WAKEUP_SLAVE])
+        self.assertEqual(waiter.wait.call_count, 2)
+        self.assertTrue(waiter.wait.call_args[0][0] <= hm.STATUS_POLL_INTERVAL)
+        self.assertEqual(comm.recv.call_count, 2)
+
+        # without point-to-point messages, only the waiter wakes up the master
+        waiter.wait.reset_mock()
+        self.assertEqual(hm._master_wait(comm, waiter, False), [hw.WAKEUP_TIMEOUT])
+        waiter.wait.assert_called_once_with()
+
+        comm = Mock()
+        comm.Get_size.return_value = 4
+        self.assertTrue(hm._can_wake_master(comm))
+        del comm.Iprobe
+        self.assertFalse(hm._can_wake_master(comm))
+
+    def test_run_tasks(self):
+        '''test running and stopping work'''
+        tmpdir = tempfile.mkdtemp()
+        try:
+            ms = hm.MpiService()
+            params = ConfigOptsParams('svc', RUNS_ON_MASTER, '', '', '', dict(), tmpdir, [], [], 1,
+                                      None, None, '', 1, 'no', 3, '', None, 0)
+            ms.tasks = [hm.Task(_DoneWork, 'svc%d' % idx, [0], params._replace(name='svc%d' % idx), None)
+                        for idx in range(3)]
+            localworkdir = os.path.join(tmpdir, 'rank0')
+            os.makedirs(localworkdir)
+            with patch('hod.mpiservice.mkjobworkdir', return_value=tmpdir):
+                with patch('hod.mpiservice.mklocalworkdir', return_value=localworkdir):
+                    with patch('hod.config.template.mklocalworkdir', return_value=localworkdir):
+                        hm.run_tasks(ms)
+            self.assertEqual(len(_DoneWork.stopped), 3)
+            self.assertEqual(_DoneWork.ticks, [1, 1, 1])
+            # the work runs on all ranks, so with the communicator of the service itself
+            self.assertEqual(ms.tempcomm, [])
+            self.assertTrue(os.path.exists(os.path.join(localworkdir, 'command-usage.txt')))
+            trace = json.load(open(os.path.join(localworkdir, 'startup-trace.json')))
+            names = [ev['name'] for ev in trace['traceEvents'] if ev['ph'] == 'X']
+            self.assertTrue('start svc0' in names)
+            self.assertTrue('ready svc2' in names)
+        finally:
+            shutil.rmtree(tmpdir)
+
+    def test_run_tasks_terminated(self):
+        '''test stopping all work when the job is killed'''
+        tmpdir = tempfile.mkdtemp()
+        try:
+            ms = hm.MpiService()
+            params = ConfigOptsParams('svc', RUNS_ON_MASTER, '', '', '', dict(), tmpdir, [], [], 1,
+                                      None, None, '', 1, 'no', 3, '', None, 0)
+            ms.tasks = [hm.Task(_KilledWork, 'svc%d' % idx, [0], params._replace(name='svc%d' % idx), None)
+                        for idx in range(2)]
+            # the usage of the commands another rank ran, in its localworkdir
+            os.makedirs(os.path.join(tmpdir, 'rank1'))
+            record = dict(service='svc0', rank=1, host='node1', script='ExecStop', wall=1.5, returncode=0)
+            usage.write_record(os.path.join(tmpdir, 'rank1', usage.USAGE_FILENAME), record)
+            localworkdir = os.path.join(tmpdir, 'rank0')
+            os.makedirs(localworkdir)
+            handler = signal.getsignal(signal.SIGTERM)
+            with patch('hod.mpiservice.mkjobworkdir', return_value=tmpdir):
+                with patch('hod.mpiservice.mklocalworkdir', return_value=localworkdir):
+                    with patch('hod.config.template.mklocalworkdir', return_value=localworkdir):
+                        self.assertRaises(hm.Terminated, hm.run_tasks, ms)
+            self.assertEqual(sorted(_KilledWork.stopped), ['svc0', 'svc1'])
+            self.assertEqual(signal.getsignal(signal.SIGTERM), handler)
+            # the master wrote the summary of the usage of all ranks
+            table = open(os.path.join(localworkdir, usage.SUMMARY_FILENAME)).read().splitlines()
+            self.assertEqual(table[1].split()[:4], ['svc0', '1', 'node1', 'ExecStop'])
+        finally:
+            shutil.rmtree(tmpdir)
+
+    def test_start_work_not_ready(self):
+        '''test work that requires work which did not become ready is not started'''
+        ms = hm.MpiService()
+        params = ConfigOptsParams('svc', RUNS_ON_MASTER, '', '', '', dict(), '/tmp', [], [], 1,
+                                  None, None, '', 1, 'no', 3, '', None, 0)
+        ms.tasks = [
+            hm.Task(None, 'namenode', [0], params._replace(name='namenode', after=[]), None),
+            hm.Task(None, 'datanode', [0], params._replace(name='datanode', requires=['namenode']), None),
+            hm.Task(None, 'yarn', [0], params._replace(name='yarn', requires=['datanode']), None),
+            hm.Task(None, 'notebook', [0], params._replace(name='notebook', after=['namenode']), None),
+        ]
+        started = []
+        task_work = {
+            0: _StartWork('namenode', started, ready=False),
+            1: _StartWork('datanode', started),
+            2: _StartWork('yarn', started),
+            3: _StartWork('notebook', started),
+        }
+        phases = service_start_phases([task.config_opts for task in ms.tasks])
+        started_idx = []
+        skipped = hm._start_work(ms, task_work, phases, started_idx)
+        # After= only orders the start, so the notebook is started anyway
+        self.assertEqual(started, ['namenode', 'notebook'])
+        self.assertEqual(sorted(started_idx), [0, 3])
+        self.assertEqual(skipped, set([1, 2]))
+
+        started[:] = []
+        task_work[0].ready = True
+        self.assertEqual(hm._start_work(ms, task_work, phases, []), set())
+        # datanode and notebook are started at the same time
+        self.assertEqual(started[0], 'namenode')
+        self.assertEqual(sorted(started[1:3]), ['datanode', 'notebook'])
+        self.assertEqual(started[3], 'yarn')
+
+    def test_start_work_startup_done(self):
+        '''test the startup is over before a script that runs until the job ends'''
+        ms = hm.MpiService()
+        params = ConfigOptsParams('svc', RUNS_ON_MASTER, '', '', '', dict(), '/tmp', [], [], 1,
+                                  None, None, '', 1, 'no', 3, '', None, 0)
+        ms.tasks = [hm.Task(None, 'svc', [0], params, None),
+                    hm.Task(None, 'script.sh', [0], params._replace(name='script.sh'), None)]
+        started = []
+        task_work = {0: _StartWork('svc', started), 1: _StartWork('script.sh', started)}
+        startup_done = Mock(side_effect=lambda: started.append('startup done'))
+        hm._start_work(ms, task_work, [[0], [1]], [], startup_done=startup_done)
+        self.assertEqual(started, ['svc', 'script.sh', 'startup done'])
+
+        started[:] = []
+        ms.tasks[1] = ms.tasks[1]._replace(config_opts=params._replace(name='script.sh', timeout=None))
+        hm._start_work(ms, task_work, [[0], [1]], [], startup_done=startup_done)
+        self.assertEqual(started, ['svc', 'startup done', 'script.sh'])
+        self.assertEqual(startup_done.call_count, 2)
+
+    def test_supervise_work_slave_control_files(self):
+        '''test the control files in the controldir of the work on a slave stop it on all ranks'''
+        tmpdir = tempfile.mkdtemp()
+        try:
+            ms = hm.MpiService()
+            ms.rank = 1
+            params = ConfigOptsParams('svc', RUNS_ON_MASTER, '', '', '', dict(), tmpdir, [], [], 1,
+                                      None, None, '', 1, 'no', 3, '', None, 0)
+            ms.tasks = [hm.Task(None, 'svc%d' % idx, [1], params._replace(name='svc%d' % idx), None)
+                        for idx in range(2)]
+            stopped = []
+            task_work = dict([(idx, _RunningWork('svc%d' % idx, stopped, os.path.join(tmpdir, 'svc%d' % idx)))
+                              for idx in range(2)])
+            for work in task_work.values():
+                os.makedirs(work.controldir)
+                open(os.path.join(work.controldir, hm.FORCE_STOP_FILE), 'w').close()
+            done = set()
+            hm._supervise_work(ms, task_work, done)
+            self.assertEqual(done, set([0, 1]))
+            self.assertEqual(sorted(stopped), ['svc0', 'svc1'])
+        finally:
+            shutil.rmtree(tmpdir)
+
+    def test_teardown(self):
+        '''test stopping the work in reverse start order within the budget'''
+        ms = hm.MpiService()
+        ms.tasks = [hm.Task(None, 'svc%d' % idx, [0], None, None) for idx in range(4)]
+        stopped = []
+        task_work = {
+            0: _StopWork('svc0', stopped),
+            1: _StopWork('svc1', stopped, delay=0.1),
+            2: _StopWork('svc2', stopped, delay=10),
+            3: _StopWork('svc3', stopped),
+        }
+        # svc3 was not started
+        not_stopped = hm._teardown(ms, task_work, [0, 1, 2], [[0], [1, 2], [3]], 0.5)
+        self.assertEqual(not_stopped, ['svc2'])
+        self.assertEqual(stopped, ['svc1', 'svc0'])
+
+    def test_teardown_terminates(self):
+        '''test stop scripts that hang are terminated when the budget is spent'''
+        ms = hm.MpiService()
+        ms.tasks = [hm.Task(None, 'svc', [0], None, None)]
+        stopped = []
+        command = Command('sleep 10')
+        start = time.time()
+        self.assertEqual(hm._teardown(ms, {0: _StopWork('svc', stopped, command=command)}, [0], [[0]], 0.5), ['svc'])
+        while not stopped and time.time() - start < 5:
+            time.sleep(0.1)
+        self.assertEqual(stopped, ['svc'])
+        self.assertTrue(time.time() - start < 2)
+        self.assertTrue(command._terminated)
+
+    def test_interruptible_barrier(self):
+        '''test waiting for a barrier without blocking in MPI'''
+        comm = Mock()
+        comm.Ibarrier.return_value.Test.side_effect = [False, False, True]
+        hm._interruptible_barrier(comm, 'test')
+        self.assertEqual(comm.Ibarrier.return_value.Test.call_count, 3)
+
+        comm = Mock()
+        comm.Ibarrier.side_effect = NotImplementedError
+        hm._interruptible_barrier(comm, 'test')
+        comm.barrier.assert_called_once_with()
+
     @pytest.mark.xfail
     def test_mpiservice_run_dist(self):
         '''test mpiservice run dist'''
@@ -0,0 +1,105 @@
+###
+# Copyright 2009-2015 Ghent University
+#
+# This file is part of hanythingondemand
+# originally created by the HPC team of Ghent University (http://ugent.be/hpc/en),
+# with support of Ghent University (http://ugent.be/hpc),
+# the Flemish Supercomputer Centre (VSC) (https://vscentrum.be/nl/en),
+# the Hercules foundation (http://www.herculesstichting.be/in_English)
+# and the Department of Economy, Science and Innovation (EWI) (http://www.ewi-vlaanderen.be/en).
+#
+# http://github.com/hpcugent/hanythingondemand
+#
+# hanythingondemand is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation v2.
+#
+# hanythingondemand is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with hanythingondemand. If not, see <http://www.gnu.org/licenses/>.
+"""
+Tests for the spawn helper (hod.spawn)
+"""
+import os
+import signal
+import subprocess
+import sys
+import time
+import unittest
+from mock import patch
+
+import hod.commands.command as hcc
+import hod.node.node as hn
+import hod.spawn as hs
+
+
+class TestSpawn(unittest.TestCase):
+    """Tests for hod.spawn"""
+    def setUp(self):
+        self.client = hs.start_spawn_helper()
+
+    def tearDown(self):
+        hs.stop_spawn_helper()
+
+    def test_spawn(self):
+        p = self.client.spawn('echo $FOO; pwd; echo err >&2; exit 3', env={'FOO': 'bar'}, cwd='/')
+        self.assertTrue(p.pid > 0)
+        self.assertEqual(p.stdout.read(), 'bar\n/\n')
+        self.assertEqual(p.stderr.read(), 'err\n')
+        self.assertEqual(p.wait(), 3)
+        self.assertEqual(p.poll(), 3)
+        self.assertTrue(p.usage['maxrss'] > 0)
+
+    def test_command(self):
+        self.assertTrue(hs.spawn_client() is self.client)
+        with patch.object(self.client, 'spawn', wraps=self.client.spawn) as spawn:
+            out, err = hcc.Command('echo hello; kill -TERM $$').run()
+        self.assertEqual(spawn.call_count, 1)
+        self.assertEqual(out, 'hello')
+        self.assertEqual(err, 'Exitcode -15\n')
+
+    def test_spawn_cpus(self):
+        cpu = hn.node_inventory().usable_cores()[-1]
+        p = self.client.spawn('grep Cpus_allowed_list /proc/self/status', cpus=[cpu])
+        self.assertEqual(p.stdout.read().split(), ['Cpus_allowed_list:', str(cpu)])
+        self.assertEqual(p.wait(), 0)
+        # cpus that do not exist
+        p = self.client.spawn('true', cpus=[1023])
+        self.assertTrue('sched_setaffinity' in p.stderr.read())
+        self.assertEqual(p.wait(), 127)
+
+    def test_ignores_sigterm(self):
+        os.kill(self.client.pid, signal.SIGTERM)
+        time.sleep(0.1)
+        self.assertTrue(hs.spawn_client() is not None)
+        self.assertEqual(hcc.Command('echo hello').run(), ('hello', ''))
+
+    def test_helper_gone(self):
+        os.kill(self.client.pid, signal.SIGKILL)
+        for _ in range(50):
+            if hs.spawn_client() is None:
+                break
+            time.sleep(0.1)
+        self.assertTrue(hs.spawn_client() is None)
+        self.assertRaises(hs.SpawnError, self.client.spawn, 'true')
+        # commands are started directly then
+        self.assertEqual(hcc.Command('echo hello').run(), ('hello', ''))
+
+    def test_start_if_requested(self):
+        hs.stop_spawn_helper()
+        hs.start_spawn_helper_if_requested(['hod.local', '--workdir=/tmp'])
+        self.assertTrue(hs.spawn_client() is None)
+        hs.start_spawn_helper_if_requested(['hod.local', hs.SPAWN_HELPER_OPTION])
+        self.assertTrue(hs.spawn_client() is not None)
+
+    def test_import_entry_points(self):
+        '''test importing the main scripts of the jobs does not start the helper nor initialize MPI'''
+        code = ("import sys; sys.argv.append(%r); import hod.local, hod.growjob, hod.spawn; "
+                "print [name for name in ('mpi4py.MPI', 'vsc.utils.fancylogger') if name in sys.modules], "
+                "hod.spawn.spawn_client()" % hs.SPAWN_HELPER_OPTION)
+        output = subprocess.Popen([sys.executable, '-c', code], stdout=subprocess.PIPE).communicate()[0]
+        self.assertEqual(output, '[] None\n')
@@ -0,0 +1,145 @@
+###
+# Copyright 2009-2015 Ghent University
+#
+# This file is part of hanythingondemand
+# originally created by the HPC team of Ghent University (http://ugent.be/hpc/en),
+# with support of Ghent University (http://ugent.be/hpc),
+# the Flemish Supercomputer Centre (VSC) (https://vscentrum.be/nl/en),
+# the Hercules foundation (http://www.herculesstichting.be/in_English)
+# and the Department of Economy, Science and Innovation (EWI) (http://www.ewi-vlaanderen.be/en).
+#
+# http://github.com/hpcugent/hanythingondemand
+#
+# hanythingondemand is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation v2.
+#
+# hanythingondemand is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with hanythingondemand. If not, see <http://www.gnu.org/licenses/>.
+'''
+Tests for the startup timeline.
+'''
+
+import json
+import os
+import shutil
+import tempfile
+import threading
+import unittest
+
+import hod.timeline as ht
+
+
+class HodTimelineTestCase(unittest.TestCase):
+    '''Test timeline functions'''
+
+    def setUp(self):
+        ht.reset()
+
+    def tearDown(self):
+        ht.reset()
+
+    def test_monotonic(self):
+        '''test the monotonic clock does not go back'''
+        first = ht.monotonic()
+        self.assertTrue(ht.monotonic() >= first)
+
+    def test_span(self):
+        '''test recording a phase with span'''
+        with ht.span('phase', size=3):
+            pass
+        events = ht.events()
+        self.assertEqual(len(events), 1)
+        name, cat, start, end, args, tid = events[0]
+        self.assertEqual((name, cat, args, tid), ('phase', ht.CATEGORY_STARTUP, {'size': 3}, 0))
+        self.assertTrue(end >= start)
+
+    def test_span_threads(self):
+        '''test phases of other threads are recorded with their own thread index'''
+        ht.record('main', 0.0, 1.0)
+        thread = threading.Thread(target=lambda: ht.record('other', 1.0, 2.0), name='worker')
+        thread.start()
+        thread.join()
+        ht.record('main', 2.0, 3.0)
+        self.assertEqual([(ev[0], ev[5]) for ev in ht.events()], [('main', 0), ('other', 1), ('main', 0)])
+        self.assertEqual(ht.export(0)['threads'], {0: threading.current_thread().name, 1: 'worker'})
+
+    def test_span_exception(self):
+        '''test a phase is recorded when it fails'''
+        def fail():
+            with ht.span('failing'):
+                raise ValueError('nope')
+        self.assertRaises(ValueError, fail)
+        self.assertEqual(ht.events()[0][0], 'failing')
+
+    def test_timed(self):
+        '''test recording each call of a function'''
+        @ht.timed('double')
+        def double(value):
+            return value * 2
+        self.assertEqual(double(2), 4)
+        self.assertEqual(double.__name__, 'double')
+        self.assertEqual([ev[0] for ev in ht.events()], ['double'])
+
+    def test_export(self):
+        '''test exporting the timeline with wall clock timestamps'''
+        ht.record('phase', 10.0, 12.5)
+        exported = ht.export(3)
+        self.assertEqual(exported['rank'], 3)
+        self.assertEqual(exported['pid'], os.getpid())
+        name, cat, start, end, args, tid = exported['events'][0]
+        self.assertAlmostEqual(end - start, 2.5)
+
+    def test_chrome_trace(self):
+        '''test making a chrome trace of several ranks'''
+        timelines = [
+            {'rank': 0, 'hostname': 'node1', 'pid': 1, 'threads': {0: 'MainThread', 1: 'start-0'}, 'events': [
+                ('load', ht.CATEGORY_STARTUP, 100.0, 101.0, {}, 0),
+                ('start', ht.CATEGORY_STARTUP, 100.25, 100.75, {}, 1),
+            ]},
+            {'rank': 1, 'hostname': 'node2', 'pid': 2, 'threads': {0: 'MainThread'},
+             'events': [('bcast', ht.CATEGORY_MPI, 100.5, 102.0, {}, 0)]},
+        ]
+        trace = ht.chrome_trace(timelines)
+        phases = [ev for ev in trace['traceEvents'] if ev['ph'] == 'X']
+        self.assertEqual([(ev['name'], ev['pid'], ev['tid'], ev['ts'], ev['dur']) for ev in phases],
+                         [('load', 0, 0, 0, 1000000), ('start', 0, 1, 250000, 500000),
+                          ('bcast', 1, 0, 500000, 1500000)])
+        threads = [(ev['pid'], ev['tid'], ev['args']['name']) for ev in trace['traceEvents']
+                   if ev['name'] == 'thread_name']
+        self.assertEqual(threads, [(0, 0, 'MainThread'), (0, 1, 'start-0'), (1, 0, 'MainThread')])
+        self.assertEqual(ht.chrome_trace([]), {'traceEvents': []})
+
+    def test_write_chrome_trace(self):
+        '''test writing a chrome trace'''
+        tmpdir = tempfile.mkdtemp()
+        try:
+            path = os.path.join(tmpdir, ht.TRACE_FILENAME)
+            ht.record('phase', 1.0, 2.0)
+            ht.write_chrome_trace([ht.export(0)], path)
+            trace = json.load(open(path))
+            self.assertEqual(trace['traceEvents'][-1]['name'], 'phase')
+        finally:
+            shutil.rmtree(tmpdir)
+
+    def test_critical_path_summary(self):
+        '''test the summary of the slowest phases'''
+        timelines = [
+            {'rank': 0, 'hostname': 'node1', 'pid': 1, 'threads': {0: 'MainThread'}, 'events': [
+                ('load', ht.CATEGORY_STARTUP, 0.0, 1.0, {}, 0),
+                ('bcast', ht.CATEGORY_MPI, 1.0, 5.0, {}, 0),
+            ]},
+            {'rank': 1, 'hostname': 'node2', 'pid': 2, 'threads': {0: 'MainThread'}, 'events': [
+                ('load', ht.CATEGORY_STARTUP, 0.0, 2.0, {}, 0),
+                ('start', ht.CATEGORY_STARTUP, 5.0, 6.0, {}, 0),
+            ]},
+        ]
+        summary = ht.critical_path_summary(timelines)
+        self.assertEqual(summary, 'startup took 6.00s; slowest phases: load 2.00s (rank 1 on node2), '
+                                  'start 1.00s (rank 1 on node2)')
+        self.assertEqual(ht.critical_path_summary([]), 'no startup phases recorded')
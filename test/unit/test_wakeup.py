@@ -0,0 +1,122 @@
+###
+# Copyright 2009-2015 Ghent University
+#
+# This file is part of hanythingondemand
+# originally created by the HPC team of Ghent University (http://ugent.be/hpc/en),
+# with support of Ghent University (http://ugent.be/hpc),
+# the Flemish Supercomputer Centre (VSC) (https://vscentrum.be/nl/en),
+# the Hercules foundation (http://www.herculesstichting.be/in_English)
+# and the Department of Economy, Science and Innovation (EWI) (http://www.ewi-vlaanderen.be/en).
+#
+# http://github.com/hpcugent/hanythingondemand
+#
+# hanythingondemand is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation v2.
+#
+# hanythingondemand is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with hanythingondemand. If not, see <http://www.gnu.org/licenses/>.
+'''
+Tests for the supervision loop wakeup sources.
+'''
+
+import os
+import shutil
+import signal
+import subprocess
+import tempfile
+import time
+import unittest
+
+import hod.wakeup as hw
+
+
+class HodWakeupTestCase(unittest.TestCase):
+    '''Test wakeup functions'''
+
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def test_wakeup_pipe(self):
+        '''test notify and drain of the self-pipe'''
+        pipe = hw.WakeupPipe()
+        self.assertFalse(pipe.drain())
+        pipe.notify()
+        pipe.notify()
+        self.assertTrue(pipe.drain())
+        self.assertFalse(pipe.drain())
+        pipe.close()
+
+    def test_wait_timeout(self):
+        '''test waiting without any event returns after the timeout'''
+        waiter = hw.Waiter(60)
+        start = time.time()
+        self.assertEqual(waiter.wait(0.1), [hw.WAKEUP_TIMEOUT])
+        self.assertTrue(time.time() - start < 5)
+        waiter.stop()
+
+    def test_wait_deadline(self):
+        '''test a deadline shortens the wait and fires only once'''
+        waiter = hw.Waiter(60)
+        waiter.add_deadline(time.time() + 0.1)
+        start = time.time()
+        self.assertEqual(waiter.wait(), [hw.WAKEUP_DEADLINE])
+        self.assertTrue(time.time() - start < 5)
+        self.assertEqual(waiter.deadlines, [])
+        self.assertEqual(waiter.wait(0.1), [hw.WAKEUP_TIMEOUT])
+        waiter.stop()
+
+    def test_wait_control_inotify(self):
+        '''test creating a control file wakes up the waiter'''
+        waiter = hw.Waiter(60)
+        waiter.watch(self.tmpdir)
+        open(os.path.join(self.tmpdir, 'force_stop'), 'w').close()
+        self.assertEqual(waiter.wait(5), [hw.WAKEUP_CONTROL])
+        waiter.stop()
+
+    def test_wait_control_polling(self):
+        '''test the polling fallback picks up control files'''
+        waiter = hw.Waiter(60, use_inotify=False)
+        waiter.watch(self.tmpdir)
+        self.assertTrue(waiter.watcher.polling)
+        self.assertEqual(waiter.watcher.fileno(), None)
+        open(os.path.join(self.tmpdir, 'force_stop'), 'w').close()
+        self.assertEqual(waiter.wait(hw.CONTROL_POLL_INTERVAL + 1), [hw.WAKEUP_CONTROL])
+        waiter.stop()
+
+    def test_wait_sigchld(self):
+        '''test a child exiting wakes up the waiter'''
+        waiter = hw.Waiter(60)
+        waiter.start()
+        try:
+            subprocess.call(['true'])
+            self.assertEqual(waiter.wait(5), [hw.WAKEUP_SIGNAL])
+        finally:
+            waiter.stop()
+        self.assertEqual(signal.getsignal(signal.SIGCHLD), signal.SIG_DFL)
+
+    def test_signal_wakeup_fd(self):
+        '''test the pipe of the last waiter is the wakeup fd of the process'''
+        first = hw.Waiter(60)
+        second = hw.Waiter(60)
+        first.start()
+        second.start()
+        try:
+            self.assertEqual(signal.set_wakeup_fd(second.pipe.wfd), second.pipe.wfd)
+            # the earlier waiter is notified by the signal handler
+            subprocess.call(['true'])
+            self.assertEqual(first.wait(5), [hw.WAKEUP_SIGNAL])
+            self.assertEqual(second.wait(5), [hw.WAKEUP_SIGNAL])
+            second.stop()
+            self.assertEqual(signal.set_wakeup_fd(first.pipe.wfd), first.pipe.wfd)
+        finally:
+            first.stop()
+        self.assertEqual(signal.set_wakeup_fd(-1), -1)
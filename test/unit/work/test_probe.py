@@ -0,0 +1,130 @@
+##
+# Copyright 2009-2013 Ghent University
+#
+# This file is part of hanythingondemand
+# originally created by the HPC team of Ghent University (http://ugent.be/hpc/en),
+# with support of Ghent University (http://ugent.be/hpc),
+# the Flemish Supercomputer Centre (VSC) (https://vscentrum.be/nl/en),
+# the Hercules foundation (http://www.herculesstichting.be/in_English)
+# and the Department of Economy, Science and Innovation (EWI) (http://www.ewi-vlaanderen.be/en).
+#
+# http://github.com/hpcugent/hanythingondemand
+#
+# hanythingondemand is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation v2.
+#
+# hanythingondemand is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with hanythingondemand. If not, see <http://www.gnu.org/licenses/>.
+'''Tests for the service probes'''
+import BaseHTTPServer
+import os
+import socket
+import subprocess
+import tempfile
+import threading
+import time
+import unittest
+
+import hod.work.probe as hwp
+
+
+class _OkHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+    def do_GET(self):
+        if self.path == '/ok':
+            self.send_response(200)
+        else:
+            self.send_response(404)
+        self.end_headers()
+
+    def log_message(self, *args):
+        pass
+
+
+class TestProbe(unittest.TestCase):
+    '''Test the service probes'''
+
+    def _free_port(self):
+        sock = socket.socket()
+        sock.bind(('127.0.0.1', 0))
+        port = sock.getsockname()[1]
+        sock.close()
+        return port
+
+    def test_parse_probe(self):
+        self.assertEqual(hwp.parse_probe('tcp:localhost:80'), ('tcp', 'localhost:80'))
+        self.assertEqual(hwp.parse_probe('http://localhost:80/x'), ('http', '//localhost:80/x'))
+        self.assertEqual(hwp.parse_probe(' file:/tmp/x '), ('file', '/tmp/x'))
+        self.assertRaises(ValueError, hwp.parse_probe, 'localhost:80')
+        self.assertRaises(ValueError, hwp.parse_probe, 'udp:localhost:80')
+        self.assertRaises(ValueError, hwp.parse_probe, 'tcp:localhost')
+        self.assertRaises(ValueError, hwp.parse_probe, 'file:')
+
+    def test_probe_tcp(self):
+        sock = socket.socket()
+        sock.bind(('127.0.0.1', 0))
+        sock.listen(1)
+        port = sock.getsockname()[1]
+        self.assertTrue(hwp.probe('tcp:127.0.0.1:%d' % port))
+        sock.close()
+        self.assertFalse(hwp.probe('tcp:127.0.0.1:%d' % self._free_port()))
+
+    def test_probe_http(self):
+        server = BaseHTTPServer.HTTPServer(('127.0.0.1', 0), _OkHandler)
+        port = server.server_address[1]
+        thread = threading.Thread(target=server.serve_forever)
+        thread.daemon = True
+        thread.start()
+        try:
+            self.assertTrue(hwp.probe('http:127.0.0.1:%d/ok' % port))
+            self.assertTrue(hwp.probe('http://127.0.0.1:%d/ok' % port))
+            self.assertFalse(hwp.probe('http:127.0.0.1:%d/missing' % port))
+        finally:
+            server.shutdown()
+            server.server_close()
+        self.assertFalse(hwp.probe('http:127.0.0.1:%d/ok' % self._free_port()))
+
+    def test_probe_file(self):
+        fd, fn = tempfile.mkstemp()
+        os.close(fd)
+        self.assertTrue(hwp.probe('file:%s' % fn))
+        os.unlink(fn)
+        self.assertFalse(hwp.probe('file:%s' % fn))
+
+    def test_probe_pid(self):
+        fd, fn = tempfile.mkstemp()
+        os.write(fd, '%d\n' % os.getpid())
+        os.close(fd)
+        self.assertTrue(hwp.probe('pid:%s' % fn))
+        proc = subprocess.Popen(['true'])
+        proc.wait()
+        fh = open(fn, 'w')
+        fh.write(str(proc.pid))
+        fh.close()
+        self.assertFalse(hwp.probe('pid:%s' % fn))
+        os.unlink(fn)
+        self.assertFalse(hwp.probe('pid:%s' % fn))
+
+    def test_wait_for_probe(self):
+        fd, fn = tempfile.mkstemp()
+        os.close(fd)
+        os.unlink(fn)
+        timer = threading.Timer(0.3, lambda: open(fn, 'w').close())
+        timer.start()
+        try:
+            start = time.time()
+            self.assertTrue(hwp.wait_for_probe('file:%s' % fn, 10))
+            self.assertTrue(time.time() - start < 5)
+        finally:
+            timer.join()
+            os.unlink(fn)
+
+    def test_wait_for_probe_timeout(self):
+        start = time.time()
+        self.assertFalse(hwp.wait_for_probe('file:/no/such/file/hopefully', 0.5))
+        self.assertTrue(0.5 <= time.time() - start < 2)
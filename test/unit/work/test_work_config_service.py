@@ -25,11 +25,17 @@
 """
 @author: Ewan Higgs
 """
+import json
 import os
+import shutil
+import tempfile
+import threading
 import unittest
-from mock import patch, sentinel
+from mock import MagicMock, patch, sentinel
 from cStringIO import StringIO
 
+import hod.commands.executor as hce
+import hod.commands.usage as hcu
 import hod.work.config_service as hwc
 import hod.config.config as hcc
 import hod.config.template as hct
@@ -74,13 +80,87 @@ class TestHodWorkConfiguredService(unittest.TestCase):
         '''Test ConfiguredService start method'''
         cfg = hcc.ConfigOpts.from_file(_mk_master_config(), hct.TemplateResolver(workdir='/tmp'))
         cs = hwc.ConfiguredService(cfg)
-        cs.start_work_service()
+        localworkdir = tempfile.mkdtemp()
+        try:
+            with patch('hod.config.template.mklocalworkdir', return_value=localworkdir):
+                cs.start_work_service()
+        finally:
+            shutil.rmtree(localworkdir)
 
     def test_ConfiguredService_stop_work_service(self):
         '''Test ConfiguredService stop method'''
         cfg = hcc.ConfigOpts.from_file(_mk_master_config(), hct.TemplateResolver(workdir='/tmp'))
         cs = hwc.ConfiguredService(cfg)
-        cs.stop_work_service()
+        localworkdir = tempfile.mkdtemp()
+        try:
+            with patch('hod.config.template.mklocalworkdir', return_value=localworkdir):
+                cs.stop_work_service()
+        finally:
+            shutil.rmtree(localworkdir)
+
+    def test_ConfiguredService_start_work_service_output(self):
+        '''Test ConfiguredService streaming the script output to its output files'''
+        cfg = hcc.ConfigOpts.from_file(_mk_master_config(), hct.TemplateResolver(workdir='/tmp'))
+        cs = hwc.ConfiguredService(cfg)
+        localworkdir = tempfile.mkdtemp()
+        try:
+            with patch('hod.config.template.mklocalworkdir', return_value=localworkdir):
+                cs.start_work_service()
+                cs.stop_work_service()
+                out_path, err_path = cs.output_paths()
+            self.assertEqual(out_path, os.path.join(localworkdir, 'log', 'test.out'))
+            lines = open(out_path).read().splitlines()
+            self.assertEqual(len(lines), 4)
+            self.assertTrue(lines[0].endswith('ExecStart: echo hello <=='))
+            self.assertEqual(lines[1], 'hello')
+            self.assertTrue(lines[2].endswith('ExecStop: echo hello <=='))
+            self.assertEqual(lines[3], 'hello')
+            self.assertEqual(len(open(err_path).read().splitlines()), 2)
+            self.assertEqual([record['script'] for record in cs.command_usage], ['ExecStart', 'ExecStop'])
+            usage_path = os.path.join(localworkdir, hcu.USAGE_FILENAME)
+            records = [json.loads(line) for line in open(usage_path)]
+            self.assertEqual(records, cs.command_usage)
+            self.assertEqual(records[0]['service'], 'test')
+            self.assertEqual(records[0]['returncode'], 0)
+        finally:
+            shutil.rmtree(localworkdir)
+
+    def test_ConfiguredService_start_work_service_no_localworkdir(self):
+        '''Test ConfiguredService running its scripts without streaming when there is no localworkdir'''
+        cfg = hcc.ConfigOpts.from_file(_mk_master_config(), hct.TemplateResolver(workdir='/tmp'))
+        cs = hwc.ConfiguredService(cfg)
+        err = RuntimeError('$PBS_JOBID must be defined to create a localworkdir')
+        with patch('hod.config.template.mklocalworkdir', side_effect=err):
+            self.assertEqual(cs._run_script('ExecStart', 'echo hello', {}), ('hello', ''))
+        self.assertEqual([record['script'] for record in cs.command_usage], ['ExecStart'])
+
+    def test_ConfiguredService_cpus(self):
+        '''Test ConfiguredService pinning its daemon following CPUAffinity or ReservedCores'''
+        cfg = hcc.ConfigOpts.from_file(_mk_master_config(), hct.TemplateResolver(workdir='/tmp'))
+        cs = hwc.ConfiguredService(cfg)
+        cs.svc = MagicMock(rank=0)
+        with patch('hod.node.node.NodeInventory.usable_cores', return_value=range(8)):
+            self.assertEqual(cs._cpus(), None)
+            cfg.reserved_cores = 2
+            self.assertEqual(cs._cpus(), [6, 7])
+            cfg.reserved_cores = 0
+            cfg.cpu_affinity = [1, 9]
+            self.assertEqual(cs._cpus(), [1])
+            cfg.cpu_affinity = [9]
+            self.assertEqual(cs._cpus(), None)
+
+        cfg.cpu_affinity = [3]
+        with patch('hod.node.node.NodeInventory.usable_cores', return_value=range(8)):
+            with patch('hod.work.config_service.Command', side_effect=hwc.Command) as command:
+                localworkdir = tempfile.mkdtemp()
+                try:
+                    with patch('hod.config.template.mklocalworkdir', return_value=localworkdir):
+                        with patch('hod.commands.command.Command.run', return_value=('', '')):
+                            cs.start_work_service()
+                            cs.stop_work_service()
+                finally:
+                    shutil.rmtree(localworkdir)
+        self.assertEqual([kwargs['cpus'] for _, kwargs in command.call_args_list], [[3], None])
 
     def test_ConfiguredService_prepare_work_cfg(self):
         cfg = hcc.ConfigOpts.from_file(_mk_slave_config(), hct.TemplateResolver(workdir='/tmp'))
@@ -90,3 +170,134 @@ class TestHodWorkConfiguredService(unittest.TestCase):
             with patch('hod.config.template.mklocalworkdir', side_effect=lambda *args, **kwargs: localworkdir):
                 cs.prepare_work_cfg()
         self.assertEqual(cs.controldir, os.path.join(localworkdir, 'controldir'))
+
+    def test_ConfiguredService_wait_ready_work_service(self):
+        '''Test ConfiguredService waiting for the ReadyCheck'''
+        cfg = hcc.ConfigOpts.from_file(_mk_master_config(), hct.TemplateResolver(workdir='/tmp'))
+        cs = hwc.ConfiguredService(cfg)
+        self.assertTrue(cs.wait_ready_work_service())
+
+        cfg = hcc.ConfigOpts.from_file(StringIO("""
+[Unit]
+Name=test
+RunsOn=master
+[Service]
+ExecStart=echo hello
+ExecStop=echo hello
+ReadyCheck=file:$workdir/no-such-file
+ReadyTimeout=1
+[Environment]
+    """), hct.TemplateResolver(workdir='/tmp'))
+        cs = hwc.ConfiguredService(cfg)
+        with patch('hod.work.config_service.wait_for_probe', return_value=True) as wait_for_probe:
+            self.assertTrue(cs.wait_ready_work_service())
+        wait_for_probe.assert_called_with('file:/tmp/no-such-file', 1)
+        self.assertFalse(cs.wait_ready_work_service())
+
+    def test_ConfiguredService_check_liveness(self):
+        '''Test ConfiguredService restarting a service that died'''
+        cfg = hcc.ConfigOpts.from_file(StringIO("""
+[Unit]
+Name=test
+RunsOn=master
+[Service]
+ExecStart=echo hello
+ExecStop=echo hello
+ReadyTimeout=0
+Restart=on-failure
+RestartLimit=2
+LivenessCheck=pid:$workdir/test.pid
+[Environment]
+    """), hct.TemplateResolver(workdir='/tmp'))
+        cs = hwc.ConfiguredService(cfg)
+        with patch('hod.work.config_service.probe', return_value=True) as probe:
+            with patch.object(cs, 'start_work_service') as start:
+                self.assertFalse(cs.work_wait())
+        probe.assert_called_with('pid:/tmp/test.pid', timeout=hwc.LIVENESS_TIMEOUT)
+        self.assertFalse(start.called)
+
+        with patch('hod.work.config_service.probe', return_value=False):
+            with patch.object(cs, 'start_work_service') as start:
+                for _ in range(4):
+                    self.assertFalse(cs.work_wait())
+        # restarted until the RestartLimit is reached
+        self.assertEqual(start.call_count, 2)
+        self.assertEqual(cs.restarts, 2)
+
+    def test_ConfiguredService_check_liveness_executor(self):
+        '''Test ConfiguredService restarting a service in the background'''
+        cfg = hcc.ConfigOpts.from_file(StringIO("""
+[Unit]
+Name=test
+RunsOn=master
+[Service]
+ExecStart=echo hello
+ExecStop=echo hello
+ReadyTimeout=0
+Restart=on-failure
+LivenessCheck=pid:$workdir/test.pid
+[Environment]
+    """), hct.TemplateResolver(workdir='/tmp'))
+        cs = hwc.ConfiguredService(cfg)
+        cs.executor = hce.CommandExecutor(1)
+        release = threading.Event()
+        with patch('hod.work.config_service.probe', return_value=False):
+            with patch.object(cs, 'start_work_service', side_effect=lambda: release.wait(5)) as start:
+                # the restart does not block, and there is no other restart while it runs
+                for _ in range(3):
+                    self.assertFalse(cs.work_wait())
+                self.assertEqual(cs.restarts, 1)
+                release.set()
+                cs._restarting.wait(5)
+                self.assertEqual(start.call_count, 1)
+                self.assertFalse(cs.work_wait())
+                self.assertEqual(cs.restarts, 2)
+                cs._restarting.wait(5)
+        cs.executor.shutdown()
+
+    def test_ConfiguredService_check_liveness_no_restart(self):
+        '''Test ConfiguredService not restarting a service without Restart=on-failure'''
+        cfg = hcc.ConfigOpts.from_file(StringIO("""
+[Unit]
+Name=test
+RunsOn=master
+[Service]
+ExecStart=echo hello
+ExecStop=echo hello
+LivenessCheck=pid:$workdir/test.pid
+[Environment]
+    """), hct.TemplateResolver(workdir='/tmp'))
+        cs = hwc.ConfiguredService(cfg)
+        with patch('hod.work.config_service.probe', return_value=False) as probe:
+            with patch.object(cs, 'start_work_service') as start:
+                self.assertFalse(cs.work_wait())
+                self.assertFalse(cs.work_wait())
+        self.assertFalse(start.called)
+        # not checked anymore once it is known to be down
+        self.assertEqual(probe.call_count, 1)
+
+    def test_ConfiguredService_check_liveness_restarting(self):
+        '''Test ConfiguredService giving a restarted service time to come up'''
+        cfg = hcc.ConfigOpts.from_file(StringIO("""
+[Unit]
+Name=test
+RunsOn=master
+[Service]
+ExecStart=echo hello
+ExecStop=echo hello
+ReadyTimeout=300
+Restart=on-failure
+LivenessCheck=tcp:localhost:1234
+[Environment]
+    """), hct.TemplateResolver(workdir='/tmp'))
+        cs = hwc.ConfiguredService(cfg)
+        with patch.object(cs, 'start_work_service') as start:
+            with patch('hod.work.config_service.probe', return_value=False):
+                cs.work_wait()
+                cs.work_wait()
+            self.assertEqual(start.call_count, 1)
+            with patch('hod.work.config_service.probe', return_value=True):
+                cs.work_wait()
+            with patch('hod.work.config_service.probe', return_value=False):
+                cs.work_wait()
+            self.assertEqual(start.call_count, 2)